@@ -0,0 +1,239 @@
+"""Admission control: shed load before it queues up on the database.
+
+Each class of endpoint may run a fixed number of requests against the
+database at once, and keep a bounded number of others waiting for a turn.
+Requests past the queue, or still waiting after ``max_wait``, get a 503
+straight away, so latency stays bounded under a spike instead of growing
+with the backlog. Admitted requests get a time limit for their database
+work, after which their query is cancelled. Optionally, each client is also
+limited to a request rate by a token bucket.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+
+from aiohttp.web import (
+    HTTPGatewayTimeout,
+    HTTPServiceUnavailable,
+    HTTPTooManyRequests,
+    Request,
+    StreamResponse,
+    middleware,
+)
+
+# (concurrency, queue) per endpoint class; the concurrencies add up to the
+# size of a connection pool
+DEFAULT_LIMITS = {
+    "lookup": (5, 64),  # source, object, pixel, multiband and xmatch jobs
+    "search": (3, 16),  # cone, knn, box and polygon
+    "export": (2, 4),
+}
+DEFAULT_MAX_WAIT = 2.0
+
+# Seconds an admitted request may spend on the database, 0 for no limit;
+# exports include streaming the quadrant to the client
+DEFAULT_TIMEOUTS = {
+    "lookup": 5.0,
+    "search": 30.0,
+    "export": 600.0,
+}
+
+# Seconds clients are told to wait before retrying a shed request
+RETRY_AFTER = 1
+
+# Paths never rate limited, so that probes keep working
+UNLIMITED_PATHS = ("/api/v1/health", "/api/v1/ready")
+
+
+class Rejected(Exception):
+    """A request was shed by a Gate."""
+
+
+class QueryTimeout(Exception):
+    """A request ran out of its time for the database."""
+
+    def __init__(self, seconds: float):
+        super().__init__(f"Query timed out after {seconds:g} s")
+        self.seconds = seconds
+
+
+class Gate:
+    """Concurrency limit with a bounded, time-limited wait queue."""
+
+    def __init__(self, concurrency: int, queue: int, max_wait: float):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.max_wait = max_wait
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @asynccontextmanager
+    async def enter(self) -> AsyncIterator[None]:
+        if self._semaphore.locked():
+            if self.waiting >= self.queue:
+                raise Rejected("queue is full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+            except TimeoutError:
+                raise Rejected("timed out in the queue") from None
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+class Admission:
+    """The gates and time limits of all endpoint classes."""
+
+    def __init__(
+        self,
+        limits: dict[str, tuple[int, int]],
+        max_wait: float = DEFAULT_MAX_WAIT,
+        timeouts: dict[str, float] | None = None,
+    ):
+        self.gates = {
+            name: Gate(concurrency, queue, max_wait)
+            for name, (concurrency, queue) in limits.items()
+        }
+        self.timeouts = timeouts or {}
+
+    @asynccontextmanager
+    async def enter(self, name: str) -> AsyncIterator[None]:
+        """Wait for admission to class ``name``, then run the block within
+        its time limit.
+
+        Running out of time cancels the block, and with it the query it is
+        awaiting: asyncpg then cancels the query on the server too.
+        """
+        seconds = self.timeouts.get(name) or None
+        async with self.gates[name].enter():
+            try:
+                async with asyncio.timeout(seconds) as deadline:
+                    yield
+            except TimeoutError:
+                if deadline.expired():
+                    raise QueryTimeout(seconds) from None
+                raise
+
+
+def admission_from_env(environ: dict[str, str]) -> Admission:
+    """Limits from ``ADMISSION_<CLASS>="concurrency,queue"``, the queue wait
+    from ``ADMISSION_MAX_WAIT`` and time limits from ``QUERY_TIMEOUT_<CLASS>``,
+    in seconds."""
+    limits = {}
+    for name, default in DEFAULT_LIMITS.items():
+        value = environ.get(f"ADMISSION_{name.upper()}")
+        if value is None:
+            limits[name] = default
+        else:
+            concurrency, queue = (int(v) for v in value.split(","))
+            limits[name] = (concurrency, queue)
+    max_wait = float(environ.get("ADMISSION_MAX_WAIT", DEFAULT_MAX_WAIT))
+    timeouts = {
+        name: float(environ.get(f"QUERY_TIMEOUT_{name.upper()}", default))
+        for name, default in DEFAULT_TIMEOUTS.items()
+    }
+    return Admission(limits, max_wait, timeouts)
+
+
+class TokenBuckets:
+    """Per-client token buckets of ``rate`` requests/s and ``burst`` tokens."""
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        # client -> (tokens, time they were counted)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._next_purge = clock()
+
+    def take(self, client: str) -> float:
+        """Take a token for ``client``: 0 if it had one, else the seconds
+        until it will."""
+        now = self._clock()
+        self._purge(now)
+        tokens, then = self._buckets.get(client, (self.burst, now))
+        tokens = min(tokens + (now - then) * self.rate, self.burst)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[client] = (tokens - 1, now)
+        return 0.0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _purge(self, now: float) -> None:
+        # A bucket that has filled up again is the same as no bucket
+        if now < self._next_purge:
+            return
+        refill = self.burst / self.rate
+        self._buckets = {
+            client: (tokens, then)
+            for client, (tokens, then) in self._buckets.items()
+            if now - then < refill
+        }
+        self._next_purge = now + refill
+
+
+def client_address(request: Request) -> str:
+    # The proxy appends the address it was connected from, which the client
+    # cannot forge, to X-Forwarded-For
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        return forwarded.rsplit(",", 1)[-1].strip()
+    return request.remote or ""
+
+
+@middleware
+async def admission_errors(
+    request: Request, handler: Callable[[Request], Awaitable[StreamResponse]]
+) -> StreamResponse:
+    # Raised as plain exceptions since single-flight hands the same one to
+    # every request sharing a call, and an HTTPException is a response
+    try:
+        return await handler(request)
+    except Rejected as e:
+        raise HTTPServiceUnavailable(
+            reason=f"Server is busy, {e}", headers={"Retry-After": str(RETRY_AFTER)}
+        )
+    except QueryTimeout as e:
+        raise HTTPGatewayTimeout(reason=str(e))
+
+
+def rate_limit(buckets: TokenBuckets):
+    @middleware
+    async def limit(
+        request: Request, handler: Callable[[Request], Awaitable[StreamResponse]]
+    ) -> StreamResponse:
+        if request.path not in UNLIMITED_PATHS:
+            wait = buckets.take(client_address(request))
+            if wait:
+                raise HTTPTooManyRequests(
+                    reason="Rate limit exceeded",
+                    headers={"Retry-After": str(math.ceil(wait))},
+                )
+        return await handler(request)
+
+    return limit
+
+
+def middlewares_from_env(environ: dict[str, str]) -> list:
+    """Answer shed and timed out requests, and rate limit clients to ``RATE_LIMIT``
+    requests/s with bursts of ``RATE_BURST`` if it is set."""
+    result = [admission_errors]
+    rate = float(environ.get("RATE_LIMIT", "0"))
+    if rate > 0:
+        burst = float(environ.get("RATE_BURST", max(2 * rate, 1)))
+        result.insert(0, rate_limit(TokenBuckets(rate, burst)))
+    return result
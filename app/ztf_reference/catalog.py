@@ -0,0 +1,198 @@
+"""Column layout, queries and object ID helpers shared by the API handlers."""
+
+from __future__ import annotations
+
+import pyarrow as pa
+
+FILTER_ID_TO_NAME = {"1": "zg", "2": "zr", "3": "zi"}
+FILTER_NAME_TO_ID = {v: k for k, v in FILTER_ID_TO_NAME.items()}
+# Values of the smallint filterid column that refpsfcat stores instead of the name
+FILTER_CODES = {name: int(code) for code, name in FILTER_ID_TO_NAME.items()}
+
+RESULT_COLUMNS = (
+    "fieldid",
+    "filter",
+    "ccdid",
+    "qid",
+    "sourceid",
+    "xpos",
+    "ypos",
+    "ra",
+    "dec",
+    "flux",
+    "sigflux",
+    "mag",
+    "sigmag",
+    "snr",
+    "chi",
+    "sharp",
+    "flags",
+    "magzp",
+    "magzp_rms",
+    "magzp_unc",
+    "infobits",
+)
+
+# The object ID as the API returns it: refpsfcat_full computes it as a
+# bigint, indexed on its own, see object_id()
+OID_SQL = "oid::text"
+
+# Every field of an API response, in output order
+OUTPUT_COLUMNS = (*RESULT_COLUMNS, "oid")
+
+SELECT_COLS = ", ".join((*RESULT_COLUMNS, f"{OID_SQL} AS oid"))
+
+# Lookup of one source by its key, shared by /source and the warm-up
+SOURCE_QUERY = f"""
+    SELECT {SELECT_COLS}
+    FROM refpsfcat_full
+    WHERE fieldid = $1 AND filterid = $2 AND ccdid = $3 AND qid = $4 AND sourceid = $5
+"""
+
+# Lookup of one source by its numeric object ID, a probe of a single index
+OBJECT_QUERY = f"""
+    SELECT {SELECT_COLS}
+    FROM refpsfcat_full
+    WHERE oid = $1
+"""
+
+# Bumped by each blue/green swap of the catalog (see swap_catalog() in the
+# schema); in-memory copies of catalog tables are reloaded when it changes
+GENERATION_QUERY = "SELECT coalesce(max(generation), 0) FROM catalog_generation"
+
+# Arrow types of the output columns, matching the database column types
+ARROW_TYPES = {
+    "fieldid": pa.int32(),
+    "filter": pa.string(),
+    "ccdid": pa.int16(),
+    "qid": pa.int16(),
+    "sourceid": pa.int32(),
+    "xpos": pa.float32(),
+    "ypos": pa.float32(),
+    "ra": pa.float64(),
+    "dec": pa.float64(),
+    "flux": pa.float32(),
+    "sigflux": pa.float32(),
+    "mag": pa.float32(),
+    "sigmag": pa.float32(),
+    "snr": pa.float32(),
+    "chi": pa.float32(),
+    "sharp": pa.float32(),
+    "flags": pa.int16(),
+    "magzp": pa.float32(),
+    "magzp_rms": pa.float32(),
+    "magzp_unc": pa.float32(),
+    "infobits": pa.int32(),
+    "oid": pa.string(),
+}
+
+
+def select_columns(columns: tuple[str, ...]) -> str:
+    """SQL select list for the requested output columns."""
+    return ", ".join(
+        f"{OID_SQL} AS oid" if col == "oid" else col
+        for col in OUTPUT_COLUMNS
+        if col in columns
+    )
+
+
+MAX_CONE_RESULTS = 1000
+
+CONE_ORDERINGS = {
+    "distance": "coord <-> $1::scircle",
+    "mag": "mag",
+}
+
+
+# The cone and kNN searches are built here for the handlers and the warm-up
+# alike, so that the warm-up prepares the very statements requests send
+def cone_query(
+    columns: tuple[str, ...], conditions: list[str], order: str = "distance"
+) -> str:
+    """Sources within the scircle $1, meeting ``conditions`` too."""
+    return f"""
+        SELECT {select_columns(columns)}
+        FROM refpsfcat_full
+        WHERE {" AND ".join(["coord <@ $1::scircle", *conditions])}
+        ORDER BY {CONE_ORDERINGS[order]}
+        LIMIT {MAX_CONE_RESULTS}
+        """
+
+
+def knn_query(columns: tuple[str, ...], conditions: list[str]) -> str:
+    """The $2 sources nearest to the spoint $1 meeting ``conditions``."""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # No radius bound: the GIST index yields rows in distance order, so the
+    # LIMIT stops the scan after the k nearest matching sources
+    return f"""
+        SELECT {select_columns(columns)},
+               degrees(coord <-> $1::spoint) * 3600.0 AS separation_arcsec
+        FROM refpsfcat_full
+        {where}
+        ORDER BY coord <-> $1::spoint
+        LIMIT $2
+        """
+
+
+def region_query(columns: tuple[str, ...], conditions: list[str], limit: int) -> str:
+    """Sources meeting ``conditions``, a box or polygon among them, by
+    numeric object ID."""
+    inner = [col for col in OUTPUT_COLUMNS if col in columns and col != "oid"]
+    # The region is matched first, through the GiST index, and only its
+    # sources are sorted: with ORDER BY oid LIMIT over the view the planner
+    # may walk the oid index instead and test each source against the
+    # region, every one of them for an empty region
+    return f"""
+        WITH matched AS MATERIALIZED (
+            SELECT {", ".join([*inner, "oid"])}
+            FROM refpsfcat_full
+            WHERE {" AND ".join(conditions)}
+        )
+        SELECT {select_columns(columns)}
+        FROM matched
+        ORDER BY matched.oid
+        LIMIT {limit}
+        """
+
+
+# The numeric object ID is a bigint
+MAX_OBJECT_ID = 2**63 - 1
+
+
+def parse_object_id(oid: str) -> tuple[int, str, int, int, int]:
+    """Parse ZTF DR object ID into (fieldid, filter, ccdid, qid, sourceid).
+
+    Format: {fieldid}{filter_id}{ccdid:02}{qid}{sourceid:08d}
+    The last 12 characters are fixed-width; fieldid is variable-length.
+    """
+    if len(oid) < 13 or not oid.isdigit():
+        raise ValueError(f"Invalid object ID: {oid!r}")
+    if int(oid) > MAX_OBJECT_ID:
+        raise ValueError(f"Object ID out of range: {oid!r}")
+    fieldid = int(oid[:-12])
+    filter_id = oid[-12]
+    if filter_id not in FILTER_ID_TO_NAME:
+        raise ValueError(f"Invalid filter ID in object ID: {filter_id}")
+    filt = FILTER_ID_TO_NAME[filter_id]
+    ccdid = int(oid[-11:-9])
+    qid = int(oid[-9])
+    sourceid = int(oid[-8:])
+    return fieldid, filt, ccdid, qid, sourceid
+
+
+def build_object_id(
+    fieldid: int, filt: str, ccdid: int, qid: int, sourceid: int
+) -> str:
+    """Build ZTF DR object ID from components."""
+    return f"{fieldid}{FILTER_NAME_TO_ID[filt]}{ccdid:02d}{qid}{sourceid:08d}"
+
+
+def object_id(fieldid, filterid, ccdid, qid, sourceid):
+    """Numeric object ID, as refpsfcat_full computes it from the key columns;
+    works on numpy arrays too.
+
+    Its decimal digits are the object ID, and it sorts like the key.
+    """
+    return (
+        ((fieldid * 10 + filterid) * 100 + ccdid) * 10 + qid
+    ) * 100_000_000 + sourceid
@@ -0,0 +1,245 @@
+"""In-memory sky coverage (MOC) of the catalog, per filter.
+
+Ingest merges the HEALPix cells holding each quadrant's sources into the
+``coverage`` table in the transaction that loads them. Searches whose
+region misses every cell have no results, so the handlers answer them
+without touching the database.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+
+import astropy.units as u
+import numpy as np
+from aiohttp.web import Application
+from astropy_healpix import HEALPix
+
+from .catalog import FILTER_CODES, GENERATION_QUERY
+from .pg_sphere import SPoint
+
+logger = logging.getLogger(__name__)
+
+# The version of every chunk, to tell which ones to read again. xmin, the
+# transaction that last wrote the row, changes with every update whenever it
+# commits, where a watermark on updated_at (the transaction's start) would
+# miss transactions committing late or a replica catching up late
+VERSIONS_QUERY = "SELECT filterid, chunk, xmin::text AS version FROM coverage"
+
+CHUNKS_QUERY = """
+    SELECT filterid, chunk, moc_order, ranges, xmin::text AS version
+    FROM coverage
+    WHERE (filterid, chunk) IN (
+        SELECT * FROM unnest($1::smallint[], $2::integer[])
+    )
+"""
+
+# Coverage is added in the transaction that writes a quadrant's summary, so
+# it is complete once every quadrant has one
+COMPLETE_QUERY = """
+    SELECT (SELECT count(*) FROM quadrant) = (SELECT count(*) FROM quadrant_summary)
+"""
+
+
+# A copy of ztf_reference_ingest.moc.union_ranges, the app and ingest share
+# no code; tests/fixtures/union_ranges.json holds the cases both are tested on
+def union_ranges(*ranges: np.ndarray) -> np.ndarray:
+    """Merge (n, 2) range arrays into sorted, disjoint, non-adjacent ranges."""
+    r = np.concatenate(
+        [np.empty((0, 2), dtype=np.int64)]
+        + [np.asarray(x, dtype=np.int64).reshape(-1, 2) for x in ranges]
+    )
+    if not len(r):
+        return r
+    r = r[np.argsort(r[:, 0], kind="stable")]
+    ends = np.maximum.accumulate(r[:, 1])
+    first = np.r_[True, r[1:, 0] > ends[:-1]]
+    idx = np.flatnonzero(first)
+    return np.stack([r[idx, 0], ends[np.r_[idx[1:] - 1, len(r) - 1]]], axis=1)
+
+
+def bounding_circle(points: list[SPoint]) -> tuple[SPoint, float]:
+    """Center and radius (deg) of a circle around the points' mean direction
+    enclosing them all, and so any box or polygon less than a hemisphere
+    across with these corners."""
+    ra = np.radians([p.ra for p in points])
+    dec = np.radians([p.dec for p in points])
+    v = np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+    c = v.sum(axis=1)
+    c /= np.linalg.norm(c)
+    radius = np.degrees(np.arccos(np.clip(c @ v, -1.0, 1.0)).max())
+    center = SPoint(
+        ra=float(np.degrees(np.arctan2(c[1], c[0])) % 360.0),
+        dec=float(np.degrees(np.arcsin(c[2]))),
+    )
+    return center, float(radius)
+
+
+class Coverage:
+    """Sorted, disjoint [start, end) ranges of nested pixels at ``order``."""
+
+    def __init__(self, order: int, ranges: np.ndarray):
+        self.order = order
+        self.ranges = ranges
+        self._levels: dict[int, tuple[HEALPix, float, np.ndarray]] = {}
+
+    def is_empty(self) -> bool:
+        return not len(self.ranges)
+
+    def _level(self, order: int) -> tuple[HEALPix, float, np.ndarray]:
+        """HEALPix, search margin (deg) and the coverage degraded to ``order``."""
+        if order not in self._levels:
+            shift = 2 * (self.order - order)
+            ranges = union_ranges(
+                np.stack(
+                    [self.ranges[:, 0] >> shift, -(-self.ranges[:, 1] >> shift)], 1
+                )
+            )
+            hp = HEALPix(nside=2**order, order="nested")
+            # cone_search only returns pixels with their center in the cone;
+            # a pixel's points are at most ~1.05 pixel sizes from its center
+            margin = 1.1 * hp.pixel_resolution.to_value(u.deg)
+            self._levels[order] = hp, margin, ranges
+        return self._levels[order]
+
+    def overlaps(self, center: SPoint, radius_deg: float) -> bool:
+        """Whether any covered cell may intersect the circle."""
+        if self.is_empty():
+            return False
+        # Pixels about a quarter of the radius across, so that large regions
+        # are checked against a few dozen coarse cells rather than thousands
+        order = int(np.clip(np.log2(234.0 / max(radius_deg, 1e-9)), 0, self.order))
+        hp, margin, ranges = self._level(order)
+        pixels = hp.cone_search_lonlat(
+            center.ra * u.deg, center.dec * u.deg, (radius_deg + margin) * u.deg
+        )
+        starts, ends = ranges[:, 0], ranges[:, 1]
+        i = np.searchsorted(ends, pixels, side="right")
+        inside = i < len(starts)
+        return bool(np.any(starts[i[inside]] <= pixels[inside]))
+
+    def to_moc(self) -> dict[str, list[int]]:
+        """The coverage as an IVOA MOC in its JSON serialization."""
+        cells: dict[int, list[int]] = {}
+        for start, end in self.ranges.tolist():
+            while start < end:
+                # Largest aligned block starting at `start` that fits
+                depth = 0
+                while (
+                    depth < self.order
+                    and start % (4 ** (depth + 1)) == 0
+                    and start + 4 ** (depth + 1) <= end
+                ):
+                    depth += 1
+                cells.setdefault(self.order - depth, []).append(start >> (2 * depth))
+                start += 4**depth
+        moc = {str(order): sorted(cells[order]) for order in sorted(cells)}
+        # The last key states the maximum order, even with no cells there
+        moc.setdefault(str(self.order), [])
+        return moc
+
+
+class CoverageCache:
+    """Coverage of each filter, and of all of them, refreshed incrementally:
+    only the chunks whose version changed are read again.
+
+    ``get()`` returns None until the coverage is loaded and complete, so that
+    nothing is skipped on the strength of a partial map.
+    """
+
+    def __init__(self):
+        self._generation = None
+        self._chunks: dict[tuple[int, int], np.ndarray] = {}
+        self._versions: dict[tuple[int, int], str] = {}
+        self._order = None
+        self._complete = False
+        self._filters: dict[str | None, Coverage] | None = None
+
+    async def refresh(self, pool) -> None:
+        async with pool.acquire() as con:
+            generation = await con.fetchval(GENERATION_QUERY)
+            if generation != self._generation:
+                # A swapped-in catalog has a coverage of its own, start over
+                self._chunks = {}
+                self._versions = {}
+                self._filters = None
+            versions = {
+                (row["filterid"], row["chunk"]): row["version"]
+                for row in await con.fetch(VERSIONS_QUERY)
+            }
+            stale = [
+                key
+                for key, version in versions.items()
+                if self._versions.get(key) != version
+            ]
+            rows = []
+            if stale:
+                rows = await con.fetch(
+                    CHUNKS_QUERY,
+                    [filterid for filterid, _ in stale],
+                    [chunk for _, chunk in stale],
+                )
+            complete = await con.fetchval(COMPLETE_QUERY)
+        self._generation = generation
+
+        changed = self._filters is None
+        for key in self._chunks.keys() - versions.keys():
+            del self._chunks[key]
+            self._versions.pop(key, None)
+            changed = True
+        for row in rows:
+            key = (row["filterid"], row["chunk"])
+            ranges = np.array(row["ranges"], dtype=np.int64).reshape(-1, 2)
+            if key not in self._chunks or not np.array_equal(self._chunks[key], ranges):
+                self._chunks[key] = ranges
+                changed = True
+            # The row as read, which may be newer than in VERSIONS_QUERY
+            self._versions[key] = row["version"]
+            self._order = row["moc_order"]
+
+        if changed:
+            order = self._order if self._order is not None else 0
+            by_filter = {
+                filt: Coverage(
+                    order,
+                    union_ranges(
+                        *(r for (f, _), r in self._chunks.items() if f == code)
+                    ),
+                )
+                for filt, code in FILTER_CODES.items()
+            }
+            by_filter[None] = Coverage(
+                order, union_ranges(*(c.ranges for c in by_filter.values()))
+            )
+            self._filters = by_filter
+        self._complete = complete
+
+    def get(self, filt: str | None = None) -> Coverage | None:
+        """Coverage of a filter, or of the whole catalog for None."""
+        if not self._complete or self._filters is None:
+            return None
+        return self._filters[filt]
+
+
+async def refresh_loop(app: Application) -> None:
+    interval = float(os.environ.get("COVERAGE_REFRESH_INTERVAL", "30"))
+    while True:
+        try:
+            await app["coverage"].refresh(app["pg_pool"])
+        except Exception:
+            logger.exception("Failed to refresh the coverage map")
+        await asyncio.sleep(interval)
+
+
+async def start_coverage(app: Application) -> None:
+    app["coverage"] = CoverageCache()
+    app["coverage_refresh"] = asyncio.create_task(refresh_loop(app))
+
+
+async def stop_coverage(app: Application) -> None:
+    task = app.get("coverage_refresh")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
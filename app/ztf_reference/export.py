@@ -0,0 +1,92 @@
+"""Stream all sources of a quadrant without materializing them in memory."""
+
+from __future__ import annotations
+
+import io
+
+import pyarrow as pa
+from aiohttp.web import StreamResponse
+from asyncpg import Connection
+
+from .catalog import ARROW_TYPES, OID_SQL, RESULT_COLUMNS, SELECT_COLS
+
+EXPORT_CONTENT_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+ARROW_BATCH_ROWS = 10_000
+
+# Leading columns of the primary key, so the scan stays on that index
+QUADRANT_QUERY = """
+    SELECT {columns}
+    FROM refpsfcat_full
+    WHERE fieldid = $1 AND filterid = $2 AND ccdid = $3 AND qid = $4
+"""
+
+# JSON has no NaN, so float columns go out as null instead
+_FLOAT_TYPES = (pa.float32(), pa.float64())
+_JSON_COLUMNS = ", ".join(
+    [
+        f"NULLIF({col}, 'NaN') AS {col}" if ARROW_TYPES[col] in _FLOAT_TYPES else col
+        for col in RESULT_COLUMNS
+    ]
+    + [f"{OID_SQL} AS oid"]
+)
+
+
+async def _copy(
+    con: Connection, response: StreamResponse, query: str, key: tuple, **options
+) -> None:
+    async def write(chunk: bytes) -> None:
+        await response.write(chunk)
+
+    await con.copy_from_query(query, *key, output=write, **options)
+
+
+async def stream_csv(con: Connection, response: StreamResponse, key: tuple) -> None:
+    query = QUADRANT_QUERY.format(columns=SELECT_COLS)
+    await _copy(con, response, query, key, format="csv", header=True)
+
+
+async def stream_ndjson(con: Connection, response: StreamResponse, key: tuple) -> None:
+    inner = QUADRANT_QUERY.format(columns=_JSON_COLUMNS)
+    # JSON documents never contain tabs, newlines or backslashes here, so
+    # the text format emits them unescaped, one per line
+    query = f"SELECT row_to_json(t) FROM ({inner}) t"
+    await _copy(con, response, query, key, format="text")
+
+
+async def stream_arrow(con: Connection, response: StreamResponse, key: tuple) -> None:
+    schema = pa.schema(list(ARROW_TYPES.items()))
+    query = QUADRANT_QUERY.format(columns=SELECT_COLS)
+    buffer = io.BytesIO()
+    writer = pa.ipc.new_stream(buffer, schema)
+
+    async def flush() -> None:
+        await response.write(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+
+    async with con.transaction(readonly=True):
+        cursor = await con.cursor(query, *key)
+        while rows := await cursor.fetch(ARROW_BATCH_ROWS):
+            batch = pa.record_batch(
+                [
+                    pa.array([row[i] for row in rows], typ, from_pandas=True)
+                    for i, typ in enumerate(schema.types)
+                ],
+                schema=schema,
+            )
+            writer.write_batch(batch)
+            await flush()
+    writer.close()
+    await flush()
+
+
+STREAMERS = {
+    "csv": stream_csv,
+    "ndjson": stream_ndjson,
+    "arrow": stream_arrow,
+}
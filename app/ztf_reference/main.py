@@ -3,19 +3,22 @@ from __future__ import annotations
 import os
 
 from aiohttp.web import Application, run_app
-from asyncpg import create_pool
 
+from .admission import admission_from_env, middlewares_from_env
+from .coverage import start_coverage, stop_coverage
 from .pg_sphere import connection_setup
+from .pools import router_from_env
 from .routes import routes
+from .shards import start_shards, stop_shards
+from .singleflight import SingleFlight
+from .stats import start_stats, stop_stats
+from .warmup import start_warmup, stop_warmup
+from .xmatch import start_workers, stop_workers
 
 
 async def on_startup(app: Application):
-    app["pg_pool"] = await create_pool(
-        host=os.environ.get("DB_HOST", "sql"),
-        database=os.environ.get("DB_NAME", "ztfref"),
-        user=os.environ.get("DB_USER", "app"),
-        setup=connection_setup,
-    )
+    app["pg_pool"] = router_from_env(os.environ, setup=connection_setup)
+    await app["pg_pool"].start()
 
 
 async def on_cleanup(app: Application):
@@ -23,15 +26,29 @@ async def on_cleanup(app: Application):
 
 
 async def get_app() -> Application:
-    app = Application()
+    app = Application(middlewares=middlewares_from_env(os.environ))
+    app["single_flight"] = SingleFlight()
+    app["admission"] = admission_from_env(os.environ)
     app.on_startup.append(on_startup)
+    app.on_startup.append(start_warmup)
+    app.on_startup.append(start_workers)
+    app.on_startup.append(start_stats)
+    app.on_startup.append(start_coverage)
+    app.on_startup.append(start_shards)
+    app.on_cleanup.append(stop_shards)
+    app.on_cleanup.append(stop_coverage)
+    app.on_cleanup.append(stop_stats)
+    app.on_cleanup.append(stop_workers)
+    app.on_cleanup.append(stop_warmup)
     app.on_cleanup.append(on_cleanup)
     app.add_routes(routes)
     return app
 
 
 def main():
-    run_app(get_app(), host="0.0.0.0", port=80)
+    # Cancel the handlers of requests whose client went away, and so their
+    # queries (see SingleFlight for shared ones)
+    run_app(get_app(), host="0.0.0.0", port=80, handler_cancellation=True)
 
 
 if __name__ == "__main__":
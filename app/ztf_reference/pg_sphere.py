@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import math as m
+import re
 from dataclasses import dataclass
 
 from asyncpg import Connection
@@ -31,6 +32,13 @@ class SPoint:
     def to_dict(self) -> dict:
         return {"ra": self.ra, "dec": self.dec}
 
+    def separation(self, other: SPoint) -> float:
+        """Angular distance to another point, in degrees."""
+        sin_ddec = m.sin((other.dec_rad - self.dec_rad) / 2)
+        sin_dra = m.sin((other.ra_rad - self.ra_rad) / 2)
+        h = sin_ddec**2 + m.cos(self.dec_rad) * m.cos(other.dec_rad) * sin_dra**2
+        return m.degrees(2 * m.asin(min(1.0, m.sqrt(h))))
+
 
 @dataclass
 class SCircle:
@@ -53,6 +61,42 @@ class SCircle:
         return SCircle(point=point, radius_arcsec=radius_arcsec)
 
 
+_FLOAT_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def _points_from_sql(s: str) -> list[SPoint]:
+    values = [m.degrees(float(x)) for x in _FLOAT_RE.findall(s)]
+    return [SPoint(ra=ra, dec=dec) for ra, dec in zip(values[::2], values[1::2])]
+
+
+@dataclass
+class SBox:
+    """Coordinate-aligned box; wraps through RA = 0 when sw.ra > ne.ra."""
+
+    sw: SPoint
+    ne: SPoint
+
+    def to_sql(self) -> str:
+        return f"({self.sw.to_sql()}, {self.ne.to_sql()})"
+
+    @staticmethod
+    def from_sql(s: str) -> SBox:
+        sw, ne = _points_from_sql(s)
+        return SBox(sw=sw, ne=ne)
+
+
+@dataclass
+class SPoly:
+    vertices: list[SPoint]
+
+    def to_sql(self) -> str:
+        return "{" + ", ".join(v.to_sql() for v in self.vertices) + "}"
+
+    @staticmethod
+    def from_sql(s: str) -> SPoly:
+        return SPoly(vertices=_points_from_sql(s))
+
+
 async def connection_setup(con: Connection):
     await con.set_type_codec(
         "spoint",
@@ -66,3 +110,15 @@ async def connection_setup(con: Connection):
         decoder=SCircle.from_sql,
         format="text",
     )
+    await con.set_type_codec(
+        "sbox",
+        encoder=SBox.to_sql,
+        decoder=SBox.from_sql,
+        format="text",
+    )
+    await con.set_type_codec(
+        "spoly",
+        encoder=SPoly.to_sql,
+        decoder=SPoly.from_sql,
+        format="text",
+    )
@@ -0,0 +1,228 @@
+"""Route read queries over the primary and its read replicas."""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from asyncpg import Connection, Pool, create_pool
+from asyncpg.exceptions import (
+    CannotConnectNowError,
+    InterfaceError,
+    PostgresConnectionError,
+    PostgresError,
+    TooManyConnectionsError,
+)
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    CannotConnectNowError,
+    InterfaceError,
+    PostgresConnectionError,
+    TooManyConnectionsError,
+)
+
+DEFAULT_PORT = 5432
+
+# Seconds a replica is behind the primary: 0 on the primary, and on a
+# replica that has replayed all it received, as a quiet primary is no lag
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery()
+          OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(
+            extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0
+        )
+    END::float8
+"""
+
+
+def parse_hosts(value: str) -> list[tuple[str, int]]:
+    """Parse a comma-separated list of ``host[:port]`` endpoints."""
+    hosts = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(":")
+        hosts.append((host, int(port) if port else DEFAULT_PORT))
+    return hosts
+
+
+@dataclass
+class Endpoint:
+    host: str
+    port: int
+    pool: Pool | None = None
+    healthy: bool = False
+
+    @property
+    def name(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    @property
+    def in_use(self) -> int:
+        if self.pool is None:
+            return 0
+        return self.pool.get_size() - self.pool.get_idle_size()
+
+
+class PoolRouter:
+    """Load-balanced, health-checked set of asyncpg pools.
+
+    ``acquire()`` hands out a connection from the healthy read endpoint with
+    the fewest connections in use, falling over to the next endpoint when a
+    connection cannot be established. ``primary`` is the pool for
+    ``DB_HOST`` and should be used for anything that writes. A replica more
+    than ``max_lag`` seconds behind counts as unhealthy; 0 disables that.
+    """
+
+    def __init__(
+        self,
+        primary: tuple[str, int],
+        read_hosts: list[tuple[str, int]],
+        check_interval: float = 5.0,
+        connect_timeout: float = 5.0,
+        max_lag: float = 0,
+        **pool_kwargs,
+    ):
+        self._pool_kwargs = pool_kwargs
+        self._check_interval = check_interval
+        self._connect_timeout = connect_timeout
+        self._max_lag = max_lag
+        self._primary = Endpoint(*primary)
+        self.endpoints: list[Endpoint] = []
+        for host, port in read_hosts or [primary]:
+            if (host, port) == primary:
+                self.endpoints.append(self._primary)
+            else:
+                self.endpoints.append(Endpoint(host, port))
+        self._round_robin = itertools.count()
+        self._health_task: asyncio.Task | None = None
+
+    @property
+    def primary(self) -> Pool:
+        if self._primary.pool is None:
+            raise ConnectionError(f"Primary {self._primary.name} is not available")
+        return self._primary.pool
+
+    async def start(self) -> None:
+        """Create the pools and start the background health checks."""
+        endpoints = {id(ep): ep for ep in [self._primary, *self.endpoints]}
+        await asyncio.gather(*(self._check(ep) for ep in endpoints.values()))
+        if self._primary.pool is None:
+            # Nothing works without the primary, so fail startup loudly
+            self._primary.pool = await self._create_pool(self._primary)
+            self._primary.healthy = True
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+        endpoints = {id(ep): ep for ep in [self._primary, *self.endpoints]}
+        await asyncio.gather(
+            *(ep.pool.close() for ep in endpoints.values() if ep.pool is not None)
+        )
+
+    def pools(self) -> list[Pool]:
+        """Pools of all read endpoints that are currently up."""
+        return [ep.pool for ep in self.endpoints if ep.healthy and ep.pool]
+
+    @asynccontextmanager
+    async def acquire(self, timeout: float | None = None) -> AsyncIterator[Connection]:
+        last_error: BaseException | None = None
+        for ep in self._candidates():
+            try:
+                if ep.pool is None:
+                    ep.pool = await self._create_pool(ep)
+                con = await ep.pool.acquire(timeout=timeout)
+            except CONNECTION_ERRORS as e:
+                logger.warning("Read endpoint %s failed: %s", ep.name, e)
+                ep.healthy = False
+                last_error = e
+                continue
+            try:
+                yield con
+            finally:
+                await ep.pool.release(con)
+            return
+        raise ConnectionError("No database endpoint is available") from last_error
+
+    def _candidates(self) -> list[Endpoint]:
+        """Healthy endpoints by load, then the unhealthy ones as a last resort."""
+        start = next(self._round_robin)
+        n = len(self.endpoints)
+        rotated = [self.endpoints[(start + i) % n] for i in range(n)]
+        healthy = sorted((ep for ep in rotated if ep.healthy), key=lambda ep: ep.in_use)
+        return healthy + [ep for ep in rotated if not ep.healthy]
+
+    async def _create_pool(self, ep: Endpoint) -> Pool:
+        return await create_pool(
+            host=ep.host,
+            port=ep.port,
+            timeout=self._connect_timeout,
+            **self._pool_kwargs,
+        )
+
+    async def _check(self, ep: Endpoint) -> None:
+        try:
+            if ep.pool is None:
+                ep.pool = await self._create_pool(ep)
+            async with ep.pool.acquire(timeout=self._connect_timeout) as con:
+                lag = await con.fetchval(LAG_QUERY, timeout=self._connect_timeout)
+        except CONNECTION_ERRORS as e:
+            if ep.healthy or ep.pool is None:
+                logger.warning("Database endpoint %s is down: %s", ep.name, e)
+            ep.healthy = False
+            return
+        except PostgresError:
+            # Such as a rejected role or a missing database, which also take
+            # the endpoint out and must not end the health checks
+            if ep.healthy or ep.pool is None:
+                logger.exception("Health check of %s failed", ep.name)
+            ep.healthy = False
+            return
+        if self._max_lag and lag > self._max_lag:
+            if ep.healthy:
+                logger.warning(
+                    "Database endpoint %s is %.1fs behind the primary", ep.name, lag
+                )
+            ep.healthy = False
+            return
+        if not ep.healthy:
+            logger.info("Database endpoint %s is up", ep.name)
+        ep.healthy = True
+
+    async def _health_loop(self) -> None:
+        endpoints = {id(ep): ep for ep in [self._primary, *self.endpoints]}
+        while True:
+            await asyncio.sleep(self._check_interval)
+            await asyncio.gather(*(self._check(ep) for ep in endpoints.values()))
+
+
+def router_from_env(
+    environ: dict[str, str], setup: Callable | None = None
+) -> PoolRouter:
+    """Build a router from ``DB_HOST``/``DB_READ_HOSTS`` style settings."""
+    (primary,) = parse_hosts(environ.get("DB_HOST", "sql"))
+    read_hosts = parse_hosts(environ.get("DB_READ_HOSTS", ""))
+    return PoolRouter(
+        primary,
+        read_hosts,
+        check_interval=float(environ.get("DB_HEALTH_INTERVAL", "5")),
+        max_lag=float(environ.get("DB_MAX_REPLICATION_LAG", "30")),
+        database=environ.get("DB_NAME", "ztfref"),
+        user=environ.get("DB_USER", "app"),
+        setup=setup,
+    )
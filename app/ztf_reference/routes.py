@@ -1,23 +1,64 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import math
+import shutil
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+from pathlib import Path
+from uuid import UUID, uuid4
+
 from aiohttp.web import (
+    FileResponse,
+    StreamResponse,
     RouteTableDef,
     Request,
     Response,
     json_response,
     HTTPBadRequest,
+    HTTPConflict,
     HTTPNotFound,
+    HTTPRequestEntityTooLarge,
+    HTTPServiceUnavailable,
 )
+from asyncpg.exceptions import DataError
 
-from .pg_sphere import SCircle, SPoint
+from .admission import QueryTimeout
+from .catalog import (
+    CONE_ORDERINGS,
+    FILTER_CODES,
+    MAX_CONE_RESULTS,
+    OUTPUT_COLUMNS,
+    RESULT_COLUMNS,
+    OBJECT_QUERY,
+    OID_SQL,
+    SOURCE_QUERY,
+    cone_query,
+    knn_query,
+    parse_object_id,
+    region_query,
+    select_columns,
+)
+from .coverage import bounding_circle
+from .export import EXPORT_CONTENT_TYPES, STREAMERS
+from .pg_sphere import SBox, SCircle, SPoint, SPoly
+from .shards import Selection, ShardSet
+from .tiles import tile_file
+from .xmatch import INPUT_FORMATS, input_path, job_dir, result_path
 
 routes = RouteTableDef()
 
 MAX_RADIUS_ARCSEC = 60.0
-MAX_CONE_RESULTS = 1000
-
-FILTER_ID_TO_NAME = {"1": "zg", "2": "zr", "3": "zi"}
-FILTER_NAME_TO_ID = {v: k for k, v in FILTER_ID_TO_NAME.items()}
+MAX_KNN_RESULTS = 100
+MAX_RADIUS_PX = 100.0
+MAX_REGION_SIZE_DEG = 1.0
+MAX_REGION_RESULTS = 5000
+MAX_POLYGON_VERTICES = 64
+MAX_UPLOAD_BYTES = 2 * 1024**3
+UPLOAD_CHUNK_BYTES = 1 << 20
+DEFAULT_XMATCH_RADIUS_ARCSEC = 1.5
+TILE_CACHE_SECONDS = 24 * 3600
 
 API_DOCS_HTML = """\
 <!DOCTYPE html>
@@ -81,6 +122,26 @@ API_DOCS_HTML = """\
   <p>Returns a single JSON object with all source fields, or 404 if not found.</p>
 </div>
 
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/multiband</code></p>
+  <p>zg, zr and zi photometry of one star. Sources of the three filters of each quadrant are
+    associated at ingestion when they lie within 1.5&Prime; of each other.</p>
+  <p><strong>Parameters</strong> (either <code>oid</code>, or <code>ra</code> and <code>dec</code>):</p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>oid</code></td><td>string</td><td>Object ID of any member of the association</td></tr>
+    <tr><td><code>ra</code></td><td>float</td><td>Right ascension in degrees</td></tr>
+    <tr><td><code>dec</code></td><td>float</td><td>Declination in degrees</td></tr>
+    <tr><td><code>radius_arcsec</code></td><td>float</td><td>Search radius around <code>ra</code>, <code>dec</code> (0&ndash;60, default 1.5)</td></tr>
+  </table>
+  <p><strong>Example:</strong>
+    <a href="/api/v1/multiband?oid=2021101100000005">/api/v1/multiband?oid=2021101100000005</a></p>
+  <p>Returns the nearest association: its <code>fieldid</code>, <code>ccdid</code>, <code>qid</code>,
+    mean <code>ra</code> and <code>dec</code> (plus <code>separation_arcsec</code> for position lookups),
+    and one object with all source fields per filter under <code>zg</code>, <code>zr</code> and
+    <code>zi</code>, <code>null</code> where the star was not detected. Returns 404 if nothing is found.</p>
+</div>
+
 <div class="endpoint">
   <p><span class="method">GET</span> <code>/api/v1/cone</code></p>
   <p>Spatial cone search around a sky position.</p>
@@ -96,24 +157,215 @@ API_DOCS_HTML = """\
     <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
     <tr><td><code>filter</code></td><td>string</td><td>Restrict to filter: <code>zg</code>, <code>zr</code>, or <code>zi</code></td></tr>
     <tr><td><code>fieldid</code></td><td>int</td><td>Restrict to a specific field ID</td></tr>
+    <tr><td><code>mag_min</code>, <code>mag_max</code></td><td>float</td><td>Range of <code>mag</code></td></tr>
+    <tr><td><code>snr_min</code>, <code>snr_max</code></td><td>float</td><td>Range of <code>snr</code></td></tr>
+    <tr><td><code>chi_max</code></td><td>float</td><td>Upper limit on <code>chi</code></td></tr>
+    <tr><td><code>sharp_min</code>, <code>sharp_max</code></td><td>float</td><td>Range of <code>sharp</code></td></tr>
+    <tr><td><code>flags_exclude</code></td><td>int</td><td>Skip sources with any of these <code>flags</code> bits set</td></tr>
+    <tr><td><code>order</code></td><td>string</td><td><code>distance</code> (default) or <code>mag</code> (brightest first)</td></tr>
+    <tr><td><code>columns</code></td><td>string</td><td>Comma-separated response fields to return, e.g. <code>oid,ra,dec,mag</code></td></tr>
   </table>
   <p><strong>Example:</strong>
     <a href="/api/v1/cone?ra=100.0&amp;dec=40.0&amp;radius_arcsec=10&amp;filter=zr">/api/v1/cone?ra=100.0&amp;dec=40.0&amp;radius_arcsec=10&amp;filter=zr</a></p>
-  <p>Returns a JSON array of matching sources (up to 1000), ordered by distance.</p>
+  <p>Returns a JSON array of matching sources (up to 1000), ordered by distance.
+    Range cuts never match <code>null</code> values.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/knn</code></p>
+  <p>Nearest sources to a sky position, without a search radius.</p>
+  <p><strong>Required parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>ra</code></td><td>float</td><td>Right ascension in degrees</td></tr>
+    <tr><td><code>dec</code></td><td>float</td><td>Declination in degrees</td></tr>
+  </table>
+  <p><strong>Optional parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>k</code></td><td>int</td><td>Number of sources to return (1&ndash;100, default 1)</td></tr>
+    <tr><td><code>filter</code></td><td>string</td><td>Restrict to filter: <code>zg</code>, <code>zr</code>, or <code>zi</code></td></tr>
+    <tr><td><code>fieldid</code></td><td>int</td><td>Restrict to a specific field ID</td></tr>
+  </table>
+  <p>The quality cuts and <code>columns</code> of <code>/api/v1/cone</code> are accepted as well.</p>
+  <p><strong>Example:</strong>
+    <a href="/api/v1/knn?ra=100.0&amp;dec=40.0&amp;k=5">/api/v1/knn?ra=100.0&amp;dec=40.0&amp;k=5</a></p>
+  <p>Returns a JSON array of the <code>k</code> nearest sources, ordered by distance,
+    each with an extra <code>separation_arcsec</code> field.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/pixel</code></p>
+  <p>Nearest sources to a pixel of a quadrant's reference image, e.g. the one under the cursor.</p>
+  <p><strong>Required parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>fieldid</code></td><td>int</td><td>ZTF field ID</td></tr>
+    <tr><td><code>filter</code></td><td>string</td><td><code>zg</code>, <code>zr</code>, or <code>zi</code></td></tr>
+    <tr><td><code>ccdid</code></td><td>int</td><td>CCD ID (1&ndash;16)</td></tr>
+    <tr><td><code>qid</code></td><td>int</td><td>Quadrant ID (1&ndash;4)</td></tr>
+    <tr><td><code>x</code>, <code>y</code></td><td>float</td><td>Pixel position, in the frame of <code>xpos</code> and <code>ypos</code></td></tr>
+    <tr><td><code>radius_px</code></td><td>float</td><td>Search radius in pixels (at most 100)</td></tr>
+  </table>
+  <p><strong>Optional parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>k</code></td><td>int</td><td>Number of sources to return (1&ndash;100, default 1)</td></tr>
+  </table>
+  <p>The quality cuts and <code>columns</code> of <code>/api/v1/cone</code> are accepted as well.</p>
+  <p><strong>Example:</strong>
+    <a href="/api/v1/pixel?fieldid=202&amp;filter=zg&amp;ccdid=10&amp;qid=1&amp;x=120&amp;y=61&amp;radius_px=5">/api/v1/pixel?fieldid=202&amp;filter=zg&amp;ccdid=10&amp;qid=1&amp;x=120&amp;y=61&amp;radius_px=5</a></p>
+  <p>Returns a JSON array of up to <code>k</code> sources within the radius, ordered by
+    distance, each with an extra <code>separation_px</code> field.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/box</code> and <code>/api/v1/polygon</code></p>
+  <p>All sources inside a sky region, e.g. the current viewport, one page at a time.</p>
+  <p><strong>Required parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>ra_min</code>, <code>ra_max</code></td><td>float</td><td><code>/box</code>: RA range in degrees, wrapping through 0 if <code>ra_min &gt; ra_max</code></td></tr>
+    <tr><td><code>dec_min</code>, <code>dec_max</code></td><td>float</td><td><code>/box</code>: Dec range in degrees</td></tr>
+    <tr><td><code>vertices</code></td><td>string</td><td><code>/polygon</code>: <code>ra1,dec1,ra2,dec2,...</code> in degrees, 3&ndash;64 vertices</td></tr>
+  </table>
+  <p>The region may be at most 1&deg; across.</p>
+  <p><strong>Optional parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>limit</code></td><td>int</td><td>Page size (1&ndash;5000, default 5000)</td></tr>
+    <tr><td><code>after</code></td><td>string</td><td>Object ID to continue after; use the <code>next</code> link instead of setting it by hand</td></tr>
+  </table>
+  <p>The <code>filter</code>, <code>fieldid</code>, quality cuts and <code>columns</code> of <code>/api/v1/cone</code> are accepted as well.</p>
+  <p><strong>Example:</strong>
+    <a href="/api/v1/box?ra_min=24.9&amp;ra_max=25.1&amp;dec_min=-29.7&amp;dec_max=-29.5">/api/v1/box?ra_min=24.9&amp;ra_max=25.1&amp;dec_min=-29.7&amp;dec_max=-29.5</a></p>
+  <p>Returns <code>{"sources": [...], "next": url}</code>, ordered by object ID;
+    <code>next</code> is the URL of the following page, or <code>null</code> on the last one.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/export</code></p>
+  <p>Bulk download of every source of one quadrant, streamed as it is read.</p>
+  <p><strong>Required parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>fieldid</code></td><td>int</td><td>ZTF field ID</td></tr>
+    <tr><td><code>filter</code></td><td>string</td><td>Filter name: <code>zg</code>, <code>zr</code>, or <code>zi</code></td></tr>
+    <tr><td><code>ccdid</code></td><td>int</td><td>CCD ID (1&ndash;16)</td></tr>
+    <tr><td><code>qid</code></td><td>int</td><td>Quadrant ID (1&ndash;4)</td></tr>
+  </table>
+  <p><strong>Optional parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>format</code></td><td>string</td><td><code>csv</code> (default), <code>ndjson</code>, or <code>arrow</code> (Arrow IPC stream)</td></tr>
+  </table>
+  <p><strong>Example:</strong>
+    <a href="/api/v1/export?fieldid=202&amp;filter=zg&amp;ccdid=10&amp;qid=1">/api/v1/export?fieldid=202&amp;filter=zg&amp;ccdid=10&amp;qid=1</a></p>
+  <p>Rows carry all response fields, in no particular order. Returns 404 if the quadrant was never ingested.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/tiles/{filter}/Norder{k}/Dir{d}/Npix{p}.tsv</code></p>
+  <p>Precomputed HiPS-style catalogue tiles for zoomed-out display, one tile set per filter.
+    Tile <code>p</code> of order <code>k</code> (HEALPix, nested, orders 3&ndash;7) lists the
+    500 brightest sources of that pixel as tab-separated <code>oid</code>, <code>ra</code>,
+    <code>dec</code>, <code>mag</code> (calibrated, <code>mag + magzp</code>) and <code>sigmag</code>;
+    <code>d</code> is <code>p</code> rounded down to a multiple of 10000.
+    <code>/api/v1/tiles/{filter}/properties</code> describes the tile set.</p>
+  <p><strong>Example:</strong>
+    <a href="/api/v1/tiles/zg/Norder3/Dir0/Npix557.tsv">/api/v1/tiles/zg/Norder3/Dir0/Npix557.tsv</a></p>
+  <p>Tiles are regenerated after each ingestion run and may be cached for a day.
+    Returns 404 for pixels without sources.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/moc</code></p>
+  <p>Sky coverage of the catalog as an IVOA Multi-Order Coverage map in JSON: for each HEALPix
+    order, the nested indices of the cells holding at least one source.</p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>filter</code></td><td>string</td><td>Coverage of one filter (<code>zg</code>,
+      <code>zr</code> or <code>zi</code>) instead of all of them (optional)</td></tr>
+  </table>
+  <p><strong>Example:</strong> <a href="/api/v1/moc?filter=zr">/api/v1/moc?filter=zr</a></p>
+  <p>Cone, box and polygon searches outside the coverage return empty results immediately.
+    Newly ingested sky is covered within a minute. Returns HTTP 503 while the map is loading.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">POST</span> <code>/api/v1/xmatch</code></p>
+  <p>Submit an asynchronous cross-match job. The request body is the table to match;
+    it must have <code>ra</code> and <code>dec</code> columns in degrees.</p>
+  <p><strong>Optional parameters:</strong></p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>format</code></td><td>string</td><td>Body format: <code>csv</code> (default), <code>fits</code>, or <code>parquet</code></td></tr>
+    <tr><td><code>radius_arcsec</code></td><td>float</td><td>Match radius in arcseconds (0&ndash;60, default 1.5)</td></tr>
+    <tr><td><code>filter</code></td><td>string</td><td>Restrict to filter: <code>zg</code>, <code>zr</code>, or <code>zi</code></td></tr>
+  </table>
+  <p><strong>Example:</strong>
+    <code>curl --data-binary @positions.csv "https://ref.ztf.snad.space/api/v1/xmatch?radius_arcsec=2"</code></p>
+  <p>Returns <code>202</code> with the <code>job_id</code>. Poll
+    <code>GET /api/v1/xmatch/{job_id}</code> for its status, then download
+    <code>GET /api/v1/xmatch/{job_id}/result</code> once it is <code>done</code>.
+    The result is a Parquet file with every input row, its <code>row_index</code> in the input,
+    the nearest reference source as <code>ref_*</code> columns (null when nothing matched)
+    and <code>separation_arcsec</code>.
+    Finished and failed jobs, with their results, are deleted after a week.</p>
 </div>
 
 <div class="endpoint">
   <p><span class="method">GET</span> <code>/api/v1/stats</code></p>
-  <p>Approximate row counts: <a href="/api/v1/stats">/api/v1/stats</a>.
-    Returns approximate number of sources and quadrants (based on PostgreSQL catalog statistics, updated by autovacuum).</p>
+  <p>Catalog statistics: <a href="/api/v1/stats">/api/v1/stats</a>.
+    Returns the exact number of sources and quadrants and the calibrated magnitude range
+    (<code>source_count</code>, <code>quadrant_count</code>, <code>mag_min</code>,
+    <code>mag_max</code>), the same per filter under <code>filters</code>, and
+    <code>updated_at</code>, the time of the last ingestion.
+    The figures are maintained by ingestion and may lag it by up to a minute.
+    <code>approximate_source_count</code> and <code>approximate_quadrant_count</code> repeat the
+    counts for older clients.</p>
+  <table>
+    <tr><th>Parameter</th><th>Type</th><th>Description</th></tr>
+    <tr><td><code>fieldid</code></td><td>int</td><td>Statistics of one field instead, with a
+      <code>quadrants</code> list giving for each filter/CCD/quadrant its source count, magnitude
+      range, median <code>sigmag</code> and a <code>region</code> circle
+      (<code>ra</code>, <code>dec</code>, <code>radius_deg</code>) enclosing its sources (optional)</td></tr>
+  </table>
+  <p>Example: <a href="/api/v1/stats?fieldid=202">/api/v1/stats?fieldid=202</a></p>
+  <p>Returns HTTP 404 if the field has not been ingested.</p>
 </div>
 
 <div class="endpoint">
   <p><span class="method">GET</span> <code>/api/v1/health</code></p>
   <p>Health check: <a href="/api/v1/health">/api/v1/health</a>.
-    Returns <code>{"status": "ok"}</code> if the database is reachable.</p>
+    Returns <code>{"status": "ok"}</code> if the database passed its last health check, HTTP 503
+    otherwise.</p>
+</div>
+
+<div class="endpoint">
+  <p><span class="method">GET</span> <code>/api/v1/ready</code></p>
+  <p>Readiness check: <a href="/api/v1/ready">/api/v1/ready</a>.
+    After a restart the service first loads the catalog indexes into the database cache and
+    warms its connections. Until then it returns HTTP 503 with
+    <code>{"status": "warming up"}</code>; afterwards <code>{"status": "ready"}</code> if the
+    database passed its last health check. Load balancers should route traffic by this endpoint.</p>
 </div>
 
+<h2>Busy server</h2>
+<p>
+  Each kind of query (lookups, searches, exports) runs a limited number of requests at a time
+  and queues a limited number of others. Requests that find the queue full, or wait in it too
+  long, are answered at once with HTTP 503; requests may also be limited per client, with
+  HTTP 429 when the limit is exceeded. Both come with a <code>Retry-After</code> header giving
+  the seconds to wait before trying again. Health, readiness, statistics, coverage and tiles
+  are not queued.
+</p>
+<p>
+  Queries also have a time limit per kind; a query running out of it is cancelled and the
+  request gets HTTP 504. An export running out of time after it started streaming is cut
+  short by closing the connection. Queries of requests whose client disconnects are cancelled.
+</p>
+
 <h2>Response fields</h2>
 <table>
   <tr><th>Field</th><th>Type</th><th>Description</th></tr>
@@ -152,53 +404,104 @@ async def index(request: Request) -> Response:
     return Response(text=API_DOCS_HTML, content_type="text/html")
 
 
-RESULT_COLUMNS = (
-    "fieldid",
-    "filter",
-    "ccdid",
-    "qid",
-    "sourceid",
-    "xpos",
-    "ypos",
-    "ra",
-    "dec",
-    "flux",
-    "sigflux",
-    "mag",
-    "sigmag",
-    "snr",
-    "chi",
-    "sharp",
-    "flags",
-    "magzp",
-    "magzp_rms",
-    "magzp_unc",
-    "infobits",
-)
-
-SELECT_COLS = ", ".join(RESULT_COLUMNS)
-
-
-def _row_to_dict(row) -> dict:
+def _row_to_dict(row, columns: tuple[str, ...] = OUTPUT_COLUMNS) -> dict:
     result = {}
-    for col in RESULT_COLUMNS:
+    for col in columns:
         val = row[col]
         if isinstance(val, float) and val != val:
             val = None
         result[col] = val
-    result["oid"] = _build_object_id(
-        row["fieldid"], row["filter"], row["ccdid"], row["qid"], row["sourceid"]
-    )
     return result
 
 
+@asynccontextmanager
+async def _connection(request: Request, gate: str, primary: bool = False):
+    """A read connection, or one to the primary, once the endpoint class
+    ``gate`` admits the request, for as long as its time limit allows (see
+    admission.py)."""
+    pool = request.app["pg_pool"]
+    async with request.app["admission"].enter(gate):
+        async with (pool.primary if primary else pool).acquire() as con:
+            yield con
+
+
+async def _shared_json(
+    request: Request, gate: str, key: tuple, query: str, params: list, render: Callable
+) -> str | None:
+    """Run a read query and serialize ``render(rows)`` as JSON.
+
+    Concurrent requests with the same ``key``, query and parameters share a
+    single database call and its serialized result, and only the one making
+    it waits for admission to ``gate``. ``key`` must capture anything else
+    ``render`` depends on. None stands for a None result.
+    """
+
+    async def run() -> str | None:
+        async with _connection(request, gate) as con:
+            rows = await con.fetch(query, *params)
+        result = render(rows)
+        return None if result is None else json.dumps(result)
+
+    params_key = tuple(p.to_sql() if hasattr(p, "to_sql") else p for p in params)
+    return await request.app["single_flight"].do((*key, query, params_key), run)
+
+
+def _json_body(body: str) -> Response:
+    return Response(text=body, content_type="application/json")
+
+
+def _first_row_to_dict(rows) -> dict | None:
+    return _row_to_dict(rows[0]) if rows else None
+
+
+def _check_database(request: Request) -> None:
+    # From the router's background health checks, so that probes are
+    # answered without queueing for a connection behind busy requests
+    if not request.app["pg_pool"].pools():
+        raise HTTPServiceUnavailable(reason="No database endpoint is available")
+
+
 @routes.get("/api/v1/health")
 async def health(request: Request) -> Response:
-    async with request.app["pg_pool"].acquire() as con:
-        await con.fetchval("SELECT 1")
+    _check_database(request)
     return json_response({"status": "ok"})
 
 
+@routes.get("/api/v1/ready")
+async def ready(request: Request) -> Response:
+    warmup = request.app.get("warmup")
+    if warmup is None or not warmup.done():
+        return json_response({"status": "warming up"}, status=503)
+    _check_database(request)
+    return json_response({"status": "ready"})
+
+
+def _shard_set(request: Request) -> ShardSet | None:
+    """The search shards matching the database, if they are enabled."""
+    store = request.app["shards"]
+    return None if store is None else store.get()
+
+
+async def _source_response(
+    request: Request, key: tuple[int, str, int, int, int], query: str, params: list
+) -> Response:
+    """The source with ``key`` from the shards, else from the database by
+    ``query``."""
+    shards = _shard_set(request)
+    rows = None if shards is None else await asyncio.to_thread(shards.source, *key)
+    if rows is not None:
+        result = _first_row_to_dict(rows)
+        body = None if result is None else json.dumps(result)
+    else:
+        body = await _shared_json(
+            request, "lookup", ("source",), query, params, _first_row_to_dict
+        )
+    if body is None:
+        raise HTTPNotFound(reason="Source not found")
+
+    return _json_body(body)
+
+
 @routes.get("/api/v1/source")
 async def source(request: Request) -> Response:
     try:
@@ -215,50 +518,9 @@ async def source(request: Request) -> Response:
     if filt not in ("zg", "zr", "zi"):
         raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
 
-    async with request.app["pg_pool"].acquire() as con:
-        row = await con.fetchrow(
-            f"""
-            SELECT {SELECT_COLS}
-            FROM refpsfcat_full
-            WHERE fieldid = $1 AND filter = $2 AND ccdid = $3 AND qid = $4 AND sourceid = $5
-            """,
-            fieldid,
-            filt,
-            ccdid,
-            qid,
-            sourceid,
-        )
-
-    if row is None:
-        raise HTTPNotFound(reason="Source not found")
-
-    return json_response(_row_to_dict(row))
-
-
-def _parse_object_id(oid: str) -> tuple[int, str, int, int, int]:
-    """Parse ZTF DR object ID into (fieldid, filter, ccdid, qid, sourceid).
-
-    Format: {fieldid}{filter_id}{ccdid:02}{qid}{sourceid:08d}
-    The last 12 characters are fixed-width; fieldid is variable-length.
-    """
-    if len(oid) < 13 or not oid.isdigit():
-        raise ValueError(f"Invalid object ID: {oid!r}")
-    fieldid = int(oid[:-12])
-    filter_id = oid[-12]
-    if filter_id not in FILTER_ID_TO_NAME:
-        raise ValueError(f"Invalid filter ID in object ID: {filter_id}")
-    filt = FILTER_ID_TO_NAME[filter_id]
-    ccdid = int(oid[-11:-9])
-    qid = int(oid[-9])
-    sourceid = int(oid[-8:])
-    return fieldid, filt, ccdid, qid, sourceid
-
-
-def _build_object_id(
-    fieldid: int, filt: str, ccdid: int, qid: int, sourceid: int
-) -> str:
-    """Build ZTF DR object ID from components."""
-    return f"{fieldid}{FILTER_NAME_TO_ID[filt]}{ccdid:02d}{qid}{sourceid:08d}"
+    key = (fieldid, filt, ccdid, qid, sourceid)
+    params = [fieldid, FILTER_CODES[filt], ccdid, qid, sourceid]
+    return await _source_response(request, key, SOURCE_QUERY, params)
 
 
 @routes.get("/api/v1/object")
@@ -269,49 +531,224 @@ async def object_lookup(request: Request) -> Response:
         raise HTTPBadRequest(reason='Missing required parameter: "oid"')
 
     try:
-        fieldid, filt, ccdid, qid, sourceid = _parse_object_id(oid)
+        key = parse_object_id(oid)
     except ValueError as e:
         raise HTTPBadRequest(reason=str(e))
 
-    async with request.app["pg_pool"].acquire() as con:
-        row = await con.fetchrow(
-            f"""
-            SELECT {SELECT_COLS}
-            FROM refpsfcat_full
-            WHERE fieldid = $1 AND filter = $2 AND ccdid = $3 AND qid = $4 AND sourceid = $5
-            """,
-            fieldid,
-            filt,
-            ccdid,
-            qid,
-            sourceid,
-        )
+    return await _source_response(request, key, OBJECT_QUERY, [int(oid)])
 
-    if row is None:
+
+BANDS = ("zg", "zr", "zi")
+
+# Sources of one association, each fetched by primary key
+MULTIBAND_QUERY = f"""
+    WITH a AS ({{association}})
+    SELECT a.ra AS assoc_ra, a.dec AS assoc_dec, a.separation_arcsec,
+           {", ".join(f"s.{col}" for col in RESULT_COLUMNS)}, s.{OID_SQL} AS oid
+    FROM a
+    CROSS JOIN LATERAL (
+        VALUES (1, a.zg_sourceid), (2, a.zr_sourceid), (3, a.zi_sourceid)
+    ) AS m(filterid, sourceid)
+    JOIN refpsfcat_full s
+      ON s.fieldid = a.fieldid AND s.filterid = m.filterid AND s.ccdid = a.ccdid
+         AND s.qid = a.qid AND s.sourceid = m.sourceid
+"""
+
+
+@routes.get("/api/v1/multiband")
+async def multiband(request: Request) -> Response:
+    if "oid" in request.query:
+        try:
+            fieldid, filt, ccdid, qid, sourceid = parse_object_id(request.query["oid"])
+        except ValueError as e:
+            raise HTTPBadRequest(reason=str(e))
+        # filt is one of BANDS, so the column name is safe to interpolate
+        association = f"""
+            SELECT *, NULL::double precision AS separation_arcsec
+            FROM band_association
+            WHERE fieldid = $1 AND ccdid = $2 AND qid = $3 AND {filt}_sourceid = $4
+        """
+        params: list = [fieldid, ccdid, qid, sourceid]
+    else:
+        try:
+            ra = float(request.query["ra"])
+            dec = float(request.query["dec"])
+        except KeyError:
+            raise HTTPBadRequest(
+                reason='Either "oid" or both "ra" and "dec" must be specified'
+            )
+        except ValueError:
+            raise HTTPBadRequest(reason='"ra" and "dec" must be floats')
+        try:
+            radius_arcsec = float(
+                request.query.get("radius_arcsec", DEFAULT_XMATCH_RADIUS_ARCSEC)
+            )
+        except ValueError:
+            raise HTTPBadRequest(reason='"radius_arcsec" must be a float')
+        if radius_arcsec <= 0 or radius_arcsec > MAX_RADIUS_ARCSEC:
+            raise HTTPBadRequest(
+                reason=f'"radius_arcsec" must be positive and at most {MAX_RADIUS_ARCSEC}'
+            )
+        association = """
+            SELECT *, degrees(coord <-> $1::spoint) * 3600.0 AS separation_arcsec
+            FROM band_association
+            WHERE coord <@ $2::scircle
+            ORDER BY coord <-> $1::spoint
+            LIMIT 1
+        """
+        point = SPoint(ra=ra, dec=dec)
+        params = [point, SCircle(point=point, radius_arcsec=radius_arcsec)]
+
+    async with _connection(request, "lookup") as con:
+        rows = await con.fetch(MULTIBAND_QUERY.format(association=association), *params)
+
+    if not rows:
         raise HTTPNotFound(reason="Source not found")
 
-    return json_response(_row_to_dict(row))
+    first = rows[0]
+    result = {
+        "fieldid": first["fieldid"],
+        "ccdid": first["ccdid"],
+        "qid": first["qid"],
+        "ra": first["assoc_ra"],
+        "dec": first["assoc_dec"],
+    }
+    if first["separation_arcsec"] is not None:
+        result["separation_arcsec"] = first["separation_arcsec"]
+    by_band = {row["filter"]: _row_to_dict(row) for row in rows}
+    for band in BANDS:
+        result[band] = by_band.get(band)
+    return json_response(result)
 
 
 @routes.get("/api/v1/stats")
 async def stats(request: Request) -> Response:
-    async with request.app["pg_pool"].acquire() as con:
-        rows = await con.fetch(
-            """
-            SELECT relname, reltuples::bigint AS approximate_row_count
-            FROM pg_class
-            WHERE relname IN ('refpsfcat', 'quadrant')
-            """
+    cached = await request.app["stats"].get(request.app["pg_pool"])
+
+    if "fieldid" not in request.query:
+        summary = cached.summary
+        return json_response(
+            {
+                **summary,
+                # Kept for existing clients, the counts are now exact
+                "approximate_source_count": summary["source_count"],
+                "approximate_quadrant_count": summary["quadrant_count"],
+            }
         )
-    counts = {row["relname"]: row["approximate_row_count"] for row in rows}
-    return json_response(
-        {
-            "approximate_source_count": counts.get("refpsfcat", 0),
-            "approximate_quadrant_count": counts.get("quadrant", 0),
-        }
+
+    try:
+        fieldid = int(request.query["fieldid"])
+    except ValueError:
+        raise HTTPBadRequest(reason='"fieldid" must be an integer')
+    try:
+        return json_response(cached.fields[fieldid])
+    except KeyError:
+        raise HTTPNotFound(reason="Field not found")
+
+
+def _filter_conditions(request: Request, params: list) -> list[str]:
+    """Parse the optional filter/fieldid constraints into SQL conditions."""
+    conditions = []
+
+    filt = request.query.get("filter")
+    if filt is not None:
+        if filt not in ("zg", "zr", "zi"):
+            raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
+        params.append(FILTER_CODES[filt])
+        conditions.append(f"filterid = ${len(params)}")
+
+    fieldid = request.query.get("fieldid")
+    if fieldid is not None:
+        try:
+            fieldid = int(fieldid)
+        except ValueError:
+            raise HTTPBadRequest(reason="fieldid must be an integer")
+        params.append(fieldid)
+        conditions.append(f"fieldid = ${len(params)}")
+
+    return conditions
+
+
+# Optional query parameters for quality cuts: (column, comparison)
+RANGE_FILTERS = {
+    "mag_min": ("mag", ">="),
+    "mag_max": ("mag", "<="),
+    "snr_min": ("snr", ">="),
+    "snr_max": ("snr", "<="),
+    "chi_max": ("chi", "<="),
+    "sharp_min": ("sharp", ">="),
+    "sharp_max": ("sharp", "<="),
+}
+
+
+def _quality_conditions(request: Request, params: list) -> list[str]:
+    """Parse the optional magnitude/SNR/shape cuts into SQL conditions."""
+    conditions = []
+
+    for name, (col, op) in RANGE_FILTERS.items():
+        value = request.query.get(name)
+        if value is None:
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            raise HTTPBadRequest(reason=f'"{name}" must be a float')
+        params.append(value)
+        # NaN sorts above every number in PostgreSQL, so exclude it explicitly
+        conditions.append(f"{col} {op} ${len(params)} AND {col} <> 'NaN'")
+
+    flags_exclude = request.query.get("flags_exclude")
+    if flags_exclude is not None:
+        try:
+            flags_exclude = int(flags_exclude)
+        except ValueError:
+            raise HTTPBadRequest(reason='"flags_exclude" must be an integer')
+        if not 0 <= flags_exclude <= 0x7FFF:
+            raise HTTPBadRequest(reason='"flags_exclude" must be between 0 and 32767')
+        params.append(flags_exclude)
+        conditions.append(f"flags & ${len(params)} = 0")
+
+    return conditions
+
+
+def _selection(request: Request) -> Selection:
+    """The constraints of ``_filter_conditions`` and ``_quality_conditions``,
+    for the search shards; those have validated the query already."""
+    query = request.query
+    return Selection(
+        filter=query.get("filter"),
+        fieldid=int(query["fieldid"]) if "fieldid" in query else None,
+        cuts=[
+            (col, op, float(query[name]))
+            for name, (col, op) in RANGE_FILTERS.items()
+            if name in query
+        ],
+        flags_exclude=(
+            int(query["flags_exclude"]) if "flags_exclude" in query else None
+        ),
     )
 
 
+def _parse_columns(request: Request) -> tuple[str, ...]:
+    value = request.query.get("columns")
+    if value is None:
+        return OUTPUT_COLUMNS
+    requested = {col.strip() for col in value.split(",") if col.strip()}
+    unknown = requested - set(OUTPUT_COLUMNS)
+    if not requested or unknown:
+        raise HTTPBadRequest(
+            reason=f"columns must be a comma-separated subset of: {', '.join(OUTPUT_COLUMNS)}"
+        )
+    return tuple(col for col in OUTPUT_COLUMNS if col in requested)
+
+
+def _outside_coverage(request: Request, center: SPoint, radius_deg: float) -> bool:
+    """Whether the coverage map rules out sources of the requested filter
+    within the circle; False while the map is not available."""
+    coverage = request.app["coverage"].get(request.query.get("filter"))
+    return coverage is not None and not coverage.overlaps(center, radius_deg)
+
+
 @routes.get("/api/v1/cone")
 async def cone(request: Request) -> Response:
     try:
@@ -330,37 +767,530 @@ async def cone(request: Request) -> Response:
             reason=f'"radius_arcsec" must be positive and at most {MAX_RADIUS_ARCSEC}'
         )
 
+    order = request.query.get("order", "distance")
+    if order not in CONE_ORDERINGS:
+        raise HTTPBadRequest(
+            reason=f"order must be one of {', '.join(map(repr, CONE_ORDERINGS))}"
+        )
+
+    columns = _parse_columns(request)
     circle = SCircle(point=SPoint(ra=ra, dec=dec), radius_arcsec=radius_arcsec)
 
     params: list = [circle]
-    where_extra = ""
+    conditions = [
+        *_filter_conditions(request, params),
+        *_quality_conditions(request, params),
+    ]
+
+    if _outside_coverage(request, circle.point, radius_arcsec / 3600.0):
+        return json_response([])
+
+    def render(rows) -> list[dict]:
+        return [_row_to_dict(row, columns) for row in rows]
+
+    shards = _shard_set(request)
+    if shards is not None:
+        rows = await asyncio.to_thread(
+            shards.cone,
+            circle.point,
+            radius_arcsec / 3600.0,
+            _selection(request),
+            order,
+            MAX_CONE_RESULTS,
+        )
+        if rows is not None:
+            return json_response(render(rows))
+
+    body = await _shared_json(
+        request,
+        "search",
+        ("cone", columns),
+        cone_query(columns, conditions, order),
+        params,
+        render,
+    )
+    return _json_body(body)
+
+
+def _parse_k(request: Request) -> int:
+    try:
+        k = int(request.query.get("k", 1))
+    except ValueError:
+        raise HTTPBadRequest(reason='"k" must be an integer')
+    if k <= 0 or k > MAX_KNN_RESULTS:
+        raise HTTPBadRequest(
+            reason=f'"k" must be positive and at most {MAX_KNN_RESULTS}'
+        )
+    return k
+
+
+@routes.get("/api/v1/knn")
+async def knn(request: Request) -> Response:
+    try:
+        ra = float(request.query["ra"])
+        dec = float(request.query["dec"])
+    except KeyError:
+        raise HTTPBadRequest(reason='Both "ra" and "dec" must be specified')
+    except ValueError:
+        raise HTTPBadRequest(reason='"ra" and "dec" must be floats')
+
+    k = _parse_k(request)
+    columns = _parse_columns(request)
+    params: list = [SPoint(ra=ra, dec=dec), k]
+    conditions = [
+        *_filter_conditions(request, params),
+        *_quality_conditions(request, params),
+    ]
+
+    # Unbounded search, so only a filter without any sources is skipped
+    coverage = request.app["coverage"].get(request.query.get("filter"))
+    if coverage is not None and coverage.is_empty():
+        return json_response([])
+
+    def render(rows) -> list[dict]:
+        return [
+            {
+                **_row_to_dict(row, columns),
+                "separation_arcsec": row["separation_arcsec"],
+            }
+            for row in rows
+        ]
+
+    shards = _shard_set(request)
+    if shards is not None:
+        rows = await asyncio.to_thread(
+            shards.knn, SPoint(ra=ra, dec=dec), k, _selection(request)
+        )
+        if rows is not None:
+            return json_response(render(rows))
+
+    body = await _shared_json(
+        request,
+        "search",
+        ("knn", columns),
+        knn_query(columns, conditions),
+        params,
+        render,
+    )
+    return _json_body(body)
+
+
+@routes.get("/api/v1/pixel")
+async def pixel(request: Request) -> Response:
+    try:
+        fieldid = int(request.query["fieldid"])
+        filt = request.query["filter"]
+        ccdid = int(request.query["ccdid"])
+        qid = int(request.query["qid"])
+        x = float(request.query["x"])
+        y = float(request.query["y"])
+        radius_px = float(request.query["radius_px"])
+    except KeyError as e:
+        raise HTTPBadRequest(reason=f"Missing required parameter: {e}")
+    except ValueError as e:
+        raise HTTPBadRequest(reason=f"Invalid parameter value: {e}")
+
+    if filt not in BANDS:
+        raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise HTTPBadRequest(reason='"x" and "y" must be finite')
+    if not 0 < radius_px <= MAX_RADIUS_PX:
+        raise HTTPBadRequest(
+            reason=f'"radius_px" must be positive and at most {MAX_RADIUS_PX:g}'
+        )
+
+    k = _parse_k(request)
+    columns = _parse_columns(request)
+    params: list = [fieldid, FILTER_CODES[filt], ccdid, qid, x, y, radius_px, k]
+    conditions = [
+        "fieldid = $1 AND filterid = $2 AND ccdid = $3 AND qid = $4",
+        "point(xpos, ypos) <@ circle(point($5, $6), $7)",
+        *_quality_conditions(request, params),
+    ]
+
+    def render(rows) -> list[dict]:
+        return [
+            {**_row_to_dict(row, columns), "separation_px": row["separation_px"]}
+            for row in rows
+        ]
+
+    # idx_refpsfcat_pixel holds the quadrant key and pixel position of every
+    # source, so this is a single nearest-first scan of the quadrant's entries
+    body = await _shared_json(
+        request,
+        "lookup",
+        ("pixel", columns),
+        f"""
+        SELECT {select_columns(columns)},
+               point(xpos, ypos) <-> point($5, $6) AS separation_px
+        FROM refpsfcat_full
+        WHERE {" AND ".join(conditions)}
+        ORDER BY point(xpos, ypos) <-> point($5, $6)
+        LIMIT $8
+        """,
+        params,
+        render,
+    )
+    return _json_body(body)
+
+
+def _page_conditions(request: Request, params: list) -> list[str]:
+    """Keyset pagination: continue after the object ID given as "after"."""
+    after = request.query.get("after")
+    if after is None:
+        return []
+    try:
+        parse_object_id(after)
+    except ValueError as e:
+        raise HTTPBadRequest(reason=str(e))
+    # The numeric object ID sorts like the key
+    params.append(int(after))
+    return [f"oid > ${len(params)}"]
+
+
+async def _region_search(
+    request: Request, region_condition: str, params: list, corners: list[SPoint]
+) -> Response:
+    try:
+        limit = int(request.query.get("limit", MAX_REGION_RESULTS))
+    except ValueError:
+        raise HTTPBadRequest(reason='"limit" must be an integer')
+    if limit <= 0 or limit > MAX_REGION_RESULTS:
+        raise HTTPBadRequest(
+            reason=f'"limit" must be positive and at most {MAX_REGION_RESULTS}'
+        )
+
+    columns = _parse_columns(request)
+    conditions = [
+        region_condition,
+        *_filter_conditions(request, params),
+        *_quality_conditions(request, params),
+        *_page_conditions(request, params),
+    ]
+
+    if _outside_coverage(request, *bounding_circle(corners)):
+        return json_response({"sources": [], "next": None})
+
+    # Ordered by the numeric oid, which "after" compares with, not by the
+    # text one in the output: "1023..." sorts before "245..." as text
+    try:
+        async with _connection(request, "search") as con:
+            rows = await con.fetch(
+                region_query((*columns, "oid"), conditions, limit + 1), *params
+            )
+    except DataError as e:
+        raise HTTPBadRequest(reason=f"Invalid region: {e}")
+
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_url = str(request.rel_url.update_query(after=rows[-1]["oid"]))
+
+    return json_response(
+        {"sources": [_row_to_dict(row, columns) for row in rows], "next": next_url}
+    )
+
+
+@routes.get("/api/v1/box")
+async def box(request: Request) -> Response:
+    try:
+        ra_min = float(request.query["ra_min"])
+        ra_max = float(request.query["ra_max"])
+        dec_min = float(request.query["dec_min"])
+        dec_max = float(request.query["dec_max"])
+    except KeyError:
+        raise HTTPBadRequest(
+            reason='All of "ra_min", "ra_max", "dec_min" and "dec_max" must be specified'
+        )
+    except ValueError:
+        raise HTTPBadRequest(
+            reason='"ra_min", "ra_max", "dec_min" and "dec_max" must be floats'
+        )
+
+    if not all(map(math.isfinite, (ra_min, ra_max, dec_min, dec_max))):
+        raise HTTPBadRequest(
+            reason='"ra_min", "ra_max", "dec_min" and "dec_max" must be finite'
+        )
+    ra_min %= 360.0
+    ra_max %= 360.0
+    if not -90.0 <= dec_min < dec_max <= 90.0:
+        raise HTTPBadRequest(reason='"dec_min" must be less than "dec_max"')
+    ra_span = (ra_max - ra_min) % 360.0
+    if ra_span == 0.0:
+        raise HTTPBadRequest(reason='"ra_min" and "ra_max" must differ')
+    # Width along the widest parallel of the box
+    widest_dec = 0.0 if dec_min < 0.0 < dec_max else min(abs(dec_min), abs(dec_max))
+    width = ra_span * math.cos(math.radians(widest_dec))
+    if width > MAX_REGION_SIZE_DEG or dec_max - dec_min > MAX_REGION_SIZE_DEG:
+        raise HTTPBadRequest(
+            reason=f"The box must be at most {MAX_REGION_SIZE_DEG} degrees across"
+        )
 
+    region = SBox(sw=SPoint(ra=ra_min, dec=dec_min), ne=SPoint(ra=ra_max, dec=dec_max))
+    corners = [
+        region.sw,
+        SPoint(ra=ra_max, dec=dec_min),
+        region.ne,
+        SPoint(ra=ra_min, dec=dec_max),
+    ]
+    return await _region_search(request, "coord <@ $1::sbox", [region], corners)
+
+
+@routes.get("/api/v1/polygon")
+async def polygon(request: Request) -> Response:
+    try:
+        values = [float(x) for x in request.query["vertices"].split(",")]
+    except KeyError:
+        raise HTTPBadRequest(reason='Missing required parameter: "vertices"')
+    except ValueError:
+        raise HTTPBadRequest(reason='"vertices" must be comma-separated floats')
+
+    if len(values) % 2:
+        raise HTTPBadRequest(reason='"vertices" must be pairs of ra,dec')
+    if not all(map(math.isfinite, values)):
+        raise HTTPBadRequest(reason='"vertices" must be finite')
+    vertices = [SPoint(ra=ra, dec=dec) for ra, dec in zip(values[::2], values[1::2])]
+    if not 3 <= len(vertices) <= MAX_POLYGON_VERTICES:
+        raise HTTPBadRequest(
+            reason=f"The polygon must have between 3 and {MAX_POLYGON_VERTICES} vertices"
+        )
+    if any(not -90.0 <= v.dec <= 90.0 for v in vertices):
+        raise HTTPBadRequest(reason="Vertex declinations must be within [-90, 90]")
+    # Diagonal of the largest box allowed by /api/v1/box
+    max_diameter = MAX_REGION_SIZE_DEG * math.sqrt(2.0)
+    if any(a.separation(b) > max_diameter for a in vertices for b in vertices):
+        raise HTTPBadRequest(
+            reason=f"The polygon must be at most {max_diameter:.2f} degrees across"
+        )
+
+    return await _region_search(
+        request, "coord <@ $1::spoly", [SPoly(vertices=vertices)], vertices
+    )
+
+
+@routes.get("/api/v1/moc")
+async def moc(request: Request) -> Response:
     filt = request.query.get("filter")
-    if filt is not None:
-        if filt not in ("zg", "zr", "zi"):
-            raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
-        params.append(filt)
-        where_extra += f" AND filter = ${len(params)}"
+    if filt is not None and filt not in BANDS:
+        raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
+    coverage = request.app["coverage"].get(filt)
+    if coverage is None:
+        raise HTTPServiceUnavailable(reason="The coverage map is not available yet")
+    return json_response(coverage.to_moc())
 
-    fieldid = request.query.get("fieldid")
-    if fieldid is not None:
-        try:
-            fieldid = int(fieldid)
-        except ValueError:
-            raise HTTPBadRequest(reason="fieldid must be an integer")
-        params.append(fieldid)
-        where_extra += f" AND fieldid = ${len(params)}"
-
-    async with request.app["pg_pool"].acquire() as con:
-        rows = await con.fetch(
-            f"""
-            SELECT {SELECT_COLS}
-            FROM refpsfcat_full
-            WHERE coord <@ $1::scircle{where_extra}
-            ORDER BY coord <-> $1::scircle
-            LIMIT {MAX_CONE_RESULTS}
-            """,
-            *params,
+
+@routes.get("/api/v1/export")
+async def export(request: Request) -> StreamResponse:
+    try:
+        fieldid = int(request.query["fieldid"])
+        filt = request.query["filter"]
+        ccdid = int(request.query["ccdid"])
+        qid = int(request.query["qid"])
+    except KeyError as e:
+        raise HTTPBadRequest(reason=f"Missing required parameter: {e}")
+    except ValueError as e:
+        raise HTTPBadRequest(reason=f"Invalid parameter value: {e}")
+
+    if filt not in ("zg", "zr", "zi"):
+        raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
+
+    fmt = request.query.get("format", "csv")
+    if fmt not in STREAMERS:
+        raise HTTPBadRequest(
+            reason=f"format must be one of {', '.join(map(repr, STREAMERS))}"
         )
 
-    return json_response([_row_to_dict(row) for row in rows])
+    key = (fieldid, FILTER_CODES[filt], ccdid, qid)
+    response = StreamResponse(
+        headers={
+            "Content-Type": EXPORT_CONTENT_TYPES[fmt],
+            "Content-Disposition": (
+                f'attachment; filename="ztf_{fieldid:06d}_{filt}'
+                f'_c{ccdid:02d}_q{qid}_refpsfcat.{fmt}"'
+            ),
+        }
+    )
+    try:
+        async with _connection(request, "export") as con:
+            exists = await con.fetchval(
+                """
+                SELECT EXISTS (
+                    SELECT 1 FROM quadrant
+                    WHERE fieldid = $1 AND filterid = $2 AND ccdid = $3 AND qid = $4
+                )
+                """,
+                *key,
+            )
+            if not exists:
+                raise HTTPNotFound(reason="Quadrant not found")
+
+            await response.prepare(request)
+            await STREAMERS[fmt](con, response, key)
+    except QueryTimeout:
+        if not response.prepared:
+            raise
+        # Too late for a 504: drop the connection so that the client sees
+        # the download was cut short rather than a complete file
+        if request.transport is not None:
+            request.transport.close()
+        return response
+
+    await response.write_eof()
+    return response
+
+
+@routes.get(
+    r"/api/v1/tiles/{filter:z[gri]}/Norder{order:\d+}/Dir{dir:\d+}/Npix{npix:\d+}.tsv"
+)
+async def tile(request: Request) -> Response:
+    info = request.match_info
+    npix = int(info["npix"])
+    if int(info["dir"]) != npix // 10000 * 10000:
+        raise HTTPNotFound(reason="Tile not found")
+    return _tile_response(
+        tile_file(info["filter"], int(info["order"]), npix),
+        "text/tab-separated-values",
+    )
+
+
+@routes.get("/api/v1/tiles/{filter:z[gri]}/properties")
+async def tile_properties(request: Request) -> Response:
+    return _tile_response(tile_file(request.match_info["filter"]), "text/plain")
+
+
+def _tile_response(path, content_type: str) -> Response:
+    if not path.is_file():
+        raise HTTPNotFound(reason="Tile not found")
+    return FileResponse(
+        path,
+        headers={
+            "Content-Type": content_type,
+            "Cache-Control": f"public, max-age={TILE_CACHE_SECONDS}",
+        },
+    )
+
+
+def _job_to_dict(job) -> dict:
+    result = {
+        "job_id": str(job["job_id"]),
+        "status": job["status"],
+        "format": job["format"],
+        "radius_arcsec": job["radius_arcsec"],
+        "filter": job["filter"],
+        "n_rows": job["n_rows"],
+        "n_processed": job["n_processed"],
+        "n_matched": job["n_matched"],
+        "error": job["error"],
+    }
+    for col in ("created_at", "started_at", "finished_at"):
+        result[col] = job[col].isoformat() if job[col] is not None else None
+    if job["status"] == "done":
+        result["result"] = f"/api/v1/xmatch/{job['job_id']}/result"
+    return result
+
+
+async def _save_upload(request: Request, path: Path) -> None:
+    """Write the request body to ``path``, with the disk writes in the
+    executor so that a slow disk does not hold up the event loop."""
+    loop = asyncio.get_running_loop()
+    size = 0
+    f = await loop.run_in_executor(None, path.open, "wb")
+    try:
+        async for chunk in request.content.iter_chunked(UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPRequestEntityTooLarge(
+                    max_size=MAX_UPLOAD_BYTES, actual_size=size
+                )
+            await loop.run_in_executor(None, f.write, chunk)
+    finally:
+        f.close()
+    if size == 0:
+        raise HTTPBadRequest(reason="Request body must contain the input table")
+
+
+@routes.post("/api/v1/xmatch")
+async def xmatch_submit(request: Request) -> Response:
+    fmt = request.query.get("format", "csv")
+    if fmt not in INPUT_FORMATS:
+        raise HTTPBadRequest(
+            reason=f"format must be one of {', '.join(map(repr, INPUT_FORMATS))}"
+        )
+
+    try:
+        radius_arcsec = float(
+            request.query.get("radius_arcsec", DEFAULT_XMATCH_RADIUS_ARCSEC)
+        )
+    except ValueError:
+        raise HTTPBadRequest(reason='"radius_arcsec" must be a float')
+    if radius_arcsec <= 0 or radius_arcsec > MAX_RADIUS_ARCSEC:
+        raise HTTPBadRequest(
+            reason=f'"radius_arcsec" must be positive and at most {MAX_RADIUS_ARCSEC}'
+        )
+
+    filt = request.query.get("filter")
+    if filt is not None and filt not in ("zg", "zr", "zi"):
+        raise HTTPBadRequest(reason='filter must be one of "zg", "zr", "zi"')
+
+    job_id = uuid4()
+    path = input_path(job_id, fmt)
+    path.parent.mkdir(parents=True)
+    try:
+        await _save_upload(request, path)
+        async with _connection(request, "lookup", primary=True) as con:
+            job = await con.fetchrow(
+                """
+                INSERT INTO xmatch_job (job_id, format, radius_arcsec, filter)
+                VALUES ($1, $2, $3, $4)
+                RETURNING *
+                """,
+                job_id,
+                fmt,
+                radius_arcsec,
+                filt,
+            )
+    except BaseException:
+        # No job refers to the upload
+        shutil.rmtree(job_dir(job_id), ignore_errors=True)
+        raise
+
+    return json_response(
+        _job_to_dict(job),
+        status=202,
+        headers={"Location": f"/api/v1/xmatch/{job_id}"},
+    )
+
+
+async def _fetch_job(request: Request):
+    try:
+        job_id = UUID(request.match_info["job_id"])
+    except ValueError:
+        raise HTTPBadRequest(reason="Invalid job ID")
+
+    # Job state changes on the primary, replicas may lag behind it
+    async with _connection(request, "lookup", primary=True) as con:
+        job = await con.fetchrow("SELECT * FROM xmatch_job WHERE job_id = $1", job_id)
+
+    if job is None:
+        raise HTTPNotFound(reason="Job not found")
+    return job
+
+
+@routes.get("/api/v1/xmatch/{job_id}")
+async def xmatch_status(request: Request) -> Response:
+    job = await _fetch_job(request)
+    return json_response(_job_to_dict(job))
+
+
+@routes.get("/api/v1/xmatch/{job_id}/result")
+async def xmatch_result(request: Request) -> Response:
+    job = await _fetch_job(request)
+    if job["status"] != "done":
+        raise HTTPConflict(reason=f"Job is {job['status']}")
+    return FileResponse(
+        result_path(job["job_id"]),
+        headers={
+            "Content-Type": "application/vnd.apache.parquet",
+            "Content-Disposition": f'attachment; filename="xmatch-{job["job_id"]}.parquet"',
+        },
+    )
@@ -0,0 +1,359 @@
+"""Cone, kNN and object lookups from memory-mapped catalog shards.
+
+Ingest can write each field/filter of the catalog as a shard of NumPy
+files (see shards.py of the ingest package) with the sources sorted by
+HEALPix index. The shards are mapped read-only, so searches read them
+through the OS page cache, without a database connection. A search picks
+the shards with sources near its region, binary searches the runs of rows
+in the region's pixels and checks the exact distances. Handlers run
+searches in a thread: reading the mapped files faults pages in from disk,
+which would otherwise block the event loop.
+
+The database stays the source of truth. A shard is used only while its
+version is the one the database has for its field/filter, and a search
+over a filter only while every field of the filter has its current shard
+loaded; otherwise the lookup returns None and the handler queries the
+database as usual. The versions are checked every SHARDS_REFRESH_INTERVAL
+seconds, which bounds how long a shard is used after its field changed.
+
+Enabled by setting SHARDS_DIR to the directory ingest writes them to.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+from aiohttp.web import Application
+from astropy_healpix import HEALPix
+
+from .catalog import FILTER_CODES, GENERATION_QUERY, object_id
+from .coverage import union_ranges
+from .pg_sphere import SPoint
+
+logger = logging.getLogger(__name__)
+
+# Must match the shards written by ingest
+SHARD_ORDER = 20
+
+VERSIONS_QUERY = """
+    SELECT fieldid, filter,
+           sum((extract(epoch FROM ingested_at) * 1000000)::bigint)::bigint AS version
+    FROM ingest_metadata
+    GROUP BY fieldid, filter
+"""
+
+# kNN searches widen a cone from the first radius up to the last, and are
+# left to the database if that finds fewer than k sources
+KNN_RADII_DEG = (10 / 3600, 1 / 60, 0.1, 1.0)
+
+
+def shard_key(ccdid: int, qid: int, sourceid: int) -> int:
+    return (ccdid << 40) | (qid << 32) | sourceid
+
+
+@dataclass
+class Selection:
+    """The optional constraints of a search, as parsed by the handlers."""
+
+    filter: str | None = None
+    fieldid: int | None = None
+    # (column, ">=" or "<=", value)
+    cuts: list[tuple[str, str, float]] = field(default_factory=list)
+    flags_exclude: int | None = None
+
+
+class Shard:
+    """The sources of one field/filter, mapped from a shard directory."""
+
+    def __init__(self, path: Path):
+        meta = json.loads((path / "meta.json").read_text())
+        if meta["order"] != SHARD_ORDER:
+            raise ValueError(f"{path} has HEALPix order {meta['order']}")
+        self.path = path
+        self.fieldid: int = meta["fieldid"]
+        self.filter: str = meta["filter"]
+        self.index_order: int = meta["index_order"]
+        self.pixels: list[int] = meta["pixels"]
+        self.sources = np.load(path / "sources.npy", mmap_mode="r")
+        self.hpx = np.load(path / "hpx.npy", mmap_mode="r")
+        self.keys = np.load(path / "keys.npy", mmap_mode="r")
+        self.key_rows = np.load(path / "key_rows.npy", mmap_mode="r")
+
+    def find(self, ccdid: int, qid: int, sourceid: int) -> int | None:
+        """Row of a source, None if it is not in the shard."""
+        key = shard_key(ccdid, qid, sourceid)
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.key_rows[i])
+        return None
+
+    def rows_in(self, ranges: np.ndarray) -> np.ndarray:
+        """Rows with a HEALPix index in the [start, end) ranges."""
+        bounds = np.searchsorted(self.hpx, ranges.ravel()).reshape(-1, 2)
+        return np.concatenate(
+            [np.empty(0, dtype=np.int64)]
+            + [np.arange(lo, hi) for lo, hi in bounds.tolist() if hi > lo]
+        )
+
+    def to_rows(self, records: np.ndarray) -> list[dict]:
+        """Records as dicts like the database rows of refpsfcat_full."""
+        columns = {name: records[name].tolist() for name in records.dtype.names}
+        oids = object_id(
+            np.int64(self.fieldid),
+            FILTER_CODES[self.filter],
+            records["ccdid"].astype(np.int64),
+            records["qid"].astype(np.int64),
+            records["sourceid"].astype(np.int64),
+        ).tolist()
+        return [
+            {
+                "fieldid": self.fieldid,
+                "filter": self.filter,
+                **{name: values[i] for name, values in columns.items()},
+                "oid": str(oids[i]),
+            }
+            for i in range(len(records))
+        ]
+
+
+@functools.cache
+def _level(order: int) -> tuple[HEALPix, float]:
+    """HEALPix at ``order`` and the margin (deg) to search it with."""
+    hp = HEALPix(nside=2**order, order="nested")
+    # cone_search only returns pixels with their center in the cone;
+    # a pixel's points are at most ~1.05 pixel sizes from its center
+    return hp, 1.1 * hp.pixel_resolution.to_value(u.deg)
+
+
+def _separation_deg(
+    ra0: float, dec0: float, ra: np.ndarray, dec: np.ndarray
+) -> np.ndarray:
+    # Haversine, accurate at the small separations searches are about
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    ra, dec = np.radians(ra), np.radians(dec)
+    h = (
+        np.sin((dec - dec0) / 2) ** 2
+        + np.cos(dec0) * np.cos(dec) * np.sin((ra - ra0) / 2) ** 2
+    )
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0))))
+
+
+def _selected(records: np.ndarray, selection: Selection) -> np.ndarray:
+    """Mask of the records passing the cuts, NaN failing every comparison
+    like the ``<> 'NaN'`` conditions of the SQL searches."""
+    mask = np.ones(len(records), dtype=bool)
+    for col, op, value in selection.cuts:
+        values = records[col]
+        mask &= values >= value if op == ">=" else values <= value
+    if selection.flags_exclude is not None:
+        mask &= (records["flags"] & selection.flags_exclude) == 0
+    return mask
+
+
+class ShardSet:
+    """The shards matching the database, by filter and sky pixel."""
+
+    def __init__(self, shards: dict[tuple[str, int], Shard], ready: set[str]):
+        self.shards = shards
+        self.ready = ready
+        self._by_pixel: dict[str, dict[int, list[Shard]]] = {}
+        self._index_order: dict[str, int] = {}
+        for shard in shards.values():
+            self._index_order.setdefault(shard.filter, shard.index_order)
+            by_pixel = self._by_pixel.setdefault(shard.filter, {})
+            for pixel in shard.pixels:
+                by_pixel.setdefault(pixel, []).append(shard)
+
+    def _covers(self, filt: str | None) -> list[str] | None:
+        filters = list(FILTER_CODES) if filt is None else [filt]
+        return filters if all(f in self.ready for f in filters) else None
+
+    def source(
+        self, fieldid: int, filt: str, ccdid: int, qid: int, sourceid: int
+    ) -> list[dict] | None:
+        shard = self.shards.get((filt, fieldid))
+        if shard is None:
+            return None
+        row = shard.find(ccdid, qid, sourceid)
+        return [] if row is None else shard.to_rows(shard.sources[[row]])
+
+    def _candidates(
+        self, center: SPoint, radius_deg: float, selection: Selection
+    ) -> list[tuple[Shard, np.ndarray, np.ndarray]] | None:
+        """(shard, records, separations) of the selected sources within the
+        circle, per shard; None if the shards cannot tell."""
+        filters = self._covers(selection.filter)
+        if filters is None:
+            return None
+        # Pixels about the radius across keep the runs of rows few
+        order = int(np.clip(np.log2(58.6 / max(radius_deg, 1e-9)), 0, SHARD_ORDER))
+        hp, margin = _level(order)
+        pixels = hp.cone_search_lonlat(
+            center.ra * u.deg, center.dec * u.deg, (radius_deg + margin) * u.deg
+        ).astype(np.int64)
+        shift = 2 * (SHARD_ORDER - order)
+        ranges = union_ranges(np.stack([pixels << shift, (pixels + 1) << shift], 1))
+
+        found = []
+        for filt in filters:
+            if filt not in self._by_pixel:
+                continue
+            index_shift = 2 * (order - self._index_order[filt])
+            index_pixels = (
+                pixels >> index_shift
+                if index_shift >= 0
+                else _children(pixels, -index_shift)
+            )
+            shards = {
+                shard.path: shard
+                for p in np.unique(index_pixels).tolist()
+                for shard in self._by_pixel[filt].get(p, ())
+                if selection.fieldid is None or shard.fieldid == selection.fieldid
+            }
+            for shard in shards.values():
+                records = shard.sources[shard.rows_in(ranges)]
+                separation = _separation_deg(
+                    center.ra, center.dec, records["ra"], records["dec"]
+                )
+                keep = (separation <= radius_deg) & _selected(records, selection)
+                if keep.any():
+                    found.append((shard, records[keep], separation[keep]))
+        return found
+
+    def cone(
+        self,
+        center: SPoint,
+        radius_deg: float,
+        selection: Selection,
+        order: str,
+        limit: int,
+    ) -> list[dict] | None:
+        """Like the cone query: sources within the circle, nearest or
+        brightest first."""
+        found = self._candidates(center, radius_deg, selection)
+        if found is None:
+            return None
+        return [row for row, _ in _first(found, limit, by_mag=order == "mag")]
+
+    def knn(self, center: SPoint, k: int, selection: Selection) -> list[dict] | None:
+        """Like the kNN query: the k nearest sources with their separation."""
+        for radius_deg in KNN_RADII_DEG:
+            found = self._candidates(center, radius_deg, selection)
+            if found is None:
+                return None
+            # Any source beyond the radius is farther than k found within it
+            if sum(len(records) for _, records, _ in found) >= k:
+                return [
+                    {**row, "separation_arcsec": separation * 3600.0}
+                    for row, separation in _first(found, k)
+                ]
+        return None
+
+
+def _first(
+    found: list[tuple[Shard, np.ndarray, np.ndarray]], limit: int, by_mag: bool = False
+) -> list[tuple[dict, float]]:
+    """The ``limit`` nearest, or brightest, of the candidates as (row,
+    separation) pairs; only those are turned into dicts."""
+    rows, keys, separations = [], [], []
+    for shard, records, separation in found:
+        key = records["mag"] if by_mag else separation
+        first = np.argsort(key, kind="stable")[:limit]
+        rows += shard.to_rows(records[first])
+        keys.append(key[first])
+        separations.append(separation[first])
+    if not rows:
+        return []
+    # NaN magnitudes sort last, as in PostgreSQL
+    ordered = np.argsort(np.concatenate(keys), kind="stable")[:limit].tolist()
+    separation = np.concatenate(separations).tolist()
+    return [(rows[i], separation[i]) for i in ordered]
+
+
+def _children(pixels: np.ndarray, shift: int) -> np.ndarray:
+    """Nested pixels ``shift / 2`` orders deeper, inside ``pixels``."""
+    return (pixels[:, None] << shift | np.arange(1 << shift)).ravel()
+
+
+class ShardStore:
+    """The shards in ``root`` matching the database, reloaded as ingest
+    writes new versions.
+
+    ``get()`` returns None until the first load.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._current: ShardSet | None = None
+
+    def get(self) -> ShardSet | None:
+        return self._current
+
+    async def refresh(self, pool) -> None:
+        async with pool.acquire() as con:
+            generation = await con.fetchval(GENERATION_QUERY)
+            versions = await con.fetch(VERSIONS_QUERY)
+        self._current = await asyncio.to_thread(self._load, generation, versions)
+
+    def _load(self, generation: int, versions) -> ShardSet:
+        previous = self._current.shards if self._current is not None else {}
+        shards = {}
+        stale = set()
+        for row in versions:
+            key = (row["filter"], row["fieldid"])
+            path = (
+                self.root
+                / row["filter"]
+                / f"{row['fieldid']:06d}"
+                / f"{generation}-{row['version']}"
+            )
+            if key in previous and previous[key].path == path:
+                shards[key] = previous[key]
+                continue
+            try:
+                shards[key] = Shard(path)
+            except FileNotFoundError:
+                stale.add(row["filter"])
+            except Exception:
+                logger.exception("Failed to load the shard in %s", path)
+                stale.add(row["filter"])
+        ready = set(FILTER_CODES) - stale
+        if ready != (self._current.ready if self._current is not None else None):
+            logger.info(
+                "Searching %s from %d shards",
+                ", ".join(sorted(ready)) or "no filter",
+                len(shards),
+            )
+        return ShardSet(shards, ready)
+
+
+async def refresh_loop(app: Application) -> None:
+    interval = float(os.environ.get("SHARDS_REFRESH_INTERVAL", "30"))
+    while True:
+        try:
+            await app["shards"].refresh(app["pg_pool"])
+        except Exception:
+            logger.exception("Failed to refresh the search shards")
+        await asyncio.sleep(interval)
+
+
+async def start_shards(app: Application) -> None:
+    root = os.environ.get("SHARDS_DIR")
+    app["shards"] = ShardStore(Path(root)) if root else None
+    if root:
+        app["shards_refresh"] = asyncio.create_task(refresh_loop(app))
+
+
+async def stop_shards(app: Application) -> None:
+    task = app.get("shards_refresh")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,57 @@
+"""Coalesce identical concurrent queries into one database call."""
+
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Run at most one call per key at a time.
+
+    Callers arriving while a call for their key is in flight wait for it
+    and get its result, or its exception, instead of starting their own.
+    The call is cancelled once every caller has gone away. Nothing is kept
+    once the call has finished.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self._waiters[task] = 0
+            task.add_done_callback(lambda t: self._done(key, t))
+        self._waiters[task] += 1
+        try:
+            # A caller going away must not cancel the call for the others
+            return await asyncio.shield(task)
+        finally:
+            self._leave(key, task)
+
+    def _leave(self, key: Hashable, task: asyncio.Task) -> None:
+        if task.done():
+            return
+        self._waiters[task] -= 1
+        if self._waiters[task] == 0:
+            # Callers arriving from now on start a call of their own
+            del self._calls[key]
+            task.cancel()
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        del self._waiters[task]
+        # Mark the exception as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
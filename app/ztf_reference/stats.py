@@ -0,0 +1,158 @@
+"""Catalog statistics, cached in memory from the quadrant_summary table."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+
+from aiohttp.web import Application
+
+from .catalog import GENERATION_QUERY
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_QUERY = """
+    SELECT fieldid, filter, ccdid, qid, n_sources, mag_min, mag_max, sigmag_median,
+           region, updated_at
+    FROM quadrant_summary
+"""
+
+# Digest of the transactions that last wrote each summary (see coverage.py):
+# max(updated_at) would miss a transaction that started earlier committing
+# later, with an updated_at older than the one already seen. A scan of one
+# small row per quadrant
+VERSION_QUERY = f"""
+    SELECT md5(string_agg(xmin::text, ',' ORDER BY ctid)), ({GENERATION_QUERY})
+    FROM quadrant_summary
+"""
+
+
+class _Totals:
+    def __init__(self):
+        self.source_count = 0
+        self.quadrant_count = 0
+        self.mag_min = None
+        self.mag_max = None
+
+    def add(self, row) -> None:
+        self.source_count += row["n_sources"]
+        self.quadrant_count += 1
+        if row["mag_min"] is not None and (
+            self.mag_min is None or row["mag_min"] < self.mag_min
+        ):
+            self.mag_min = row["mag_min"]
+        if row["mag_max"] is not None and (
+            self.mag_max is None or row["mag_max"] > self.mag_max
+        ):
+            self.mag_max = row["mag_max"]
+
+    def to_dict(self) -> dict:
+        return {
+            "source_count": self.source_count,
+            "quadrant_count": self.quadrant_count,
+            "mag_min": self.mag_min,
+            "mag_max": self.mag_max,
+        }
+
+
+def _quadrant_to_dict(row) -> dict:
+    region = row["region"]
+    return {
+        "filter": row["filter"],
+        "ccdid": row["ccdid"],
+        "qid": row["qid"],
+        "source_count": row["n_sources"],
+        "mag_min": row["mag_min"],
+        "mag_max": row["mag_max"],
+        "sigmag_median": row["sigmag_median"],
+        "region": None
+        if region is None
+        else {
+            "ra": region.point.ra,
+            "dec": region.point.dec,
+            "radius_deg": region.radius_arcsec / 3600.0,
+        },
+    }
+
+
+class CatalogStats:
+    """Totals of the whole catalog, per filter and per field.
+
+    Everything is aggregated once when the summaries are loaded, so the
+    responses are ready-made dicts.
+    """
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        total = _Totals()
+        filters: dict[str, _Totals] = {}
+        fields: dict[int, tuple[_Totals, dict[str, _Totals], list]] = {}
+        for row in sorted(
+            rows, key=lambda r: (r["fieldid"], r["filter"], r["ccdid"], r["qid"])
+        ):
+            total.add(row)
+            filters.setdefault(row["filter"], _Totals()).add(row)
+            field_total, field_filters, quadrants = fields.setdefault(
+                row["fieldid"], (_Totals(), {}, [])
+            )
+            field_total.add(row)
+            field_filters.setdefault(row["filter"], _Totals()).add(row)
+            quadrants.append(_quadrant_to_dict(row))
+
+        updated_at = max((row["updated_at"] for row in rows), default=None)
+        self.summary = {
+            **total.to_dict(),
+            "filters": {filt: t.to_dict() for filt, t in sorted(filters.items())},
+            "updated_at": None if updated_at is None else updated_at.isoformat(),
+        }
+        self.fields = {
+            fieldid: {
+                "fieldid": fieldid,
+                **field_total.to_dict(),
+                "filters": {filt: t.to_dict() for filt, t in field_filters.items()},
+                "quadrants": quadrants,
+            }
+            for fieldid, (field_total, field_filters, quadrants) in fields.items()
+        }
+
+
+class StatsCache:
+    """The current CatalogStats, reloaded when ingest changes the summaries."""
+
+    def __init__(self):
+        self.current: CatalogStats | None = None
+
+    async def load(self, pool) -> CatalogStats:
+        async with pool.acquire() as con:
+            version = tuple(await con.fetchrow(VERSION_QUERY))
+            if self.current is not None and self.current.version == version:
+                return self.current
+            rows = await con.fetch(SUMMARY_QUERY)
+        self.current = CatalogStats(rows, version)
+        return self.current
+
+    async def get(self, pool) -> CatalogStats:
+        return self.current or await self.load(pool)
+
+
+async def refresh_loop(app: Application) -> None:
+    interval = float(os.environ.get("STATS_REFRESH_INTERVAL", "60"))
+    while True:
+        try:
+            await app["stats"].load(app["pg_pool"])
+        except Exception:
+            logger.exception("Failed to refresh the catalog statistics")
+        await asyncio.sleep(interval)
+
+
+async def start_stats(app: Application) -> None:
+    app["stats"] = StatsCache()
+    app["stats_refresh"] = asyncio.create_task(refresh_loop(app))
+
+
+async def stop_stats(app: Application) -> None:
+    task = app.get("stats_refresh")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,23 @@
+"""Locate the HEALPix display tiles written by the ingest service."""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+
+def tiles_dir() -> Path:
+    return Path(os.environ.get("TILES_DIR", "/data/tiles"))
+
+
+def tile_file(filt: str, order: int | None = None, npix: int | None = None) -> Path:
+    """Path of a tile, or of the tile set's properties file without ``order``."""
+    if order is None:
+        return tiles_dir() / filt / "properties"
+    return (
+        tiles_dir()
+        / filt
+        / f"Norder{order}"
+        / f"Dir{npix // 10000 * 10000}"
+        / f"Npix{npix}.tsv"
+    )
@@ -0,0 +1,126 @@
+"""Warm database caches and connections before taking traffic.
+
+A freshly started instance would otherwise serve its first requests from
+cold connections (no cached plans or catalog lookups) against a database
+whose index pages may not be in shared buffers. ``/api/v1/ready`` reports
+503 until the warm-up is over, so load balancers hold traffic back.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+
+from aiohttp.web import Application
+from asyncpg import Connection, Pool
+from asyncpg.exceptions import UndefinedFunctionError
+
+from .catalog import (
+    OBJECT_QUERY,
+    OUTPUT_COLUMNS,
+    SOURCE_QUERY,
+    cone_query,
+    knn_query,
+    object_id,
+)
+from .pg_sphere import SCircle
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 20
+SAMPLE_RADIUS_ARCSEC = 10.0
+
+# A spread of sources over the sky, from the whole table if the sample
+# comes out too small (as on a tiny database)
+SAMPLE_QUERY = """
+    (SELECT fieldid, filterid, ccdid, qid, sourceid, coord
+     FROM refpsfcat TABLESAMPLE SYSTEM (0.01) LIMIT $1)
+    UNION ALL
+    (SELECT fieldid, filterid, ccdid, qid, sourceid, coord
+     FROM refpsfcat LIMIT $1)
+    LIMIT $1
+"""
+
+# The statements of cone and kNN searches without constraints, as the
+# handlers build them
+CONE_QUERY = cone_query(OUTPUT_COLUMNS, [])
+KNN_QUERY = knn_query(OUTPUT_COLUMNS, [])
+SAMPLE_K = 10
+
+
+async def warm_connection(con: Connection, sample: list) -> None:
+    """Run representative lookups so the connection caches their plans."""
+    for row in sample:
+        await con.fetch(
+            SOURCE_QUERY,
+            row["fieldid"],
+            row["filterid"],
+            row["ccdid"],
+            row["qid"],
+            row["sourceid"],
+        )
+        await con.fetch(
+            OBJECT_QUERY,
+            object_id(
+                row["fieldid"],
+                row["filterid"],
+                row["ccdid"],
+                row["qid"],
+                row["sourceid"],
+            ),
+        )
+        circle = SCircle(point=row["coord"], radius_arcsec=SAMPLE_RADIUS_ARCSEC)
+        await con.fetch(CONE_QUERY, circle)
+        await con.fetch(KNN_QUERY, row["coord"], SAMPLE_K)
+
+
+async def warm_pool(pool: Pool) -> None:
+    """Load the hot relations into the server's buffers, then warm every
+    connection the pool keeps open."""
+    async with pool.acquire() as con:
+        try:
+            blocks = await con.fetchval("SELECT prewarm_catalog()")
+            logger.info("Prewarmed %d blocks", blocks)
+        except UndefinedFunctionError:
+            # Databases created before the function was added to the schema
+            logger.warning("prewarm_catalog() is missing, skipping prewarm")
+        sample = await con.fetch(SAMPLE_QUERY, SAMPLE_SIZE)
+
+    cons = [await pool.acquire() for _ in range(pool.get_min_size())]
+    try:
+        await asyncio.gather(*(warm_connection(con, sample) for con in cons))
+    finally:
+        for con in cons:
+            await pool.release(con)
+
+
+async def warm_up(app: Application) -> None:
+    """Warm all read pools, giving up after ``WARMUP_TIMEOUT`` seconds.
+
+    Failures are logged and otherwise ignored: a cold instance is still
+    better than one that never becomes ready.
+    """
+    timeout = float(os.environ.get("WARMUP_TIMEOUT", "300"))
+    pools = app["pg_pool"].pools()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(warm_pool(pool) for pool in pools)), timeout
+        )
+    except TimeoutError:
+        logger.warning("Warm-up did not finish in %g s, serving anyway", timeout)
+    except Exception:
+        logger.exception("Warm-up failed, serving anyway")
+    else:
+        logger.info("Warm-up done for %d database endpoints", len(pools))
+
+
+async def start_warmup(app: Application) -> None:
+    app["warmup"] = asyncio.create_task(warm_up(app))
+
+
+async def stop_warmup(app: Application) -> None:
+    task = app.get("warmup")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,393 @@
+"""Asynchronous cross-match jobs for uploaded position tables."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import shutil
+from pathlib import Path
+from uuid import UUID
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+from aiohttp.web import Application
+
+from .catalog import (
+    ARROW_TYPES,
+    FILTER_CODES,
+    OUTPUT_COLUMNS,
+    SELECT_COLS,
+)
+
+logger = logging.getLogger(__name__)
+
+INPUT_FORMATS = ("csv", "fits", "parquet")
+
+CHUNK_SIZE = 5000
+ZONE_HEIGHT_DEG = 0.1
+POLL_INTERVAL = 2.0
+
+# Running jobs touch heartbeat_at this often; one not touched for
+# STALE_AFTER, its worker's process having died, is claimed again
+HEARTBEAT_INTERVAL = 30.0
+STALE_AFTER = 300.0
+
+# Finished and failed jobs are deleted, with their files, after this long
+RETENTION_SECONDS = float(os.environ.get("XMATCH_RETENTION_DAYS", "7")) * 86400
+SWEEP_INTERVAL = 3600.0
+
+# Arrow types of the reference columns added to every output row
+RESULT_TYPES = {**ARROW_TYPES, "separation_arcsec": pa.float64()}
+
+MATCH_QUERY = f"""
+    SELECT p.i, m.*
+    FROM unnest($1::integer[], $2::double precision[], $3::double precision[])
+        AS p(i, ra, dec)
+    CROSS JOIN LATERAL (
+        SELECT {SELECT_COLS},
+               degrees(coord <-> spoint(radians(p.ra), radians(p.dec))) * 3600.0
+                   AS separation_arcsec
+        FROM refpsfcat_full
+        WHERE coord <@ scircle(spoint(radians(p.ra), radians(p.dec)),
+                               radians($4::double precision / 3600.0))
+          AND ($5::smallint IS NULL OR filterid = $5)
+        ORDER BY coord <-> spoint(radians(p.ra), radians(p.dec))
+        LIMIT 1
+    ) m
+"""
+
+
+class JobLost(Exception):
+    """The job was claimed again by another worker, which now owns it."""
+
+
+def jobs_dir() -> Path:
+    return Path(os.environ.get("XMATCH_DIR", "/data/xmatch"))
+
+
+def job_dir(job_id: UUID | str) -> Path:
+    return jobs_dir() / str(job_id)
+
+
+def input_path(job_id: UUID | str, fmt: str) -> Path:
+    return job_dir(job_id) / f"input.{fmt}"
+
+
+def result_path(job_id: UUID | str) -> Path:
+    return job_dir(job_id) / "result.parquet"
+
+
+def partial_path(job_id: UUID | str, attempt: int) -> Path:
+    """Where an attempt writes the result, so that two never share a file."""
+    return job_dir(job_id) / f"result.{attempt}.tmp"
+
+
+def read_table(path: Path, fmt: str) -> pa.Table:
+    """Read an uploaded table, which must have "ra" and "dec" columns in degrees."""
+    if fmt == "csv":
+        table = pyarrow.csv.read_csv(path)
+    elif fmt == "parquet":
+        table = pq.read_table(path)
+    elif fmt == "fits":
+        from astropy.table import Table
+
+        fits_table = Table.read(path, format="fits")
+        table = pa.table(
+            {
+                name: np.asarray(fits_table[name])
+                for name in fits_table.colnames
+                if fits_table[name].ndim == 1
+            }
+        )
+    else:
+        raise ValueError(f"Unsupported format: {fmt!r}")
+
+    names = [name.lower() for name in table.column_names]
+    for col in ("ra", "dec"):
+        if col not in names:
+            raise ValueError(f'Input table has no "{col}" column')
+    return table.rename_columns(
+        [
+            lower if lower in ("ra", "dec") else name
+            for name, lower in zip(table.column_names, names)
+        ]
+    )
+
+
+def spatial_order(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """Sort positions into declination zones, then by RA within each zone.
+
+    Consecutive positions then probe neighbouring GIST pages, so each chunk
+    reads a compact part of the index instead of random pages across the sky.
+    """
+    zone = np.floor((dec + 90.0) / ZONE_HEIGHT_DEG)
+    return np.lexsort((ra, zone))
+
+
+def _chunk_result(chunk: pa.Table, indices: np.ndarray, rows: list) -> pa.Table:
+    """Append the matched reference columns to a chunk of input rows."""
+    n = len(chunk)
+    values: dict[str, list] = {col: [None] * n for col in RESULT_TYPES}
+    for row in rows:
+        i = row["i"]
+        for col in OUTPUT_COLUMNS:
+            val = row[col]
+            if isinstance(val, float) and val != val:
+                val = None
+            values[col][i] = val
+        values["separation_arcsec"][i] = row["separation_arcsec"]
+
+    columns = [pa.array(indices, pa.int64()), *chunk.columns]
+    names = ["row_index", *chunk.column_names]
+    for col, typ in RESULT_TYPES.items():
+        columns.append(pa.array(values[col], typ))
+        names.append(col if col == "separation_arcsec" else f"ref_{col}")
+    return pa.Table.from_arrays(columns, names=names)
+
+
+async def _update_owned(app: Application, job, query: str, *args) -> None:
+    """Run an UPDATE of the job's row, whose WHERE clause takes the job ID
+    as $1 and the attempt as $2; raise JobLost if the row is not ours."""
+    async with app["pg_pool"].primary.acquire() as con:
+        status = await con.execute(query, job["job_id"], job["attempt"], *args)
+    if status == "UPDATE 0":
+        raise JobLost(job["job_id"])
+
+
+async def run_job(app: Application, job) -> None:
+    """Match the job's input into its partial result file; ``_finish``
+    moves it into place."""
+    loop = asyncio.get_running_loop()
+    job_id = job["job_id"]
+    table = await loop.run_in_executor(
+        None, read_table, input_path(job_id, job["format"]), job["format"]
+    )
+    ra = table.column("ra").to_numpy(zero_copy_only=False).astype(np.float64)
+    dec = table.column("dec").to_numpy(zero_copy_only=False).astype(np.float64)
+    order = spatial_order(ra, dec)
+
+    await _update_owned(
+        app,
+        job,
+        "UPDATE xmatch_job SET n_rows = $3 WHERE job_id = $1 AND attempt = $2",
+        len(table),
+    )
+
+    tmp_path = partial_path(job_id, job["attempt"])
+    writer = None
+    n_matched = 0
+    try:
+        for start in range(0, len(order), CHUNK_SIZE):
+            indices = order[start : start + CHUNK_SIZE]
+            async with app["pg_pool"].acquire() as con:
+                rows = await con.fetch(
+                    MATCH_QUERY,
+                    list(range(len(indices))),
+                    ra[indices].tolist(),
+                    dec[indices].tolist(),
+                    job["radius_arcsec"],
+                    FILTER_CODES.get(job["filter"]),
+                )
+            n_matched += len(rows)
+            result = await loop.run_in_executor(
+                None, _chunk_result, table.take(indices), indices, rows
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, result.schema)
+            await loop.run_in_executor(None, writer.write_table, result)
+
+            # Also stops a worker whose job was given to another
+            await _update_owned(
+                app,
+                job,
+                """
+                UPDATE xmatch_job SET n_processed = $3, n_matched = $4
+                WHERE job_id = $1 AND attempt = $2
+                """,
+                start + len(indices),
+                n_matched,
+            )
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        empty = _chunk_result(table.slice(0, 0), np.empty(0, np.int64), [])
+        pq.write_table(empty, tmp_path)
+
+
+async def claim_job(app: Application):
+    """Take the oldest job that is queued or whose worker is gone, skipping
+    ones other workers have locked. Each claim is a new attempt, which the
+    worker's updates of the job must match."""
+    async with app["pg_pool"].primary.acquire() as con:
+        return await con.fetchrow(
+            """
+            WITH next AS (
+                SELECT job_id, status FROM xmatch_job
+                WHERE status = 'queued'
+                   OR (status = 'running'
+                       AND coalesce(heartbeat_at, started_at)
+                           < now() - make_interval(secs => $1))
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE xmatch_job j
+            SET status = 'running', started_at = now(), heartbeat_at = now(),
+                attempt = j.attempt + 1
+            FROM next
+            WHERE j.job_id = next.job_id
+            RETURNING j.job_id, j.attempt, j.format, j.radius_arcsec, j.filter,
+                      next.status = 'running' AS reclaimed
+            """,
+            STALE_AFTER,
+        )
+
+
+async def _heartbeat(app: Application, job) -> None:
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            await _update_owned(
+                app,
+                job,
+                """
+                UPDATE xmatch_job SET heartbeat_at = now()
+                WHERE job_id = $1 AND attempt = $2
+                """,
+            )
+        except JobLost:
+            # run_job notices at its next progress update
+            return
+        except Exception:
+            logger.warning("Heartbeat of cross-match job %s failed", job["job_id"])
+
+
+async def worker(app: Application) -> None:
+    while True:
+        try:
+            job = await claim_job(app)
+        except Exception:
+            logger.exception("Failed to claim a cross-match job")
+            job = None
+        if job is None:
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+
+        job_id = job["job_id"]
+        if job["reclaimed"]:
+            logger.warning("Restarting stale cross-match job %s", job_id)
+        else:
+            logger.info("Starting cross-match job %s", job_id)
+        heartbeat = asyncio.create_task(_heartbeat(app, job))
+        try:
+            try:
+                await run_job(app, job)
+            except asyncio.CancelledError:
+                await _finish(app, job, "queued", None)
+                raise
+            except JobLost:
+                raise
+            except Exception as e:
+                logger.exception("Cross-match job %s failed", job_id)
+                await _finish(app, job, "failed", str(e))
+            else:
+                await _finish(app, job, "done", None)
+                logger.info("Finished cross-match job %s", job_id)
+        except JobLost:
+            logger.warning(
+                "Cross-match job %s was claimed again, dropping attempt %d",
+                job_id,
+                job["attempt"],
+            )
+        finally:
+            heartbeat.cancel()
+            partial_path(job_id, job["attempt"]).unlink(missing_ok=True)
+
+
+async def _finish(app: Application, job, status: str, error: str | None):
+    """Record the outcome of the job's attempt, and move its result into
+    place if done, as long as the job is still ours."""
+    async with app["pg_pool"].primary.acquire() as con, con.transaction():
+        # The row lock keeps the job from being claimed again meanwhile
+        owned = await con.fetchval(
+            """
+            SELECT true FROM xmatch_job
+            WHERE job_id = $1 AND attempt = $2
+            FOR UPDATE
+            """,
+            job["job_id"],
+            job["attempt"],
+        )
+        if not owned:
+            raise JobLost(job["job_id"])
+        if status == "done":
+            partial_path(job["job_id"], job["attempt"]).rename(
+                result_path(job["job_id"])
+            )
+        await con.execute(
+            """
+            UPDATE xmatch_job
+            SET status = $2, error = $3,
+                finished_at = CASE WHEN $2 = 'queued' THEN NULL ELSE now() END
+            WHERE job_id = $1
+            """,
+            job["job_id"],
+            status,
+            error,
+        )
+
+
+async def sweep_jobs(app: Application) -> int:
+    """Delete the jobs finished more than RETENTION_SECONDS ago, and their
+    files. Returns the number of jobs deleted."""
+    async with app["pg_pool"].primary.acquire() as con:
+        job_ids = [
+            row["job_id"]
+            for row in await con.fetch(
+                """
+                SELECT job_id FROM xmatch_job
+                WHERE status IN ('done', 'failed')
+                  AND finished_at < now() - make_interval(secs => $1)
+                """,
+                RETENTION_SECONDS,
+            )
+        ]
+    if not job_ids:
+        return 0
+    loop = asyncio.get_running_loop()
+    # Files first: a job deleted before its files would leave them for good
+    for job_id in job_ids:
+        await loop.run_in_executor(None, shutil.rmtree, job_dir(job_id), True)
+    async with app["pg_pool"].primary.acquire() as con:
+        await con.execute(
+            "DELETE FROM xmatch_job WHERE job_id = ANY($1::uuid[])", job_ids
+        )
+    logger.info("Deleted %d expired cross-match jobs", len(job_ids))
+    return len(job_ids)
+
+
+async def _sweep_loop(app: Application) -> None:
+    while True:
+        try:
+            await sweep_jobs(app)
+        except Exception:
+            logger.exception("Failed to delete expired cross-match jobs")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+async def start_workers(app: Application) -> None:
+    n = int(os.environ.get("XMATCH_WORKERS", "2"))
+    app["xmatch_workers"] = [asyncio.create_task(worker(app)) for _ in range(n)]
+    app["xmatch_workers"].append(asyncio.create_task(_sweep_loop(app)))
+
+
+async def stop_workers(app: Application) -> None:
+    tasks = app.get("xmatch_workers", [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
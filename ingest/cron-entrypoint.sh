@@ -1,8 +1,10 @@
 #!/bin/bash
 set -e
 
-# Run ingest on startup, then repeat every 30 days
+# Run ingest on startup, then repeat every INGEST_INTERVAL (default 30 days).
+# Writes are throttled when the API is busy (see --max-app-waits), so a
+# short interval can keep ingest running in the background.
 while true; do
     uv run python -m ztf_reference_ingest
-    sleep 30d
+    sleep "${INGEST_INTERVAL:-30d}"
 done
@@ -2,52 +2,196 @@
 
 from __future__ import annotations
 
+import glob
+import itertools
 import logging
 import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
 from pathlib import Path
 
 import click
 import psycopg
 
-from .db import ingest_catalog
-from .discover import FileRef, generate_all_refs
-from .fits import parse_fits
-from .worker import _init_worker, process_one
+from .associate import associate_quadrant
+from .db import get_conninfo
+from .discover import generate_all_refs
+from .maintenance import TableActivity, run_maintenance, table_activity
+from .parquet import export_parquet
+from .shards import build_shards
+from .shadow import SHADOW_SCHEMA, finish_shadow, prepare_shadow, shadow_conninfo, swap
+from .summary import rebuild_summaries
+from .throttle import Governor, Throttle
+from .tiles import build_tiles
+from .worker import _init_worker, process_batch, process_local_batch
 
 logger = logging.getLogger(__name__)
 
+LOCAL_FILE_PATTERN = "*_refpsfcat.fits"
 
-def get_conninfo() -> str:
-    host = os.environ.get("DB_HOST", "sql")
-    dbname = os.environ.get("DB_NAME", "ztfref")
-    user = os.environ.get("DB_USER", "ingest")
-    return f"host={host} dbname={dbname} user={user}"
 
+def expand_local_paths(patterns: tuple[str, ...]) -> list[Path]:
+    """Resolve --from-file arguments, which may be files, directories
+    (searched recursively for catalog files) or glob patterns."""
+    paths: set[Path] = set()
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            paths.update(path.rglob(LOCAL_FILE_PATTERN))
+        elif path.is_file():
+            paths.add(path)
+        else:
+            matches = [Path(p) for p in glob.glob(pattern, recursive=True)]
+            matches = [p for p in matches if p.is_file()]
+            if not matches:
+                raise click.BadParameter(
+                    f"no such file, directory or matching files: {pattern}",
+                    param_hint="--from-file",
+                )
+            paths.update(matches)
+    return sorted(paths)
 
-def ingest_local_file(filepath: Path, conninfo: str) -> int:
-    """Ingest a single local FITS file into the database."""
-    catalog = parse_fits(filepath)
-    ref = FileRef(
-        fieldid=catalog.fieldid,
-        filter=catalog.filter,
-        ccdid=catalog.ccdid,
-        qid=catalog.qid,
-    )
+
+def _run_batches(
+    fn,
+    items: list,
+    workers: int,
+    commit_size: int,
+    conninfo: str,
+    diff: bool,
+    governor: Governor,
+) -> tuple[dict[str, int], int]:
+    """Run ``fn`` over batches of ``items`` in a process pool, writing
+    within the limits of the governor's throttle.
+
+    Returns the count of files per status and the total rows ingested.
+    """
+    stats = {"ingested": 0, "skipped": 0, "failed": 0}
+    total_rows = 0
+    governor.start()
+    try:
+        # Each worker keeps its connection; a batch of files is one transaction
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(conninfo, governor.throttle),
+        ) as executor:
+            futures = [
+                executor.submit(fn, list(batch), diff)
+                for batch in itertools.batched(items, commit_size)
+            ]
+            for future in as_completed(futures):
+                for status, count in future.result():
+                    stats[status] += 1
+                    total_rows += count
+    finally:
+        governor.stop()
+    return stats, total_rows
+
+
+def _table_activity(conninfo: str) -> dict[str, TableActivity]:
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        return table_activity(conn)
+    finally:
+        conn.close()
+
+
+def _maintain(
+    conninfo: str,
+    before: dict[str, TableActivity] | None,
+    budget: float,
+    statistics_target: int | None,
+    reindex_bloat: float,
+) -> None:
+    """Vacuum, analyze and reindex what the run left in need of it."""
     conn = psycopg.connect(conninfo, autocommit=True)
     try:
-        return ingest_catalog(conn, catalog, ref)
+        run_maintenance(conn, before, budget, statistics_target, reindex_bloat)
     finally:
         conn.close()
 
 
-def _analyze(conninfo: str) -> None:
-    """Run ANALYZE to update pg_class.reltuples for the /stats endpoint."""
+def _prepare_shadow(conninfo: str) -> None:
     conn = psycopg.connect(conninfo, autocommit=True)
     try:
-        conn.execute("ANALYZE quadrant")
-        conn.execute("ANALYZE refpsfcat")
-        logger.info("ANALYZE completed for quadrant and refpsfcat")
+        prepare_shadow(conn)
+    finally:
+        conn.close()
+
+
+def _finish_shadow(conninfo: str) -> None:
+    """Index the catalog built in the shadow schema and swap it in."""
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        finish_shadow(conn)
+        swap(conn)
+    finally:
+        conn.close()
+
+
+def _swap(conninfo: str) -> None:
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        swap(conn)
+    finally:
+        conn.close()
+
+
+def _rebuild_associations(conninfo: str) -> None:
+    """Re-match the filters of every ingested quadrant, one at a time."""
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        quadrants = conn.execute(
+            "SELECT DISTINCT fieldid, ccdid, qid FROM quadrant ORDER BY 1, 2, 3"
+        ).fetchall()
+        for fieldid, ccdid, qid in quadrants:
+            with conn.transaction():
+                associate_quadrant(conn, fieldid, ccdid, qid)
+    finally:
+        conn.close()
+
+
+def _rebuild_summaries(conninfo: str) -> None:
+    """Recompute the /stats summary and the coverage of every ingested quadrant."""
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        rebuild_summaries(conn)
+    finally:
+        conn.close()
+
+
+def _db_now(conninfo: str) -> datetime:
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        return conn.execute("SELECT now()").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _build_tiles(conninfo: str, tiles_dir: Path, since: datetime | None) -> None:
+    """Regenerate display tiles for quadrants ingested since ``since``."""
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        build_tiles(conn, tiles_dir, since)
+    finally:
+        conn.close()
+
+
+def _build_shards(conninfo: str, shards_dir: Path, rebuild: bool) -> None:
+    """Bring the search shards up to date with the catalog."""
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        build_shards(conn, shards_dir, rebuild)
+    finally:
+        conn.close()
+
+
+def _export_parquet(conninfo: str, parquet_dir: Path, rebuild: bool) -> None:
+    """Rewrite the partitions of the Parquet export that are out of date."""
+    conn = psycopg.connect(conninfo, autocommit=True)
+    try:
+        export_parquet(conn, parquet_dir, rebuild)
     finally:
         conn.close()
 
@@ -69,7 +213,9 @@ def _env_strings(var: str) -> list[str] | None:
 
 
 @click.command()
-@click.option("--workers", default=10, help="Number of parallel download workers")
+@click.option(
+    "--workers", default=10, help="Number of parallel download or local ingest workers"
+)
 @click.option(
     "--fieldid", type=int, multiple=True, help="Only process specific field IDs"
 )
@@ -92,13 +238,149 @@ def _env_strings(var: str) -> list[str] | None:
     multiple=True,
     help="Only process specific quadrant IDs (1-4)",
 )
+@click.option(
+    "--commit-size",
+    type=click.IntRange(min=1),
+    default=1,
+    envvar="INGEST_COMMIT_SIZE",
+    show_default=True,
+    help="Number of files each worker loads per transaction",
+)
+@click.option(
+    "--diff",
+    is_flag=True,
+    envvar="INGEST_DIFF",
+    help=(
+        "Compare re-ingested quadrants with the stored rows and write only "
+        "the sources that changed"
+    ),
+)
+@click.option(
+    "--max-writers",
+    type=click.IntRange(min=1),
+    envvar="INGEST_MAX_WRITERS",
+    help="Workers allowed to load into the database at once [default: --workers]",
+)
+@click.option(
+    "--max-copy-rate",
+    type=click.FloatRange(min=0),
+    default=0,
+    envvar="INGEST_MAX_COPY_RATE",
+    show_default=True,
+    help="MB/s of rows all workers together COPY into the database, 0 for no limit",
+)
+@click.option(
+    "--max-app-waits",
+    type=click.IntRange(min=0),
+    default=4,
+    envvar="INGEST_MAX_APP_WAITS",
+    show_default=True,
+    help=(
+        "Back off while more API queries than this wait on I/O or locks, 0 to ignore"
+    ),
+)
+@click.option(
+    "--max-replication-lag",
+    type=click.FloatRange(min=0),
+    default=30,
+    envvar="INGEST_MAX_REPLICATION_LAG",
+    show_default=True,
+    help="Back off while replicas are more seconds behind than this, 0 to ignore",
+)
+@click.option(
+    "--shadow",
+    is_flag=True,
+    help=(
+        f"Build a complete new catalog from IRSA in the {SHADOW_SCHEMA} schema "
+        "and swap it in once loaded and indexed, leaving the live one untouched "
+        "until then"
+    ),
+)
+@click.option(
+    "--rollback",
+    is_flag=True,
+    help=f"Swap back the catalog left in {SHADOW_SCHEMA} by the last swap and exit",
+)
 @click.option("--dry-run", is_flag=True, help="List files without downloading")
 @click.option(
     "--from-file",
     "from_files",
-    type=click.Path(exists=True, path_type=Path),
     multiple=True,
-    help="Ingest local FITS file(s) instead of downloading from IRSA",
+    help=(
+        "Ingest local FITS files instead of downloading from IRSA: a file, "
+        f"a directory searched for {LOCAL_FILE_PATTERN}, or a glob pattern"
+    ),
+)
+@click.option(
+    "--tiles-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    envvar="TILES_DIR",
+    help="Update the HEALPix display tiles in this directory after ingestion",
+)
+@click.option(
+    "--rebuild-tiles",
+    is_flag=True,
+    help="Regenerate every display tile, not only the ones touched by this run",
+)
+@click.option(
+    "--shards-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    envvar="SHARDS_DIR",
+    help=("Update the memory-mappable search shards in this directory after ingestion"),
+)
+@click.option(
+    "--rebuild-shards",
+    is_flag=True,
+    help="Write every search shard again, not only the out of date ones",
+)
+@click.option(
+    "--parquet-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    envvar="PARQUET_DIR",
+    help="Update the Parquet export of the catalog in this directory after ingestion",
+)
+@click.option(
+    "--rebuild-parquet",
+    is_flag=True,
+    help="Write every partition of the Parquet export again, not only the changed ones",
+)
+@click.option(
+    "--export-parquet",
+    "export_only",
+    is_flag=True,
+    help="Only update the Parquet export in --parquet-dir and exit",
+)
+@click.option(
+    "--maintenance-budget",
+    type=click.FloatRange(min=0),
+    default=600,
+    envvar="INGEST_MAINTENANCE_BUDGET",
+    show_default=True,
+    help="Seconds of VACUUM/ANALYZE/REINDEX allowed after the run",
+)
+@click.option(
+    "--statistics-target",
+    type=click.IntRange(1, 10000),
+    envvar="INGEST_STATISTICS_TARGET",
+    help="Statistics target for ANALYZE, bounding its sample to 300 rows per unit",
+)
+@click.option(
+    "--reindex-bloat",
+    type=click.FloatRange(0, 1),
+    default=0.5,
+    envvar="INGEST_REINDEX_BLOAT",
+    show_default=True,
+    help="Fraction of a GiST index free or dead beyond a fresh build that triggers a REINDEX",
+)
+@click.option(
+    "--rebuild-associations",
+    is_flag=True,
+    help="Rebuild the cross-band associations of all ingested quadrants and exit",
+)
+@click.option(
+    "--rebuild-summaries",
+    is_flag=True,
+    help="Recompute the statistics and coverage of all ingested quadrants and exit",
 )
 def main(
     workers: int,
@@ -106,8 +388,28 @@ def main(
     filters: tuple[str, ...],
     ccdid: tuple[int, ...],
     qid: tuple[int, ...],
+    commit_size: int,
+    diff: bool,
+    max_writers: int | None,
+    max_copy_rate: float,
+    max_app_waits: int,
+    max_replication_lag: float,
+    shadow: bool,
+    rollback: bool,
     dry_run: bool,
-    from_files: tuple[Path, ...],
+    from_files: tuple[str, ...],
+    tiles_dir: Path | None,
+    rebuild_tiles: bool,
+    shards_dir: Path | None,
+    rebuild_shards: bool,
+    parquet_dir: Path | None,
+    rebuild_parquet: bool,
+    export_only: bool,
+    maintenance_budget: float,
+    statistics_target: int | None,
+    reindex_bloat: float,
+    rebuild_associations: bool,
+    rebuild_summaries: bool,
 ):
     """Ingest ZTF reference PSF catalog files from IRSA."""
     logging.basicConfig(
@@ -117,45 +419,108 @@ def main(
 
     conninfo = get_conninfo()
 
-    if from_files:
-        total_rows = 0
-        for filepath in from_files:
-            logger.info("Ingesting local file: %s", filepath)
-            count = ingest_local_file(filepath, conninfo)
-            total_rows += count
-        _analyze(conninfo)
-        logger.info(
-            "Done: ingested %d file(s), %d rows total", len(from_files), total_rows
+    if rollback:
+        _swap(conninfo)
+        return
+
+    if rebuild_associations:
+        before = _table_activity(conninfo)
+        _rebuild_associations(conninfo)
+        _maintain(
+            conninfo, before, maintenance_budget, statistics_target, reindex_bloat
         )
         return
 
+    if rebuild_summaries:
+        _rebuild_summaries(conninfo)
+        return
+
+    if export_only:
+        if parquet_dir is None:
+            raise click.UsageError("--export-parquet needs --parquet-dir")
+        _export_parquet(conninfo, parquet_dir, rebuild_parquet)
+        return
+
     fieldids = list(fieldid) if fieldid else _env_ints("INGEST_FIELDID")
     filter_list = list(filters) if filters else _env_strings("INGEST_FILTER")
     ccdids = list(ccdid) if ccdid else _env_ints("INGEST_CCDID")
     qids = list(qid) if qid else _env_ints("INGEST_QID")
-    refs = generate_all_refs(
-        fieldids=fieldids, filters=filter_list, ccdids=ccdids, qids=qids
+    # The shadow catalog replaces the live one whole, it must not be a subset
+    if shadow and (from_files or fieldids or filter_list or ccdids or qids):
+        raise click.UsageError(
+            "--shadow loads the whole catalog from IRSA, it cannot be combined "
+            "with --from-file, --fieldid, --filter, --ccdid, --qid or their "
+            "INGEST_* variables"
+        )
+
+    # Database clock, so that it compares with ingest_metadata.ingested_at
+    started_at = None
+    if tiles_dir is not None and not rebuild_tiles and not dry_run:
+        started_at = _db_now(conninfo)
+    before = None if dry_run or shadow else _table_activity(conninfo)
+
+    # Workers load into the shadow schema, everything else sees the live one
+    run_conninfo = conninfo
+    if shadow and not dry_run:
+        _prepare_shadow(conninfo)
+        run_conninfo = shadow_conninfo(conninfo)
+
+    governor = Governor(
+        conninfo,
+        Throttle(max_writers or workers, max_copy_rate * 1e6),
+        max_app_waits=max_app_waits,
+        max_lag=max_replication_lag,
     )
-    logger.info("Total files to process: %d", len(refs))
 
-    if dry_run:
-        for ref in refs:
-            click.echo(ref.url)
-        return
+    if from_files:
+        paths = expand_local_paths(from_files)
+        logger.info("Total local files to process: %d", len(paths))
+        if dry_run:
+            for path in paths:
+                click.echo(path)
+            return
+        stats, total_rows = _run_batches(
+            process_local_batch,
+            paths,
+            workers,
+            commit_size,
+            run_conninfo,
+            diff,
+            governor,
+        )
+    else:
+        refs = generate_all_refs(
+            fieldids=fieldids, filters=filter_list, ccdids=ccdids, qids=qids
+        )
+        logger.info("Total files to process: %d", len(refs))
 
-    stats = {"ingested": 0, "skipped": 0, "failed": 0}
-    total_rows = 0
+        if dry_run:
+            for ref in refs:
+                click.echo(ref.url)
+            return
 
-    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
-        futures = {executor.submit(process_one, ref, conninfo): ref for ref in refs}
-        for future in as_completed(futures):
-            ref = futures[future]
-            status, count = future.result()
-            stats[status] += 1
-            total_rows += count
+        stats, total_rows = _run_batches(
+            process_batch, refs, workers, commit_size, run_conninfo, diff, governor
+        )
 
-    if stats["ingested"] > 0:
-        _analyze(conninfo)
+    if shadow:
+        if stats["failed"]:
+            raise click.ClickException(
+                f"{stats['failed']} file(s) failed, the catalog built in "
+                f"{SHADOW_SCHEMA} was not swapped in"
+            )
+        _finish_shadow(conninfo)
+    else:
+        _maintain(
+            conninfo, before, maintenance_budget, statistics_target, reindex_bloat
+        )
+    if tiles_dir is not None and (stats["ingested"] > 0 or rebuild_tiles):
+        _build_tiles(conninfo, tiles_dir, started_at)
+    # Shards know which of them are out of date, also from earlier runs
+    if shards_dir is not None:
+        _build_shards(conninfo, shards_dir, rebuild_shards)
+    if parquet_dir is not None:
+        _export_parquet(conninfo, parquet_dir, rebuild_parquet)
 
     logger.info(
         "Done: %d ingested (%d rows), %d skipped, %d failed",
@@ -0,0 +1,180 @@
+"""Link sources of the same star across the filters of a quadrant."""
+
+from __future__ import annotations
+
+import logging
+import math
+
+import numpy as np
+import psycopg
+
+from .discover import FILTER_IDS
+
+logger = logging.getLogger(__name__)
+
+ASSOCIATION_RADIUS_ARCSEC = 1.5
+BANDS = ("zg", "zr", "zi")
+
+ASSOCIATION_COLUMNS = (
+    "fieldid",
+    "ccdid",
+    "qid",
+    "associd",
+    "ra",
+    "dec",
+    "coord",
+    *(f"{band}_sourceid" for band in BANDS),
+)
+
+
+def associate(
+    bands: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]],
+    radius_arcsec: float = ASSOCIATION_RADIUS_ARCSEC,
+) -> list[tuple[float, float, dict[str, int]]]:
+    """Group per-filter sources lying within ``radius_arcsec`` of each other.
+
+    ``bands`` maps a filter name to (sourceid, ra, dec) arrays. Filters are
+    matched in BANDS order: every source is paired one-to-one with the
+    nearest unclaimed group of the earlier filters, closest pairs first, or
+    starts a group of its own. Groups are matched on the position of their
+    first member. Returns (ra, dec, {filter: sourceid}) for each group, with
+    the mean position of its members.
+    """
+    radius = math.radians(radius_arcsec / 3600.0)
+    vectors: list[tuple[float, float, float]] = []
+    members: list[dict[str, int]] = []
+    sums: list[list[float]] = []
+    # Unit vectors on a grid of `radius` cells: the chord between two
+    # points is shorter than their separation, so a match is always in one
+    # of the 27 neighbouring cells, with no trouble at RA 0 or the poles
+    grid: dict[tuple[int, int, int], list[int]] = {}
+
+    for band in BANDS:
+        if band not in bands:
+            continue
+        sourceid, ra, dec = bands[band]
+        points = [_unit_vector(r, d) for r, d in zip(ra, dec)]
+        pairs = []
+        for i, v in enumerate(points):
+            for key in _neighbour_cells(v, radius):
+                for g in grid.get(key, ()):
+                    sep = _angle(v, vectors[g])
+                    if sep <= radius:
+                        pairs.append((sep, i, g))
+
+        matched = [-1] * len(points)
+        claimed = set()
+        for _, i, g in sorted(pairs):
+            if matched[i] < 0 and g not in claimed:
+                matched[i] = g
+                claimed.add(g)
+
+        for i, v in enumerate(points):
+            g = matched[i]
+            if g < 0:
+                g = len(members)
+                vectors.append(v)
+                members.append({})
+                sums.append([0.0, 0.0, 0.0])
+                grid.setdefault(_cell(v, radius), []).append(g)
+            members[g][band] = int(sourceid[i])
+            for k in range(3):
+                sums[g][k] += v[k]
+
+    result = []
+    for (x, y, z), group in zip(sums, members):
+        ra = math.degrees(math.atan2(y, x)) % 360.0
+        dec = math.degrees(math.atan2(z, math.hypot(x, y)))
+        result.append((ra, dec, group))
+    return result
+
+
+def _unit_vector(ra: float, dec: float) -> tuple[float, float, float]:
+    ra, dec = math.radians(ra), math.radians(dec)
+    return (
+        math.cos(dec) * math.cos(ra),
+        math.cos(dec) * math.sin(ra),
+        math.sin(dec),
+    )
+
+
+def _cell(v: tuple[float, float, float], size: float) -> tuple[int, int, int]:
+    return (math.floor(v[0] / size), math.floor(v[1] / size), math.floor(v[2] / size))
+
+
+def _neighbour_cells(v: tuple[float, float, float], size: float):
+    cx, cy, cz = _cell(v, size)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                yield cx + dx, cy + dy, cz + dz
+
+
+def _angle(a: tuple[float, float, float], b: tuple[float, float, float]) -> float:
+    """Angle in radians between unit vectors, accurate at small separations."""
+    chord = math.dist(a, b)
+    return 2.0 * math.asin(min(chord / 2.0, 1.0))
+
+
+def associate_quadrant(
+    conn: psycopg.Connection, fieldid: int, ccdid: int, qid: int
+) -> int:
+    """Rebuild the band associations of one field/ccd/quadrant.
+
+    Must run inside the transaction that loaded the quadrant, so that the
+    associations never disagree with the committed sources. Returns the
+    number of associations written.
+    """
+    # Serialize with concurrent loads of the other filters of this quadrant,
+    # otherwise each would match against a snapshot missing the other
+    conn.execute(
+        "SELECT pg_advisory_xact_lock(%s::integer, %s::integer)",
+        (fieldid, ccdid * 10 + qid),
+    )
+
+    bands = {}
+    for band in BANDS:
+        rows = conn.execute(
+            """
+            SELECT sourceid, degrees(long(coord)), degrees(lat(coord)) FROM refpsfcat
+            WHERE fieldid = %s AND filterid = %s AND ccdid = %s AND qid = %s
+            ORDER BY sourceid
+            """,
+            (fieldid, FILTER_IDS[band], ccdid, qid),
+        ).fetchall()
+        if rows:
+            sourceid, ra, dec = np.array(rows, dtype=np.float64).T
+            bands[band] = (sourceid.astype(np.int64), ra, dec)
+
+    groups = associate(bands)
+
+    conn.execute(
+        "DELETE FROM band_association WHERE fieldid = %s AND ccdid = %s AND qid = %s",
+        (fieldid, ccdid, qid),
+    )
+    with conn.cursor().copy(
+        f"COPY band_association ({', '.join(ASSOCIATION_COLUMNS)}) FROM STDIN"
+    ) as copy:
+        for associd, (ra, dec, group) in enumerate(groups):
+            copy.write_row(
+                (
+                    fieldid,
+                    ccdid,
+                    qid,
+                    associd,
+                    ra,
+                    dec,
+                    f"({math.radians(ra)}, {math.radians(dec)})",
+                    *(group.get(band) for band in BANDS),
+                )
+            )
+
+    logger.info(
+        "Associated %d sources into %d groups for field=%d ccd=%d qid=%d",
+        sum(len(sourceid) for sourceid, _, _ in bands.values()),
+        len(groups),
+        fieldid,
+        ccdid,
+        qid,
+    )
+    return len(groups)
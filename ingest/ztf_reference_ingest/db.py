@@ -3,24 +3,26 @@
 from __future__ import annotations
 
 import logging
+import os
 
 import psycopg
 
-from .discover import FileRef
+from .associate import associate_quadrant
+from .discover import FILTER_IDS, FileRef
 from .fits import ParsedCatalog
+from .moc import add_coverage
+from .summary import summarize, write_summary
 
 logger = logging.getLogger(__name__)
 
 SOURCE_COLUMNS = (
     "fieldid",
-    "filter",
+    "filterid",
     "ccdid",
     "qid",
     "sourceid",
     "xpos",
     "ypos",
-    "ra",
-    "dec",
     "coord",
     "flux",
     "sigflux",
@@ -33,6 +35,102 @@ SOURCE_COLUMNS = (
 )
 
 
+def get_conninfo() -> str:
+    host = os.environ.get("DB_HOST", "sql")
+    dbname = os.environ.get("DB_NAME", "ztfref")
+    user = os.environ.get("DB_USER", "ingest")
+    return f"host={host} dbname={dbname} user={user}"
+
+
+def _copy_sources(conn: psycopg.Connection, table: str, catalog: ParsedCatalog) -> None:
+    with conn.cursor().copy(
+        f"COPY {table} ({', '.join(SOURCE_COLUMNS)}) FROM STDIN"
+    ) as copy:
+        for row in catalog.rows:
+            copy.write_row(row)
+
+
+def _replace_sources(
+    conn: psycopg.Connection, catalog: ParsedCatalog, quadrant: tuple
+) -> None:
+    conn.execute(
+        "DELETE FROM refpsfcat WHERE fieldid = %s AND filterid = %s AND ccdid = %s AND qid = %s",
+        quadrant,
+    )
+    _copy_sources(conn, "refpsfcat", catalog)
+
+
+def diff_sources(
+    conn: psycopg.Connection, catalog: ParsedCatalog, quadrant: tuple
+) -> tuple[int, int, int]:
+    """Apply to a quadrant's stored sources only the rows that differ.
+
+    The catalog is staged in a temporary table, which is not WAL-logged, and
+    compared to the stored rows by sourceid. Returns the number of rows
+    inserted, updated and deleted.
+    """
+    stored = conn.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM refpsfcat
+            WHERE fieldid = %s AND filterid = %s AND ccdid = %s AND qid = %s
+        )
+        """,
+        quadrant,
+    ).fetchone()[0]
+    if not stored:
+        _copy_sources(conn, "refpsfcat", catalog)
+        return len(catalog.rows), 0, 0
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS refpsfcat_stage (LIKE refpsfcat)")
+    conn.execute("TRUNCATE refpsfcat_stage")
+    _copy_sources(conn, "refpsfcat_stage", catalog)
+
+    deleted = conn.execute(
+        """
+        DELETE FROM refpsfcat r
+        WHERE (r.fieldid, r.filterid, r.ccdid, r.qid) = (%s, %s, %s, %s)
+          AND NOT EXISTS (
+              SELECT 1 FROM refpsfcat_stage s WHERE s.sourceid = r.sourceid
+          )
+        """,
+        quadrant,
+    ).rowcount
+    # coord is compared through its float8 components, spoint equality has
+    # a tolerance
+    updated = conn.execute(
+        """
+        UPDATE refpsfcat r
+        SET coord = s.coord, xpos = s.xpos, ypos = s.ypos, flux = s.flux,
+            sigflux = s.sigflux, mag = s.mag, sigmag = s.sigmag, snr = s.snr,
+            chi = s.chi, sharp = s.sharp, flags = s.flags
+        FROM refpsfcat_stage s
+        WHERE (r.fieldid, r.filterid, r.ccdid, r.qid) = (%s, %s, %s, %s)
+          AND r.sourceid = s.sourceid
+          AND (long(r.coord), lat(r.coord), r.xpos, r.ypos, r.flux, r.sigflux,
+               r.mag, r.sigmag, r.snr, r.chi, r.sharp, r.flags)
+              IS DISTINCT FROM
+              (long(s.coord), lat(s.coord), s.xpos, s.ypos, s.flux, s.sigflux,
+               s.mag, s.sigmag, s.snr, s.chi, s.sharp, s.flags)
+        """,
+        quadrant,
+    ).rowcount
+    inserted = conn.execute(
+        f"""
+        INSERT INTO refpsfcat ({", ".join(SOURCE_COLUMNS)})
+        SELECT {", ".join(SOURCE_COLUMNS)} FROM refpsfcat_stage s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM refpsfcat r
+            WHERE (r.fieldid, r.filterid, r.ccdid, r.qid) = (%s, %s, %s, %s)
+              AND r.sourceid = s.sourceid
+        )
+        """,
+        quadrant,
+    ).rowcount
+    conn.execute("TRUNCATE refpsfcat_stage")
+    return inserted, updated, deleted
+
+
 def ingest_catalog(
     conn: psycopg.Connection,
     catalog: ParsedCatalog,
@@ -40,13 +138,19 @@ def ingest_catalog(
     etag: str | None = None,
     last_modified: str | None = None,
     content_length: int | None = None,
+    diff: bool = False,
 ) -> int:
     """Ingest a parsed catalog into the database within a single transaction.
 
-    Returns the number of rows inserted.
+    The cross-band associations, the summary and the sky coverage of the
+    quadrant are updated in the same transaction. With ``diff``, only the
+    sources that changed are written (see ``diff_sources``), and the
+    associations and coverage are left alone when none did. Returns the
+    number of rows inserted, or inserted and updated with ``diff``.
     """
+    quadrant = (ref.fieldid, FILTER_IDS[ref.filter], ref.ccdid, ref.qid)
     with conn.transaction():
-        # Upsert quadrant-level header data
+        # Upsert quadrant-level header data, leaving the row alone if unchanged
         conn.execute(
             """
             INSERT INTO quadrant (fieldid, filter, ccdid, qid, magzp, magzp_rms, magzp_unc, infobits)
@@ -56,6 +160,9 @@ def ingest_catalog(
                           magzp_rms = EXCLUDED.magzp_rms,
                           magzp_unc = EXCLUDED.magzp_unc,
                           infobits = EXCLUDED.infobits
+            WHERE (quadrant.magzp, quadrant.magzp_rms, quadrant.magzp_unc, quadrant.infobits)
+                  IS DISTINCT FROM
+                  (EXCLUDED.magzp, EXCLUDED.magzp_rms, EXCLUDED.magzp_unc, EXCLUDED.infobits)
             """,
             (
                 ref.fieldid,
@@ -69,17 +176,41 @@ def ingest_catalog(
             ),
         )
 
-        # Replace source rows for this quadrant
-        conn.execute(
-            "DELETE FROM refpsfcat WHERE fieldid = %s AND filter = %s AND ccdid = %s AND qid = %s",
-            (ref.fieldid, ref.filter, ref.ccdid, ref.qid),
-        )
+        if diff:
+            inserted, updated, deleted = diff_sources(conn, catalog, quadrant)
+            count = inserted + updated
+            sources_changed = count + deleted > 0
+            logger.info(
+                "Diff for field=%d filter=%s ccd=%d qid=%d: "
+                "%d inserted, %d updated, %d deleted",
+                ref.fieldid,
+                ref.filter,
+                ref.ccdid,
+                ref.qid,
+                inserted,
+                updated,
+                deleted,
+            )
+        else:
+            _replace_sources(conn, catalog, quadrant)
+            count = len(catalog.rows)
+            sources_changed = True
+
+        if sources_changed:
+            associate_quadrant(conn, ref.fieldid, ref.ccdid, ref.qid)
 
-        with conn.cursor().copy(
-            f"COPY refpsfcat ({', '.join(SOURCE_COLUMNS)}) FROM STDIN"
-        ) as copy:
-            for row in catalog.rows:
-                copy.write_row(row)
+        write_summary(
+            conn,
+            ref.fieldid,
+            ref.filter,
+            ref.ccdid,
+            ref.qid,
+            summarize(
+                catalog.mag + catalog.magzp, catalog.sigmag, catalog.ra, catalog.dec
+            ),
+        )
+        if sources_changed:
+            add_coverage(conn, ref.filter, catalog.ra, catalog.dec)
 
         # Update ingest metadata
         conn.execute(
@@ -105,10 +236,49 @@ def ingest_catalog(
 
     logger.info(
         "Ingested %d rows for field=%d filter=%s ccd=%d qid=%d",
-        len(catalog.rows),
+        count,
         ref.fieldid,
         ref.filter,
         ref.ccdid,
         ref.qid,
     )
-    return len(catalog.rows)
+    return count
+
+
+def ingest_catalogs(
+    conn: psycopg.Connection,
+    items: list[tuple[ParsedCatalog, FileRef, dict]],
+    diff: bool = False,
+) -> list[int | None]:
+    """Ingest several catalogs in a single transaction.
+
+    ``items`` are (catalog, ref, download metadata) tuples. Each catalog
+    loads in its own savepoint, so a failing one does not take the others
+    down; failures (such as deadlocks with concurrent loads of neighbouring
+    quadrants) are retried alone after the commit. Returns the rows
+    inserted per catalog, None where it failed. Raises if the transaction
+    itself fails, in which case nothing was ingested.
+    """
+    counts: list[int | None] = [None] * len(items)
+    retry = []
+    with conn.transaction():
+        for i, (catalog, ref, metadata) in enumerate(items):
+            try:
+                counts[i] = ingest_catalog(conn, catalog, ref, **metadata, diff=diff)
+            except Exception:
+                if conn.broken or len(items) == 1:
+                    raise
+                logger.warning(
+                    "Failed to ingest %s, will retry", ref.path, exc_info=True
+                )
+                retry.append(i)
+
+    for i in retry:
+        catalog, ref, metadata = items[i]
+        try:
+            counts[i] = ingest_catalog(conn, catalog, ref, **metadata, diff=diff)
+        except Exception:
+            logger.exception("Failed to ingest %s", ref.path)
+            if conn.broken:
+                break
+    return counts
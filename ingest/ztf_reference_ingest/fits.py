@@ -23,6 +23,11 @@ class ParsedCatalog:
     magzp_unc: float
     infobits: int
     rows: list[tuple]
+    # Positions in degrees, the rows only carry the spoint
+    ra: np.ndarray
+    dec: np.ndarray
+    mag: np.ndarray
+    sigmag: np.ndarray
 
 
 def parse_fits(source: Path | bytes) -> ParsedCatalog:
@@ -69,14 +74,12 @@ def parse_fits(source: Path | bytes) -> ParsedCatalog:
         rows = [
             (
                 fieldid,
-                filt,
+                filterid,
                 ccdid,
                 qid,
                 int(sourceids[i]),
                 float(xpos[i]),
                 float(ypos[i]),
-                float(ra[i]),
-                float(dec[i]),
                 f"({ra_rad[i]}, {dec_rad[i]})",
                 float(flux[i]),
                 float(sigflux[i]),
@@ -100,4 +103,8 @@ def parse_fits(source: Path | bytes) -> ParsedCatalog:
         magzp_unc=magzp_unc,
         infobits=infobits,
         rows=rows,
+        ra=ra,
+        dec=dec,
+        mag=mag,
+        sigmag=sigmag,
     )
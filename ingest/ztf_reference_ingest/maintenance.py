@@ -0,0 +1,255 @@
+"""VACUUM, ANALYZE and REINDEX after an ingest run, only where it is needed.
+
+``ingest_catalog`` replaces a quadrant with DELETE + COPY, so a re-ingest
+leaves as many dead tuples as it loads rows. Instead of analyzing whole
+tables after every run and leaving the dead tuples to autovacuum, the
+tables are picked from the counters PostgreSQL keeps for them, the most
+churned first, and work stops being started once the time budget is spent.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from dataclasses import dataclass
+
+import psycopg
+from psycopg import errors, sql
+
+logger = logging.getLogger(__name__)
+
+# Tables written by ingest, and their GiST indexes, which fill up less well
+# with piecemeal deletes and inserts than B-trees do
+TABLES = (
+    "refpsfcat",
+    "band_association",
+    "quadrant",
+    "quadrant_summary",
+    "coverage",
+    "ingest_metadata",
+)
+GIST_INDEXES = {
+    "refpsfcat": ("idx_refpsfcat_coord",),
+    "band_association": ("idx_band_association_coord",),
+}
+
+# Free space a freshly built GiST index leaves on its pages, from its
+# fillfactor (90 unless set on the index); bloat is counted beyond it
+DEFAULT_GIST_FILLFACTOR = 90
+
+# Index bytes REINDEX CONCURRENTLY is taken to build per second, on the low
+# side, to tell whether a rebuild fits in the budget left
+REINDEX_BYTES_PER_SECOND = 16 << 20
+
+# Fraction of a table's live rows that must be dead, or modified since the
+# last ANALYZE, for it to be vacuumed or analyzed
+VACUUM_THRESHOLD = 0.05
+ANALYZE_THRESHOLD = 0.05
+
+ACTIVITY_QUERY = """
+    SELECT relname, n_tup_ins + n_tup_upd + n_tup_del,
+           n_live_tup, n_dead_tup, n_mod_since_analyze
+    FROM pg_stat_user_tables
+    WHERE schemaname = 'public' AND relname = ANY(%s)
+"""
+
+BLOAT_QUERY = """
+    SELECT s.table_len, s.free_space + s.dead_tuple_len,
+           coalesce((SELECT option_value::integer
+                     FROM pg_options_to_table(c.reloptions)
+                     WHERE option_name = 'fillfactor'), %s)
+    FROM pgstattuple(%s::regclass) s, pg_class c
+    WHERE c.oid = %s::regclass
+"""
+
+
+@dataclass
+class TableActivity:
+    changed: int  # rows inserted, updated or deleted since the stats reset
+    live: int
+    dead: int
+    modified_since_analyze: int
+
+
+@dataclass
+class Task:
+    table: str
+    vacuum: bool
+    analyze: bool
+    priority: float
+
+
+def table_activity(conn: psycopg.Connection) -> dict[str, TableActivity]:
+    """Current statistics counters of the ingest tables."""
+    rows = conn.execute(ACTIVITY_QUERY, (list(TABLES),)).fetchall()
+    return {name: TableActivity(*values) for name, *values in rows}
+
+
+def churn(
+    before: dict[str, TableActivity] | None, after: dict[str, TableActivity]
+) -> dict[str, int]:
+    """Rows inserted, updated or deleted per table between two snapshots."""
+    if before is None:
+        return {}
+    return {
+        # The counters go back to zero if the statistics are reset meanwhile
+        table: max(a.changed - before[table].changed, 0)
+        if table in before
+        else a.changed
+        for table, a in after.items()
+    }
+
+
+def plan(
+    activity: dict[str, TableActivity],
+    vacuum_threshold: float = VACUUM_THRESHOLD,
+    analyze_threshold: float = ANALYZE_THRESHOLD,
+) -> list[Task]:
+    """Tables to vacuum and/or analyze, the most out of date first."""
+    tasks = []
+    for table, a in activity.items():
+        live = max(a.live, 1)
+        vacuum = a.dead > 0 and a.dead >= vacuum_threshold * live
+        analyze = (
+            a.modified_since_analyze > 0
+            and a.modified_since_analyze >= analyze_threshold * live
+        )
+        if vacuum or analyze:
+            priority = max(a.dead, a.modified_since_analyze) / live
+            tasks.append(Task(table, vacuum, analyze, priority))
+    return sorted(tasks, key=lambda t: t.priority, reverse=True)
+
+
+def bloat_fraction(size: int, wasted: int, fillfactor: int) -> float:
+    """Fraction of an index's ``size`` bytes free or dead beyond the free
+    space a fresh build with ``fillfactor`` leaves."""
+    if not size:
+        return 0.0
+    return max(wasted / size - (100 - fillfactor) / 100, 0.0)
+
+
+def index_bloat(conn: psycopg.Connection, index: str) -> tuple[float, int]:
+    """Bloat of an index, from pgstattuple, and its size in bytes."""
+    size, wasted, fillfactor = conn.execute(
+        BLOAT_QUERY, (DEFAULT_GIST_FILLFACTOR, index, index)
+    ).fetchone()
+    return bloat_fraction(size, wasted, fillfactor), size
+
+
+def rebuild_seconds(size: int) -> float:
+    """Rough duration of a REINDEX CONCURRENTLY of an index of ``size`` bytes."""
+    return size / REINDEX_BYTES_PER_SECOND
+
+
+def _set_timeout(conn: psycopg.Connection, seconds: float | None) -> None:
+    ms = 0 if seconds is None else max(int(seconds * 1000), 1)
+    conn.execute(sql.SQL("SET statement_timeout = {}").format(sql.Literal(ms)))
+
+
+def run_maintenance(
+    conn: psycopg.Connection,
+    before: dict[str, TableActivity] | None,
+    budget: float,
+    statistics_target: int | None = None,
+    reindex_bloat: float = 0.5,
+) -> None:
+    """Vacuum and analyze the tables that need it, then check GiST indexes.
+
+    ``before`` is ``table_activity()`` from the start of the run, to report
+    its churn and pick the indexes to check; None checks every index.
+    Statements are cancelled at the end of ``budget`` seconds, except
+    REINDEX CONCURRENTLY, which is only started if its estimated duration
+    fits in the budget left since cancelling it leaves an invalid index
+    behind. ``statistics_target``
+    caps the ANALYZE sample (300 rows per unit) of columns without their own.
+    """
+    deadline = time.monotonic() + budget
+    activity = table_activity(conn)
+    churned = churn(before, activity)
+    for table in TABLES:
+        if churned.get(table):
+            logger.info("Rows churned in %s: %d", table, churned[table])
+
+    if statistics_target is not None:
+        conn.execute(
+            sql.SQL("SET default_statistics_target = {}").format(
+                sql.Literal(statistics_target)
+            )
+        )
+
+    vacuumed = set()
+    tasks = plan(activity)
+    for n, task in enumerate(tasks):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning(
+                "Maintenance budget spent, left for next run: %s",
+                ", ".join(t.table for t in tasks[n:]),
+            )
+            break
+        if task.vacuum:
+            options = sql.SQL("(ANALYZE) ") if task.analyze else sql.SQL("")
+            query = sql.SQL("VACUUM {}{}").format(options, sql.Identifier(task.table))
+        else:
+            query = sql.SQL("ANALYZE {}").format(sql.Identifier(task.table))
+        started = time.monotonic()
+        _set_timeout(conn, remaining)
+        try:
+            conn.execute(query)
+        except errors.QueryCanceled:
+            logger.warning("Maintenance budget spent during %s", query.as_string(conn))
+            break
+        logger.info("%s took %.1fs", query.as_string(conn), time.monotonic() - started)
+        if task.vacuum:
+            vacuumed.add(task.table)
+
+    for table, indexes in GIST_INDEXES.items():
+        if before is not None and not churned.get(table) and table not in vacuumed:
+            continue
+        for index in indexes:
+            if not _check_index(conn, index, deadline, reindex_bloat):
+                break
+
+    _set_timeout(conn, None)
+    if statistics_target is not None:
+        conn.execute("RESET default_statistics_target")
+
+
+def _check_index(
+    conn: psycopg.Connection, index: str, deadline: float, reindex_bloat: float
+) -> bool:
+    """Report an index's bloat and rebuild it past ``reindex_bloat``.
+
+    Returns False if bloat cannot be measured at all.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        logger.warning("Maintenance budget spent, %s not checked", index)
+        return True
+    _set_timeout(conn, remaining)
+    try:
+        bloat, size = index_bloat(conn, index)
+    except errors.QueryCanceled:
+        logger.warning("Maintenance budget spent while measuring %s", index)
+        return True
+    except errors.UndefinedFunction:
+        logger.warning("pgstattuple is not installed, index bloat not checked")
+        return False
+    logger.info("Index %s: %.0f%% bloat", index, bloat * 100)
+    if bloat < reindex_bloat:
+        return True
+    remaining = deadline - time.monotonic()
+    if rebuild_seconds(size) > remaining:
+        logger.warning(
+            "%s needs a REINDEX of about %.0fs, more than the %.0fs of budget "
+            "left; left for next run",
+            index,
+            rebuild_seconds(size),
+            max(remaining, 0.0),
+        )
+        return True
+    _set_timeout(conn, None)
+    started = time.monotonic()
+    conn.execute(sql.SQL("REINDEX INDEX CONCURRENTLY {}").format(sql.Identifier(index)))
+    logger.info("Reindexed %s in %.1fs", index, time.monotonic() - started)
+    return True
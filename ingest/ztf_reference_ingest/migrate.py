@@ -0,0 +1,399 @@
+"""Convert refpsfcat to the current layout without taking the API down.
+
+Run as the database owner while the old services keep running:
+
+    DB_USER=ztfref python -m ztf_reference_ingest.migrate
+
+Sources are copied into ``refpsfcat_compact`` one quadrant per transaction,
+so the old table stays readable and writable throughout. Quadrants that are
+re-ingested meanwhile are copied again. A final transaction blocks ingestion
+(not reads), copies what is still stale and swaps the tables; only the swap
+itself briefly blocks readers. Deploy the new app and ingest images right
+after: the old ones cannot write to, or efficiently filter, the new table.
+An interrupted run resumes where it stopped.
+
+The indexes added since, on the object ID and on pixel positions, are then
+built concurrently, so that ingestion goes on meanwhile, the object ID is
+added to refpsfcat_full and xmatch_job gets its heartbeat and attempt
+columns, and the app the right to delete expired jobs. Deploy
+the new app image after them: the old one keeps working with them, the new
+one needs them.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+
+import click
+import psycopg
+from psycopg import errors
+
+from .db import get_conninfo
+from .discover import FILTER_IDS
+
+logger = logging.getLogger(__name__)
+
+SWAP_ATTEMPTS = 10
+
+PREPARE_SQL = """
+    ALTER TABLE quadrant ADD COLUMN IF NOT EXISTS filterid smallint NOT NULL
+        GENERATED ALWAYS AS (
+            CASE filter WHEN 'zg' THEN 1 WHEN 'zr' THEN 2 WHEN 'zi' THEN 3 END
+        ) STORED;
+
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conrelid = 'public.quadrant'::regclass
+              AND conname = 'quadrant_fieldid_filterid_ccdid_qid_key'
+        ) THEN
+            ALTER TABLE quadrant ADD CONSTRAINT quadrant_fieldid_filterid_ccdid_qid_key
+                UNIQUE (fieldid, filterid, ccdid, qid);
+        END IF;
+    END
+    $$;
+
+    CREATE TABLE IF NOT EXISTS refpsfcat_compact (
+        coord       spoint   NOT NULL,
+        fieldid     integer  NOT NULL,
+        sourceid    integer  NOT NULL,
+        xpos        real     NOT NULL,
+        ypos        real     NOT NULL,
+        flux        real     NOT NULL,
+        sigflux     real     NOT NULL,
+        mag         real     NOT NULL,
+        sigmag      real     NOT NULL,
+        snr         real     NOT NULL,
+        chi         real     NOT NULL,
+        sharp       real     NOT NULL,
+        filterid    smallint NOT NULL,
+        ccdid       smallint NOT NULL,
+        qid         smallint NOT NULL,
+        flags       smallint NOT NULL,
+        CONSTRAINT refpsfcat_compact_pkey
+            PRIMARY KEY (fieldid, filterid, ccdid, qid, sourceid),
+        CONSTRAINT refpsfcat_compact_quadrant_fkey
+            FOREIGN KEY (fieldid, filterid, ccdid, qid)
+            REFERENCES quadrant (fieldid, filterid, ccdid, qid)
+    );
+
+    -- The ingested_at of each quadrant as of its copy
+    CREATE TABLE IF NOT EXISTS refpsfcat_migration (
+        fieldid     integer    NOT NULL,
+        filter      varchar(2) NOT NULL,
+        ccdid       smallint   NOT NULL,
+        qid         smallint   NOT NULL,
+        ingested_at timestamptz,
+        PRIMARY KEY (fieldid, filter, ccdid, qid)
+    );
+"""
+
+STALE_QUADRANTS_SQL = """
+    SELECT q.fieldid, q.filter, q.ccdid, q.qid
+    FROM quadrant q
+    LEFT JOIN refpsfcat_migration m USING (fieldid, filter, ccdid, qid)
+    LEFT JOIN ingest_metadata i USING (fieldid, filter, ccdid, qid)
+    WHERE m.fieldid IS NULL OR i.ingested_at IS DISTINCT FROM m.ingested_at
+    ORDER BY q.fieldid, q.filter, q.ccdid, q.qid
+"""
+
+SWAP_SQL = """
+    DROP VIEW refpsfcat_full;
+    DROP TABLE refpsfcat;
+    ALTER TABLE refpsfcat_compact RENAME TO refpsfcat;
+    ALTER TABLE refpsfcat RENAME CONSTRAINT refpsfcat_compact_pkey TO refpsfcat_pkey;
+    ALTER TABLE refpsfcat RENAME CONSTRAINT refpsfcat_compact_quadrant_fkey
+        TO refpsfcat_fieldid_filterid_ccdid_qid_fkey;
+    ALTER INDEX idx_refpsfcat_compact_coord RENAME TO idx_refpsfcat_coord;
+
+    CREATE VIEW refpsfcat_full AS
+    SELECT r.fieldid,
+           (CASE r.filterid WHEN 1 THEN 'zg' WHEN 2 THEN 'zr' WHEN 3 THEN 'zi' END)::varchar(2)
+               AS filter,
+           r.filterid, r.ccdid, r.qid, r.sourceid,
+           r.xpos, r.ypos, degrees(long(r.coord)) AS ra, degrees(lat(r.coord)) AS dec, r.coord,
+           r.flux, r.sigflux, r.mag, r.sigmag, r.snr, r.chi, r.sharp, r.flags,
+           q.magzp, q.magzp_rms, q.magzp_unc, q.infobits
+    FROM refpsfcat r
+    LEFT JOIN quadrant q USING (fieldid, filterid, ccdid, qid);
+
+    GRANT SELECT ON refpsfcat TO app;
+    GRANT SELECT ON refpsfcat_full TO app;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON refpsfcat TO ingest;
+    GRANT SELECT ON refpsfcat_full TO ingest;
+    GRANT MAINTAIN ON refpsfcat TO ingest;
+
+    DROP TABLE refpsfcat_migration;
+"""
+
+
+# The object ID as a bigint, see idx_refpsfcat_oid in the schema; the view
+# must compute it with the same expression for the index to be used
+OBJECT_ID_SQL = (
+    "(((fieldid::bigint * 10 + filterid) * 100 + ccdid) * 10 + qid) * 100000000"
+    " + sourceid"
+)
+
+OBJECT_ID_VIEW_SQL = """
+    CREATE OR REPLACE VIEW refpsfcat_full AS
+    SELECT r.fieldid,
+           (CASE r.filterid WHEN 1 THEN 'zg' WHEN 2 THEN 'zr' WHEN 3 THEN 'zi' END)::varchar(2)
+               AS filter,
+           r.filterid, r.ccdid, r.qid, r.sourceid,
+           r.xpos, r.ypos, degrees(long(r.coord)) AS ra, degrees(lat(r.coord)) AS dec, r.coord,
+           r.flux, r.sigflux, r.mag, r.sigmag, r.snr, r.chi, r.sharp, r.flags,
+           q.magzp, q.magzp_rms, q.magzp_unc, q.infobits,
+           (((r.fieldid::bigint * 10 + r.filterid) * 100 + r.ccdid) * 10 + r.qid) * 100000000
+               + r.sourceid AS oid
+    FROM refpsfcat r
+    LEFT JOIN quadrant q USING (fieldid, filterid, ccdid, qid);
+
+    CREATE OR REPLACE FUNCTION prewarm_catalog() RETURNS bigint
+    LANGUAGE sql SECURITY DEFINER SET search_path = public, pg_temp
+    AS $$
+        SELECT coalesce(sum(pg_prewarm(rel)), 0)
+        FROM unnest(ARRAY[
+            'quadrant', 'quadrant_pkey', 'quadrant_fieldid_filterid_ccdid_qid_key',
+            'refpsfcat_pkey', 'idx_refpsfcat_coord', 'idx_refpsfcat_oid',
+            'band_association_pkey', 'idx_band_association_coord'
+        ]::regclass[]) AS rel
+    $$;
+"""
+
+
+def is_migrated(conn: psycopg.Connection) -> bool:
+    # The shadow catalog has its own refpsfcat, always of the current layout
+    return (
+        conn.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'refpsfcat'
+              AND column_name = 'filterid'
+            """
+        ).fetchone()
+        is not None
+    )
+
+
+def copy_quadrant(
+    conn: psycopg.Connection, fieldid: int, filt: str, ccdid: int, qid: int
+) -> int:
+    """Replace the compact copy of one quadrant, returning the rows copied."""
+    key = {"fieldid": fieldid, "filter": filt, "ccdid": ccdid, "qid": qid}
+    with conn.transaction():
+        # Ingestion updates the quadrant row before touching its sources, so
+        # this waits for a load in progress and holds off new ones until the
+        # copy and its ingested_at are committed together
+        conn.execute(
+            """
+            SELECT 1 FROM quadrant
+            WHERE fieldid = %(fieldid)s AND filter = %(filter)s
+              AND ccdid = %(ccdid)s AND qid = %(qid)s
+            FOR SHARE
+            """,
+            key,
+        )
+        conn.execute(
+            """
+            DELETE FROM refpsfcat_compact
+            WHERE fieldid = %(fieldid)s AND filterid = %(filterid)s
+              AND ccdid = %(ccdid)s AND qid = %(qid)s
+            """,
+            {**key, "filterid": FILTER_IDS[filt]},
+        )
+        count = conn.execute(
+            """
+            INSERT INTO refpsfcat_compact (coord, fieldid, sourceid, xpos, ypos,
+                                           flux, sigflux, mag, sigmag, snr, chi, sharp,
+                                           filterid, ccdid, qid, flags)
+            SELECT coord, fieldid, sourceid, xpos, ypos,
+                   flux, sigflux, mag, sigmag, snr, chi, sharp,
+                   %(filterid)s, ccdid, qid, flags
+            FROM refpsfcat
+            WHERE fieldid = %(fieldid)s AND filter = %(filter)s
+              AND ccdid = %(ccdid)s AND qid = %(qid)s
+            """,
+            {**key, "filterid": FILTER_IDS[filt]},
+        ).rowcount
+        conn.execute(
+            """
+            INSERT INTO refpsfcat_migration (fieldid, filter, ccdid, qid, ingested_at)
+            SELECT %(fieldid)s, %(filter)s, %(ccdid)s, %(qid)s,
+                   (SELECT ingested_at FROM ingest_metadata
+                    WHERE fieldid = %(fieldid)s AND filter = %(filter)s
+                      AND ccdid = %(ccdid)s AND qid = %(qid)s)
+            ON CONFLICT (fieldid, filter, ccdid, qid)
+            DO UPDATE SET ingested_at = EXCLUDED.ingested_at
+            """,
+            key,
+        )
+    return count
+
+
+def copy_stale(conn: psycopg.Connection) -> int:
+    """Copy every quadrant that is new or re-ingested since its last copy."""
+    stale = conn.execute(STALE_QUADRANTS_SQL).fetchall()
+    total = 0
+    for i, (fieldid, filt, ccdid, qid) in enumerate(stale, 1):
+        total += copy_quadrant(conn, fieldid, filt, ccdid, qid)
+        if i % 100 == 0 or i == len(stale):
+            logger.info("Copied %d/%d quadrants, %d rows", i, len(stale), total)
+    return len(stale)
+
+
+def swap(conn: psycopg.Connection) -> None:
+    """Catch up with the last loads and replace refpsfcat in one transaction."""
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        try:
+            with conn.transaction():
+                # Don't queue up readers behind a lock that we can't get soon
+                conn.execute("SET LOCAL lock_timeout = '5s'")
+                # Blocks ingestion, still allows reads
+                conn.execute("LOCK TABLE quadrant IN SHARE MODE")
+                copy_stale(conn)
+                conn.execute(SWAP_SQL)
+            return
+        except errors.LockNotAvailable:
+            logger.warning(
+                "Swap attempt %d/%d timed out on a lock", attempt, SWAP_ATTEMPTS
+            )
+            time.sleep(attempt)
+    raise click.ClickException(
+        "Could not lock the tables for the swap, try again later"
+    )
+
+
+def _sizes(conn: psycopg.Connection, table: str) -> tuple[int, int, float]:
+    """Heap bytes, index bytes and heap bytes per row of a table."""
+    heap, indexes, rows = conn.execute(
+        """
+        SELECT pg_table_size(c.oid), pg_indexes_size(c.oid), c.reltuples
+        FROM pg_class c WHERE c.oid = %s::regclass
+        """,
+        (table,),
+    ).fetchone()
+    return heap, indexes, heap / rows if rows > 0 else 0.0
+
+
+def compact(conn: psycopg.Connection) -> None:
+    """Copy refpsfcat into the compact layout and swap it in."""
+    conn.execute(PREPARE_SQL)
+    before = _sizes(conn, "refpsfcat")
+
+    # Bulk copy, then catch up with quadrants loaded in the meantime
+    # until few enough are left to copy while ingestion is blocked
+    while copy_stale(conn) > 10:
+        pass
+
+    logger.info("Building the coordinate index")
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_refpsfcat_compact_coord
+        ON refpsfcat_compact USING GIST (coord)
+        """
+    )
+    conn.execute("ANALYZE refpsfcat_compact")
+    after = _sizes(conn, "refpsfcat_compact")
+
+    swap(conn)
+    conn.execute("ANALYZE quadrant")
+
+    logger.info(
+        "Compacted: heap %.1f -> %.1f GiB (%.0f -> %.0f bytes/row), "
+        "indexes %.1f -> %.1f GiB",
+        before[0] / 1024**3,
+        after[0] / 1024**3,
+        before[2],
+        after[2],
+        before[1] / 1024**3,
+        after[1] / 1024**3,
+    )
+
+
+def _index_concurrently(conn: psycopg.Connection, name: str, definition: str) -> None:
+    """Build index ``name`` of refpsfcat without blocking ingestion, unless it
+    is already there. ``definition`` follows CREATE [UNIQUE] INDEX."""
+    valid = conn.execute(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,)
+    ).fetchone()
+    if valid is not None and valid[0]:
+        return
+    if valid is not None:
+        # Left behind by an interrupted build
+        conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+    logger.info("Building %s", name)
+    conn.execute(f"CREATE {definition.replace('INDEX', 'INDEX CONCURRENTLY', 1)}")
+
+
+def add_object_ids(conn: psycopg.Connection) -> None:
+    """Index the numeric object IDs, then add them to refpsfcat_full and to
+    the prewarmed indexes."""
+    _index_concurrently(
+        conn,
+        "idx_refpsfcat_oid",
+        f"UNIQUE INDEX idx_refpsfcat_oid ON refpsfcat (({OBJECT_ID_SQL}))",
+    )
+    with conn.transaction():
+        conn.execute("SET LOCAL lock_timeout = '5s'")
+        conn.execute(OBJECT_ID_VIEW_SQL)
+    logger.info("refpsfcat_full has object IDs")
+
+
+def add_pixel_index(conn: psycopg.Connection) -> None:
+    """Index the sources by pixel position within their quadrant."""
+    conn.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    _index_concurrently(
+        conn,
+        "idx_refpsfcat_pixel",
+        "INDEX idx_refpsfcat_pixel ON refpsfcat"
+        " USING GIST (fieldid, filterid, ccdid, qid, point(xpos, ypos))",
+    )
+
+
+def add_job_heartbeats(conn: psycopg.Connection) -> None:
+    """Add the column the app's cross-match workers keep their jobs alive in."""
+    with conn.transaction():
+        conn.execute("SET LOCAL lock_timeout = '5s'")
+        conn.execute(
+            "ALTER TABLE xmatch_job ADD COLUMN IF NOT EXISTS heartbeat_at timestamptz"
+        )
+
+
+def add_job_attempts(conn: psycopg.Connection) -> None:
+    """Add the column telling a job's current worker from a stale one, and
+    let the app delete the jobs it keeps no longer."""
+    with conn.transaction():
+        conn.execute("SET LOCAL lock_timeout = '5s'")
+        conn.execute(
+            "ALTER TABLE xmatch_job"
+            " ADD COLUMN IF NOT EXISTS attempt integer NOT NULL DEFAULT 0"
+        )
+        conn.execute("GRANT DELETE ON xmatch_job TO app")
+
+
+@click.command()
+def main():
+    """Move refpsfcat to the current storage layout."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+    conn = psycopg.connect(get_conninfo(), autocommit=True)
+    try:
+        if is_migrated(conn):
+            logger.info("refpsfcat already uses the compact layout")
+        else:
+            compact(conn)
+        add_object_ids(conn)
+        add_pixel_index(conn)
+        add_job_heartbeats(conn)
+        add_job_attempts(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
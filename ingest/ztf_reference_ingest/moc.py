@@ -0,0 +1,107 @@
+"""Multi-Order Coverage map of each filter, used by the API to skip queries
+on sky without sources.
+
+The coverage is kept as sorted, disjoint ``[start, end)`` ranges of nested
+HEALPix pixels at MOC_ORDER, the cells holding at least one source. It is
+stored split by the pixel at CHUNK_ORDER it falls in, so loading a quadrant
+only rewrites the few rows of the sky it touches. Coverage only grows:
+re-ingesting a quadrant never removes cells.
+"""
+
+from __future__ import annotations
+
+import astropy.units as u
+import numpy as np
+import psycopg
+from astropy_healpix import HEALPix
+
+from .discover import FILTER_IDS
+
+MOC_ORDER = 11
+CHUNK_ORDER = 3
+CHUNK_SHIFT = 2 * (MOC_ORDER - CHUNK_ORDER)
+
+
+def cells(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """Sorted, unique MOC_ORDER pixels holding the given positions (deg)."""
+    hp = HEALPix(nside=2**MOC_ORDER, order="nested")
+    return np.unique(hp.lonlat_to_healpix(ra * u.deg, dec * u.deg)).astype(np.int64)
+
+
+def cells_to_ranges(pixels: np.ndarray) -> np.ndarray:
+    """Runs of consecutive pixels of a sorted, unique array as (n, 2) ranges."""
+    if not len(pixels):
+        return np.empty((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(pixels) != 1) + 1
+    starts = pixels[np.r_[0, breaks]]
+    ends = pixels[np.r_[breaks - 1, len(pixels) - 1]] + 1
+    return np.stack([starts, ends], axis=1)
+
+
+# Copied as ztf_reference.coverage.union_ranges, the app and ingest share no
+# code; tests/fixtures/union_ranges.json holds the cases both are tested on
+def union_ranges(*ranges: np.ndarray) -> np.ndarray:
+    """Merge (n, 2) range arrays into sorted, disjoint, non-adjacent ranges."""
+    r = np.concatenate(
+        [np.empty((0, 2), dtype=np.int64)]
+        + [np.asarray(x, dtype=np.int64).reshape(-1, 2) for x in ranges]
+    )
+    if not len(r):
+        return r
+    r = r[np.argsort(r[:, 0], kind="stable")]
+    ends = np.maximum.accumulate(r[:, 1])
+    first = np.r_[True, r[1:, 0] > ends[:-1]]
+    idx = np.flatnonzero(first)
+    return np.stack([r[idx, 0], ends[np.r_[idx[1:] - 1, len(r) - 1]]], axis=1)
+
+
+def add_coverage(
+    conn: psycopg.Connection, filt: str, ra: np.ndarray, dec: np.ndarray
+) -> int:
+    """Merge the cells of the given sources into the coverage of a filter.
+
+    Meant to run in the transaction that loads them, so the API never sees
+    sources outside the coverage. Returns the number of chunks changed.
+    """
+    pixels = cells(ra, dec)
+    if not len(pixels):
+        return 0
+    filterid = FILTER_IDS[filt]
+    chunk_of = pixels >> CHUNK_SHIFT
+    chunks = np.unique(chunk_of).tolist()
+
+    # Lock the rows in a fixed order, loads of neighbouring quadrants share them
+    conn.execute(
+        """
+        INSERT INTO coverage (filterid, chunk, moc_order, ranges)
+        SELECT %s, chunk, %s, '{}' FROM unnest(%s::integer[]) AS chunk
+        ORDER BY chunk
+        ON CONFLICT DO NOTHING
+        """,
+        (filterid, MOC_ORDER, chunks),
+    )
+    rows = conn.execute(
+        """
+        SELECT chunk, ranges FROM coverage
+        WHERE filterid = %s AND chunk = ANY(%s)
+        ORDER BY chunk
+        FOR UPDATE
+        """,
+        (filterid, chunks),
+    ).fetchall()
+
+    changed = 0
+    for chunk, stored in rows:
+        old = np.array(stored, dtype=np.int64).reshape(-1, 2)
+        new = union_ranges(old, cells_to_ranges(pixels[chunk_of == chunk]))
+        if np.array_equal(old, new):
+            continue
+        conn.execute(
+            """
+            UPDATE coverage SET ranges = %s::bigint[], updated_at = now()
+            WHERE filterid = %s AND chunk = %s
+            """,
+            (new.ravel().tolist(), filterid, chunk),
+        )
+        changed += 1
+    return changed
@@ -0,0 +1,284 @@
+"""Export the catalog as a Parquet dataset for batch processing.
+
+The dataset holds the rows of ``refpsfcat_full``, sources with the header
+values of their quadrant, of all filters. It is hive-partitioned by the
+nested HEALPix pixel of the sources at PARTITION_ORDER, one file per pixel:
+``Norder={order}/Npix={pixel}/data.parquet``. Within a file the rows are
+sorted by their pixel at SORT_ORDER, the ``hpx`` column, so that each row
+group covers a small patch of sky and the min/max statistics of its
+ra/dec/hpx columns let readers skip the row groups outside their region.
+``_metadata`` gathers the footers of all files, for readers to plan a scan
+without opening each of them.
+
+Exports are incremental: ``_manifest.json`` records, for every quadrant,
+its ``ingest_metadata.ingested_at`` and the partitions it has sources in.
+A later export only rewrites the partitions of the quadrants that were
+ingested again, added or removed since, along with the partitions they
+used to have sources in.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import shutil
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+import psycopg
+import pyarrow as pa
+import pyarrow.parquet as pq
+from astropy_healpix import HEALPix
+
+from .discover import FileRef
+from .tiles import QuadrantKey, _bounding_circle, quadrant_pixels
+
+logger = logging.getLogger(__name__)
+
+# Partitions of about 3.4 deg², a few per ZTF quadrant; rows sorted by
+# pixels of about 0.2"
+PARTITION_ORDER = 5
+SORT_ORDER = 20
+ROW_GROUP_ROWS = 65_536
+# Rows a partition is read in from a server-side cursor, so that only one
+# batch at a time is held as Python objects; the rest is in Arrow buffers
+FETCH_ROWS = 50_000
+
+MANIFEST = "_manifest.json"
+DATA_FILE = "data.parquet"
+
+# Columns of refpsfcat_full, with the types of the database columns
+SCHEMA = pa.schema(
+    [
+        ("fieldid", pa.int32()),
+        ("filter", pa.string()),
+        ("ccdid", pa.int16()),
+        ("qid", pa.int16()),
+        ("sourceid", pa.int32()),
+        ("xpos", pa.float32()),
+        ("ypos", pa.float32()),
+        ("ra", pa.float64()),
+        ("dec", pa.float64()),
+        ("flux", pa.float32()),
+        ("sigflux", pa.float32()),
+        ("mag", pa.float32()),
+        ("sigmag", pa.float32()),
+        ("snr", pa.float32()),
+        ("chi", pa.float32()),
+        ("sharp", pa.float32()),
+        ("flags", pa.int16()),
+        ("magzp", pa.float32()),
+        ("magzp_rms", pa.float32()),
+        ("magzp_unc", pa.float32()),
+        ("infobits", pa.int32()),
+        ("oid", pa.string()),
+        ("hpx", pa.int64()),
+    ],
+    metadata={
+        "partition_order": str(PARTITION_ORDER),
+        "hpx_order": str(SORT_ORDER),
+    },
+)
+
+GENERATION_QUERY = "SELECT coalesce(max(generation), 0) FROM catalog_generation"
+
+VERSIONS_QUERY = """
+    SELECT fieldid, filter, ccdid, qid,
+           (extract(epoch FROM ingested_at) * 1000000)::bigint
+    FROM ingest_metadata
+"""
+
+# Sources of the circle enclosing a partition, the pixel is picked in Python
+PARTITION_QUERY = f"""
+    SELECT {", ".join(SCHEMA.names[:-2])}, oid::text
+    FROM refpsfcat_full
+    WHERE coord <@ scircle(spoint(radians(%s), radians(%s)), radians(%s))
+"""
+
+
+def partition_path(root: Path, npix: int) -> Path:
+    return root / f"Norder={PARTITION_ORDER}" / f"Npix={npix}" / DATA_FILE
+
+
+def changed_quadrants(
+    exported: dict[QuadrantKey, int], current: dict[QuadrantKey, int]
+) -> set[QuadrantKey]:
+    """Quadrants whose version differs between the last export and now,
+    including those only in one of them."""
+    return {
+        key
+        for key in exported.keys() | current.keys()
+        if exported.get(key) != current.get(key)
+    }
+
+
+def partition_batch(
+    rows: list[tuple], npix: int, hp: HEALPix | None = None
+) -> pa.RecordBatch:
+    """Record batch of the ``rows`` of PARTITION_QUERY lying in pixel
+    ``npix``, with their ``hpx``."""
+    hp = hp or HEALPix(nside=2**SORT_ORDER, order="nested")
+    if rows:
+        ra, dec = np.array([row[7:9] for row in rows], dtype=np.float64).T
+        hpx = np.asarray(hp.lonlat_to_healpix(ra * u.deg, dec * u.deg), np.int64)
+    else:
+        hpx = np.empty(0, dtype=np.int64)
+    inside = np.flatnonzero(hpx >> 2 * (SORT_ORDER - PARTITION_ORDER) == npix)
+    columns = list(zip(*rows)) or [()] * (len(SCHEMA) - 1)
+    arrays = [
+        pa.array(columns[i], field.type).take(inside)
+        for i, field in enumerate(SCHEMA)
+        if field.name != "hpx"
+    ]
+    return pa.RecordBatch.from_arrays([*arrays, pa.array(hpx[inside])], schema=SCHEMA)
+
+
+def partition_table(batches: list[pa.RecordBatch]) -> pa.Table:
+    """The rows of a partition's batches, sorted by ``hpx``."""
+    return pa.Table.from_batches(batches, schema=SCHEMA).sort_by("hpx")
+
+
+def read_partition(
+    conn: psycopg.Connection, npix: int, hp: HEALPix, sort_hp: HEALPix
+) -> pa.Table:
+    """The rows of partition ``npix``, fetched FETCH_ROWS at a time."""
+    batches = []
+    # Server-side cursors only live in a transaction
+    with conn.transaction(), conn.cursor(name=f"parquet_{npix}") as cur:
+        cur.execute(PARTITION_QUERY, _bounding_circle(hp, npix))
+        while rows := cur.fetchmany(FETCH_ROWS):
+            batches.append(partition_batch(rows, npix, sort_hp))
+    return partition_table(batches)
+
+
+def write_partition(path: Path, table: pa.Table) -> None:
+    """Write ``table`` to ``path`` under a temporary name, or remove the
+    partition if it is empty."""
+    if not table.num_rows:
+        shutil.rmtree(path.parent, ignore_errors=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(
+        table,
+        tmp,
+        row_group_size=ROW_GROUP_ROWS,
+        compression="zstd",
+        write_statistics=True,
+        sorting_columns=[pq.SortingColumn(SCHEMA.get_field_index("hpx"))],
+    )
+    tmp.replace(path)
+
+
+def write_metadata(root: Path) -> int:
+    """Write ``_common_metadata`` and ``_metadata`` with the footers of all
+    partitions. Returns the number of partitions."""
+    footers = []
+    for path in sorted(root.glob(f"Norder={PARTITION_ORDER}/Npix=*/{DATA_FILE}")):
+        footer = pq.read_metadata(path)
+        footer.set_file_path(path.relative_to(root).as_posix())
+        footers.append(footer)
+    pq.write_metadata(SCHEMA, root / "_common_metadata")
+    pq.write_metadata(SCHEMA, root / "_metadata", metadata_collector=footers)
+    return len(footers)
+
+
+def read_manifest(root: Path) -> dict:
+    """The last export's generation and, per quadrant, its version and
+    partitions; empty if there was none."""
+    path = root / MANIFEST
+    if not path.exists():
+        return {"generation": None, "quadrants": {}}
+    manifest = json.loads(path.read_text())
+    if manifest.get("partition_order") != PARTITION_ORDER:
+        return {"generation": None, "quadrants": {}}
+    return {
+        "generation": manifest["generation"],
+        "quadrants": {
+            (fieldid, filt, ccdid, qid): (version, pixels)
+            for fieldid, filt, ccdid, qid, version, pixels in manifest["quadrants"]
+        },
+    }
+
+
+def write_manifest(
+    root: Path,
+    generation: int,
+    quadrants: dict[QuadrantKey, tuple[int, list[int]]],
+) -> None:
+    manifest = {
+        "generation": generation,
+        "partition_order": PARTITION_ORDER,
+        "quadrants": [
+            [*key, version, pixels]
+            for key, (version, pixels) in sorted(quadrants.items())
+        ],
+    }
+    tmp = root / f"{MANIFEST}.tmp"
+    tmp.write_text(json.dumps(manifest))
+    tmp.replace(root / MANIFEST)
+
+
+def _remove_stale(root: Path, pixels: set[int]) -> None:
+    """Remove the partitions no quadrant has sources in any more."""
+    for path in root.glob(f"Norder={PARTITION_ORDER}/Npix=*"):
+        if int(path.name.removeprefix("Npix=")) not in pixels:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def export_parquet(conn: psycopg.Connection, root: Path, rebuild: bool = False) -> int:
+    """Rewrite the partitions of the quadrants changed since the last export.
+
+    With ``rebuild``, or after a blue/green swap of the catalog, every
+    partition is written again. Returns the number of partitions written or
+    removed.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(root)
+    # Versions are read before the rows, so that a quadrant ingested during
+    # the export is exported again next time
+    generation = conn.execute(GENERATION_QUERY).fetchone()[0]
+    current = {
+        (fieldid, filt, ccdid, qid): version
+        for fieldid, filt, ccdid, qid, version in conn.execute(VERSIONS_QUERY)
+    }
+
+    exported = manifest["quadrants"]
+    if rebuild or manifest["generation"] != generation:
+        changed = exported.keys() | current.keys()
+    else:
+        changed = changed_quadrants(
+            {key: version for key, (version, _) in exported.items()}, current
+        )
+
+    quadrants = {key: exported[key] for key in current.keys() - changed}
+    dirty: set[int] = set()
+    for key in sorted(changed):
+        if key in exported:
+            dirty.update(exported[key][1])
+        if key in current:
+            pixels = quadrant_pixels(conn, FileRef(*key), PARTITION_ORDER)
+            quadrants[key] = (current[key], sorted(pixels))
+            dirty.update(pixels)
+    logger.info(
+        "Exporting %d partitions of %d changed quadrants", len(dirty), len(changed)
+    )
+
+    hp = HEALPix(nside=2**PARTITION_ORDER, order="nested")
+    sort_hp = HEALPix(nside=2**SORT_ORDER, order="nested")
+    for npix in sorted(dirty):
+        table = read_partition(conn, npix, hp, sort_hp)
+        write_partition(partition_path(root, npix), table)
+        logger.debug("Wrote partition %d: %d rows", npix, table.num_rows)
+
+    _remove_stale(root, {npix for _, pixels in quadrants.values() for npix in pixels})
+    count = write_metadata(root)
+    # Last, so that an interrupted export is redone from the previous one
+    write_manifest(root, generation, quadrants)
+    logger.info(
+        "Parquet export done: %d partitions updated, %d in the dataset",
+        len(dirty),
+        count,
+    )
+    return len(dirty)
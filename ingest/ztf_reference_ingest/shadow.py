@@ -0,0 +1,207 @@
+"""Blue/green reload of the whole catalog.
+
+A shadow run builds a complete catalog in SHADOW_SCHEMA while the API keeps
+reading the one in ``public``: tables are created like the live ones with
+only the keys ingest needs, the files are loaded through a search_path
+that puts the shadow schema first, and the remaining indexes, foreign keys
+and statistics are built once everything is in. ``swap_catalog()`` in the
+database then exchanges the two catalogs in one transaction; the previous
+one is left in SHADOW_SCHEMA, so swapping again rolls back.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+
+import psycopg
+from psycopg import errors, sql
+
+logger = logging.getLogger(__name__)
+
+SHADOW_SCHEMA = "catalog_next"
+
+# Relations swapped together, in dependency order; xmatch_job and the
+# functions stay put
+CATALOG_TABLES = (
+    "quadrant",
+    "refpsfcat",
+    "band_association",
+    "quadrant_summary",
+    "coverage",
+    "ingest_metadata",
+)
+CATALOG_VIEWS = ("refpsfcat_full",)
+
+SWAP_ATTEMPTS = 5
+
+CONSTRAINTS_QUERY = """
+    SELECT conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype = ANY(%s)
+    ORDER BY conname
+"""
+
+# Indexes not backing a constraint, built after the load
+INDEXES_QUERY = """
+    SELECT pg_get_indexdef(i.indexrelid, 0, true)
+    FROM pg_index i
+    WHERE i.indrelid = %s::regclass
+      AND NOT EXISTS (
+          SELECT 1 FROM pg_constraint c
+          WHERE c.conrelid = i.indrelid AND c.conindid = i.indexrelid
+      )
+    ORDER BY i.indexrelid
+"""
+
+
+def shadow_conninfo(conninfo: str) -> str:
+    """Connection string resolving the catalog tables in the shadow schema."""
+    return f"{conninfo} options='-c search_path={SHADOW_SCHEMA},public'"
+
+
+def _live(name: str) -> str:
+    return f"public.{name}"
+
+
+def _use_shadow(conn: psycopg.Connection, shadow: bool) -> None:
+    # Definitions read with only public on the path name its relations
+    # unqualified, and so resolve to the shadow ones when replayed
+    path = f"{SHADOW_SCHEMA}, public" if shadow else "public"
+    conn.execute(sql.SQL("SET search_path = {}").format(sql.SQL(path)))
+
+
+def prepare_shadow(conn: psycopg.Connection) -> None:
+    """Replace the shadow schema's relations with empty copies of the live ones."""
+    shadow = sql.Identifier(SHADOW_SCHEMA)
+    with conn.transaction():
+        _use_shadow(conn, False)
+        views = {
+            view: conn.execute("SELECT pg_get_viewdef(%s::regclass)", (_live(view),))
+            .fetchone()[0]
+            .rstrip()
+            .rstrip(";")
+            for view in CATALOG_VIEWS
+        }
+        keys = {
+            table: conn.execute(
+                CONSTRAINTS_QUERY, (_live(table), ["p", "u"])
+            ).fetchall()
+            for table in CATALOG_TABLES
+        }
+
+        for view in CATALOG_VIEWS:
+            conn.execute(
+                sql.SQL("DROP VIEW IF EXISTS {}.{}").format(
+                    shadow, sql.Identifier(view)
+                )
+            )
+        for table in reversed(CATALOG_TABLES):
+            conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}.{}").format(
+                    shadow, sql.Identifier(table)
+                )
+            )
+
+        _use_shadow(conn, True)
+        for table in CATALOG_TABLES:
+            conn.execute(
+                sql.SQL(
+                    "CREATE TABLE {}.{} (LIKE public.{} INCLUDING ALL EXCLUDING INDEXES)"
+                ).format(shadow, sql.Identifier(table), sql.Identifier(table))
+            )
+            # The ON CONFLICT clauses of ingest need the keys during the load
+            for name, definition in keys[table]:
+                conn.execute(
+                    sql.SQL("ALTER TABLE {}.{} ADD CONSTRAINT {} {}").format(
+                        shadow,
+                        sql.Identifier(table),
+                        sql.Identifier(name),
+                        sql.SQL(definition),
+                    )
+                )
+        for view, definition in views.items():
+            conn.execute(
+                sql.SQL("CREATE VIEW {}.{} AS {}").format(
+                    shadow, sql.Identifier(view), sql.SQL(definition)
+                )
+            )
+        _use_shadow(conn, False)
+    logger.info("Prepared empty catalog in schema %s", SHADOW_SCHEMA)
+
+
+def finish_shadow(conn: psycopg.Connection) -> None:
+    """Build the shadow catalog's remaining indexes and foreign keys,
+    gather its statistics and load its indexes in the cache."""
+    _use_shadow(conn, False)
+    indexes = {
+        table: [row[0] for row in conn.execute(INDEXES_QUERY, (_live(table),))]
+        for table in CATALOG_TABLES
+    }
+    foreign_keys = {
+        table: conn.execute(CONSTRAINTS_QUERY, (_live(table), ["f"])).fetchall()
+        for table in CATALOG_TABLES
+    }
+
+    _use_shadow(conn, True)
+    for table in CATALOG_TABLES:
+        for definition in indexes[table]:
+            started = time.monotonic()
+            conn.execute(sql.SQL(definition))
+            logger.info("%s took %.1fs", definition, time.monotonic() - started)
+        for name, definition in foreign_keys[table]:
+            conn.execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                    sql.Identifier(SHADOW_SCHEMA, table),
+                    sql.Identifier(name),
+                    sql.SQL(definition),
+                )
+            )
+    for table in CATALOG_TABLES:
+        conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(SHADOW_SCHEMA, table)))
+    # Like prewarm_catalog() does for the live catalog, so that the first
+    # queries after the swap do not all go to disk
+    blocks = conn.execute(
+        """
+        SELECT coalesce(sum(pg_prewarm(i.indexrelid)), 0)
+        FROM pg_index i
+        WHERE i.indrelid = ANY(%s::regclass[])
+        """,
+        (
+            [
+                f"{SHADOW_SCHEMA}.{t}"
+                for t in ("quadrant", "refpsfcat", "band_association")
+            ],
+        ),
+    ).fetchone()[0]
+    _use_shadow(conn, False)
+    logger.info(
+        "Built indexes and statistics of %s, prewarmed %d blocks", SHADOW_SCHEMA, blocks
+    )
+
+
+def swap(conn: psycopg.Connection) -> int:
+    """Exchange the shadow and live catalogs. Returns the new generation.
+
+    The swap gives up after a few seconds waiting for running queries, so
+    that it never holds up the ones queued behind it for long, and is tried
+    again a few times.
+    """
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        try:
+            generation = conn.execute(
+                "SELECT swap_catalog(%s)", (SHADOW_SCHEMA,)
+            ).fetchone()[0]
+        except errors.LockNotAvailable:
+            if attempt == SWAP_ATTEMPTS:
+                raise
+            logger.warning("Catalog busy, swap attempt %d failed", attempt)
+            time.sleep(attempt)
+            continue
+        logger.info(
+            "Swapped in the catalog from %s (generation %d); the previous one "
+            "is now there",
+            SHADOW_SCHEMA,
+            generation,
+        )
+        return generation
@@ -0,0 +1,236 @@
+"""Write the catalog as memory-mappable shards for the API to search.
+
+Every field/filter becomes one shard directory,
+``{filter}/{fieldid:06d}/{generation}-{version}``, holding:
+
+- ``sources.npy``, the sources as records sorted by their nested HEALPix
+  index at SHARD_ORDER, so that the sources of a sky region are a few
+  contiguous runs of rows;
+- ``hpx.npy``, that index, to binary search the runs;
+- ``keys.npy`` and ``key_rows.npy``, the sorted (ccdid, qid, sourceid) keys
+  of the rows and the row of each, for lookups by key;
+- ``meta.json``, the field, filter, versions and the HEALPix pixels at
+  INDEX_ORDER the shard has sources in.
+
+The database stays the source of truth: the version in a shard's name is
+the one ``VERSIONS_QUERY`` gives for its field/filter, which changes with
+every ingest into it, and the API only uses shards matching the current
+one. A shard is written under a temporary name and renamed into place, so
+it is never seen half-written; older versions are removed afterwards.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import shutil
+import uuid
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+import psycopg
+from astropy_healpix import HEALPix
+
+from .discover import FILTER_IDS
+
+logger = logging.getLogger(__name__)
+
+# Sorting order of the sources (pixels of about 0.2"), and order of the
+# pixels listed in meta.json for picking the shards of a region
+SHARD_ORDER = 20
+INDEX_ORDER = 6
+
+# Columns of sources.npy, with the types of the database columns; fieldid
+# and filter are the same for the whole shard and only in meta.json
+SOURCE_DTYPE = np.dtype(
+    [
+        ("ccdid", "i2"),
+        ("qid", "i2"),
+        ("sourceid", "i4"),
+        ("xpos", "f4"),
+        ("ypos", "f4"),
+        ("ra", "f8"),
+        ("dec", "f8"),
+        ("flux", "f4"),
+        ("sigflux", "f4"),
+        ("mag", "f4"),
+        ("sigmag", "f4"),
+        ("snr", "f4"),
+        ("chi", "f4"),
+        ("sharp", "f4"),
+        ("flags", "i2"),
+        ("magzp", "f4"),
+        ("magzp_rms", "f4"),
+        ("magzp_unc", "f4"),
+        ("infobits", "i4"),
+    ]
+)
+
+GENERATION_QUERY = "SELECT coalesce(max(generation), 0) FROM catalog_generation"
+
+# ingested_at only ever grows and is set for each quadrant ingest, so its
+# sum changes with every ingest into a field/filter
+VERSIONS_QUERY = """
+    SELECT fieldid, filter,
+           sum((extract(epoch FROM ingested_at) * 1000000)::bigint)::bigint
+    FROM ingest_metadata
+    WHERE %(fieldid)s::integer IS NULL
+       OR (fieldid = %(fieldid)s AND filter = %(filter)s)
+    GROUP BY fieldid, filter
+"""
+
+QUADRANT_QUERY = f"""
+    SELECT {", ".join(SOURCE_DTYPE.names)}
+    FROM refpsfcat_full
+    WHERE fieldid = %s AND filterid = %s AND ccdid = %s AND qid = %s
+"""
+
+
+def shard_key(ccdid, qid, sourceid):
+    """Sortable int64 key of a source within its shard, scalars or arrays."""
+    return (
+        (np.asarray(ccdid, dtype=np.int64) << 40)
+        | (np.asarray(qid, dtype=np.int64) << 32)
+        | np.asarray(sourceid, dtype=np.int64)
+    )
+
+
+def shard_path(
+    root: Path, filt: str, fieldid: int, generation: int, version: int
+) -> Path:
+    return root / filt / f"{fieldid:06d}" / f"{generation}-{version}"
+
+
+def _read_sources(conn: psycopg.Connection, fieldid: int, filt: str) -> np.ndarray:
+    quadrants = conn.execute(
+        """
+        SELECT ccdid, qid FROM ingest_metadata
+        WHERE fieldid = %s AND filter = %s
+        ORDER BY ccdid, qid
+        """,
+        (fieldid, filt),
+    ).fetchall()
+    # A quadrant at a time, the rows of a whole field would not fit in memory
+    # as Python tuples
+    parts = [
+        np.array(
+            conn.execute(
+                QUADRANT_QUERY, (fieldid, FILTER_IDS[filt], ccdid, qid)
+            ).fetchall(),
+            dtype=SOURCE_DTYPE,
+        )
+        for ccdid, qid in quadrants
+    ]
+    return np.concatenate([np.empty(0, dtype=SOURCE_DTYPE), *parts])
+
+
+def write_shard(
+    path: Path,
+    fieldid: int,
+    filt: str,
+    generation: int,
+    version: int,
+    sources: np.ndarray,
+) -> None:
+    """Write a shard of ``sources`` and rename it to ``path``."""
+    hp = HEALPix(nside=2**SHARD_ORDER, order="nested")
+    hpx = np.asarray(
+        hp.lonlat_to_healpix(sources["ra"] * u.deg, sources["dec"] * u.deg),
+        dtype=np.int64,
+    )
+    order = np.argsort(hpx, kind="stable")
+    sources, hpx = sources[order], hpx[order]
+    keys = shard_key(sources["ccdid"], sources["qid"], sources["sourceid"])
+    key_rows = np.argsort(keys, kind="stable").astype(np.int32)
+
+    tmp = path.parent / f".tmp-{uuid.uuid4().hex}"
+    tmp.mkdir(parents=True)
+    try:
+        np.save(tmp / "sources.npy", sources)
+        np.save(tmp / "hpx.npy", hpx)
+        np.save(tmp / "keys.npy", keys[key_rows])
+        np.save(tmp / "key_rows.npy", key_rows)
+        meta = {
+            "fieldid": fieldid,
+            "filter": filt,
+            "generation": generation,
+            "version": version,
+            "order": SHARD_ORDER,
+            "index_order": INDEX_ORDER,
+            "pixels": np.unique(hpx >> 2 * (SHARD_ORDER - INDEX_ORDER)).tolist(),
+        }
+        (tmp / "meta.json").write_text(json.dumps(meta))
+        tmp.rename(path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _remove_others(field_dir: Path, keep: Path | None) -> None:
+    """Remove the other versions of a field/filter's shard, and the field's
+    directory if none is left. The API may still have them mapped, which
+    keeps their data until it lets go."""
+    if not field_dir.is_dir():
+        return
+    for path in field_dir.iterdir():
+        if path != keep and not path.name.startswith(".tmp-"):
+            shutil.rmtree(path, ignore_errors=True)
+    if keep is None:
+        shutil.rmtree(field_dir, ignore_errors=True)
+
+
+def build_shards(conn: psycopg.Connection, root: Path, rebuild: bool = False) -> int:
+    """Write the shards that are missing or out of date, and remove those of
+    fields/filters no longer in the catalog. Returns the number written.
+
+    With ``rebuild``, every shard is written again.
+    """
+    generation = conn.execute(GENERATION_QUERY).fetchone()[0]
+    current = {
+        (filt, fieldid): version
+        for fieldid, filt, version in conn.execute(
+            VERSIONS_QUERY, {"fieldid": None, "filter": None}
+        )
+    }
+
+    count = 0
+    for (filt, fieldid), version in sorted(current.items()):
+        if (
+            not rebuild
+            and shard_path(root, filt, fieldid, generation, version).exists()
+        ):
+            continue
+        # Version and rows from one snapshot, so that they go together
+        with conn.transaction():
+            conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            generation = conn.execute(GENERATION_QUERY).fetchone()[0]
+            row = conn.execute(
+                VERSIONS_QUERY, {"fieldid": fieldid, "filter": filt}
+            ).fetchone()
+            if row is None:
+                continue
+            version = row[2]
+            sources = _read_sources(conn, fieldid, filt)
+        path = shard_path(root, filt, fieldid, generation, version)
+        if path.exists():
+            shutil.rmtree(path)
+        write_shard(path, fieldid, filt, generation, version, sources)
+        _remove_others(path.parent, path)
+        count += 1
+        logger.info(
+            "Wrote shard of field=%d filter=%s: %d sources",
+            fieldid,
+            filt,
+            len(sources),
+        )
+
+    for filt in FILTER_IDS:
+        if not (root / filt).is_dir():
+            continue
+        for field_dir in (root / filt).iterdir():
+            if field_dir.name.isdigit() and (filt, int(field_dir.name)) not in current:
+                _remove_others(field_dir, None)
+
+    logger.info("Shards done: %d written", count)
+    return count
@@ -0,0 +1,118 @@
+"""Per-quadrant statistics backing the API's /stats endpoint."""
+
+from __future__ import annotations
+
+import logging
+import math
+
+import numpy as np
+import psycopg
+
+from .discover import FILTER_IDS
+from .moc import add_coverage
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(
+    mag: np.ndarray, sigmag: np.ndarray, ra: np.ndarray, dec: np.ndarray
+) -> tuple:
+    """Summary of one quadrant's sources.
+
+    ``mag`` are calibrated magnitudes. Returns (n_sources, mag_min, mag_max,
+    sigmag_median, region), where region is the scircle text of a circle
+    around the mean position enclosing every source. NaN magnitudes are
+    ignored; values are None when nothing is left.
+    """
+    good_mag = mag[np.isfinite(mag)]
+    good_sigmag = sigmag[np.isfinite(sigmag)]
+
+    region = None
+    if len(ra):
+        ra_rad, dec_rad = np.radians(ra), np.radians(dec)
+        v = np.stack(
+            [
+                np.cos(dec_rad) * np.cos(ra_rad),
+                np.cos(dec_rad) * np.sin(ra_rad),
+                np.sin(dec_rad),
+            ]
+        )
+        center = v.sum(axis=1)
+        center /= np.linalg.norm(center)
+        radius = float(np.arccos(np.clip(center @ v, -1.0, 1.0)).max())
+        c_ra = math.atan2(center[1], center[0]) % (2 * math.pi)
+        c_dec = math.asin(center[2])
+        # Some room for rounding, every source must stay inside
+        region = f"<({c_ra}, {c_dec}), {radius * (1 + 1e-6) + 1e-9}>"
+
+    return (
+        len(ra),
+        float(good_mag.min()) if len(good_mag) else None,
+        float(good_mag.max()) if len(good_mag) else None,
+        float(np.median(good_sigmag)) if len(good_sigmag) else None,
+        region,
+    )
+
+
+def write_summary(
+    conn: psycopg.Connection,
+    fieldid: int,
+    filt: str,
+    ccdid: int,
+    qid: int,
+    summary: tuple,
+) -> None:
+    conn.execute(
+        """
+        INSERT INTO quadrant_summary (fieldid, filter, ccdid, qid, n_sources,
+                                      mag_min, mag_max, sigmag_median, region)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (fieldid, filter, ccdid, qid)
+        DO UPDATE SET n_sources = EXCLUDED.n_sources,
+                      mag_min = EXCLUDED.mag_min,
+                      mag_max = EXCLUDED.mag_max,
+                      sigmag_median = EXCLUDED.sigmag_median,
+                      region = EXCLUDED.region,
+                      updated_at = now()
+        WHERE (quadrant_summary.n_sources, quadrant_summary.mag_min,
+               quadrant_summary.mag_max, quadrant_summary.sigmag_median,
+               quadrant_summary.region)
+              IS DISTINCT FROM
+              (EXCLUDED.n_sources, EXCLUDED.mag_min, EXCLUDED.mag_max,
+               EXCLUDED.sigmag_median, EXCLUDED.region)
+        """,
+        (fieldid, filt, ccdid, qid, *summary),
+    )
+
+
+def summarize_quadrant(
+    conn: psycopg.Connection, fieldid: int, filt: str, ccdid: int, qid: int
+) -> None:
+    """Recompute the summary of a quadrant from its stored sources.
+
+    Also adds the quadrant to the coverage map, which the API only trusts
+    once every quadrant has a summary.
+    """
+    rows = conn.execute(
+        """
+        SELECT mag + magzp, sigmag, ra, dec FROM refpsfcat_full
+        WHERE fieldid = %s AND filterid = %s AND ccdid = %s AND qid = %s
+        """,
+        (fieldid, FILTER_IDS[filt], ccdid, qid),
+    ).fetchall()
+    mag, sigmag, ra, dec = np.array(rows, dtype=np.float64).reshape(-1, 4).T
+    write_summary(conn, fieldid, filt, ccdid, qid, summarize(mag, sigmag, ra, dec))
+    add_coverage(conn, filt, ra, dec)
+
+
+def rebuild_summaries(conn: psycopg.Connection) -> int:
+    """Recompute the summaries of all ingested quadrants, one at a time."""
+    quadrants = conn.execute(
+        "SELECT fieldid, filter, ccdid, qid FROM quadrant ORDER BY 1, 2, 3, 4"
+    ).fetchall()
+    for i, (fieldid, filt, ccdid, qid) in enumerate(quadrants, 1):
+        with conn.transaction():
+            summarize_quadrant(conn, fieldid, filt, ccdid, qid)
+        if i % 1000 == 0 or i == len(quadrants):
+            logger.info("Summarized %d/%d quadrants", i, len(quadrants))
+    return len(quadrants)
@@ -0,0 +1,184 @@
+"""Keep ingest writes from hurting API latency.
+
+A Throttle is shared by the worker processes: it caps how many of them load
+at once and the rate at which they COPY rows. The rate is waited out before
+each load's transaction opens, never inside it, so that throttling does not
+hold locks or keep a snapshot open any longer. The Governor, a thread of the
+main process, watches signs of the database being busy with the API (app
+queries waiting on I/O or locks, replication lag) and scales both down when
+one crosses its threshold, then back up once it clears.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import multiprocessing
+import threading
+import time
+
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+# Scale back by half on pressure, recover by a tenth per quiet check
+MIN_FACTOR = 1 / 64
+BACKOFF = 0.5
+RECOVERY = 0.1
+
+SIGNALS_QUERY = """
+    SELECT
+        (SELECT count(*) FROM pg_stat_activity
+         WHERE usename = %s AND state = 'active'
+           AND wait_event_type IN ('IO', 'Lock', 'LWLock', 'BufferPin')),
+        (SELECT coalesce(max(extract(epoch FROM replay_lag)), 0)::float8
+         FROM pg_stat_replication)
+"""
+
+
+class Throttle:
+    """Writer slots and COPY rate shared by the ingest processes.
+
+    ``max_rate`` is in bytes/s for all writers together, 0 for no limit.
+    Both limits are scaled by a factor the Governor sets; at the bottom no
+    writer is admitted until it rises again.
+    """
+
+    def __init__(self, max_writers: int, max_rate: float = 0):
+        self.max_writers = max_writers
+        self.max_rate = max_rate
+        self._factor = multiprocessing.Value("d", 1.0)
+        self._active = multiprocessing.Value("i", 0)
+        self._next = 0.0
+
+    @property
+    def factor(self) -> float:
+        return self._factor.value
+
+    @factor.setter
+    def factor(self, value: float) -> None:
+        self._factor.value = value
+
+    def allowed_writers(self) -> int:
+        return int(self.max_writers * self.factor + 1e-9)
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Hold one of the writer slots, waiting for one to be free."""
+        while True:
+            with self._active.get_lock():
+                if self._active.value < self.allowed_writers():
+                    self._active.value += 1
+                    break
+            time.sleep(0.2)
+        try:
+            yield
+        finally:
+            with self._active.get_lock():
+                self._active.value -= 1
+
+    def pace(self, nbytes: int) -> None:
+        """Sleep as long as this writer's share of the rate takes for nbytes."""
+        if not self.max_rate:
+            return
+        rate = self.max_rate * self.factor / max(self.allowed_writers(), 1)
+        now = time.monotonic()
+        self._next = max(self._next, now) + nbytes / rate
+        if self._next > now:
+            time.sleep(self._next - now)
+
+
+_throttle: Throttle | None = None
+
+
+def install(throttle: Throttle | None) -> None:
+    """Make ``writer()`` and ``reserve()`` of this process use ``throttle``."""
+    global _throttle
+    _throttle = throttle
+
+
+def writer():
+    """The installed throttle's writer slot, or nothing to wait for."""
+    return _throttle.writer() if _throttle is not None else contextlib.nullcontext()
+
+
+def reserve(nbytes: int) -> None:
+    """Wait out the installed throttle's rate for ``nbytes`` about to be
+    written; call it holding a writer slot, before the transaction."""
+    if _throttle is not None:
+        _throttle.pace(nbytes)
+
+
+def copy_bytes(rows: list[tuple]) -> int:
+    """Size of rows in COPY text format, tabs and newlines included."""
+    if not rows:
+        return 0
+    # Rows of a table are all about the same size
+    return len(rows) * (sum(len(str(v)) for v in rows[0]) + len(rows[0]))
+
+
+def adjust(factor: float, pressure: bool) -> float:
+    """Next throttle factor: back off on pressure, recover slowly otherwise."""
+    if pressure:
+        return max(factor * BACKOFF, MIN_FACTOR)
+    return min(factor + RECOVERY, 1.0)
+
+
+class Governor(threading.Thread):
+    """Scale a Throttle with the load the API puts on the database.
+
+    Pressure is more than ``max_app_waits`` queries of ``app_user`` waiting
+    on I/O or locks, or replicas more than ``max_lag`` seconds behind; 0
+    disables either signal.
+    """
+
+    def __init__(
+        self,
+        conninfo: str,
+        throttle: Throttle,
+        app_user: str = "app",
+        max_app_waits: int = 0,
+        max_lag: float = 0,
+        interval: float = 2.0,
+    ):
+        super().__init__(name="ingest-governor", daemon=True)
+        self.conninfo = conninfo
+        self.throttle = throttle
+        self.app_user = app_user
+        self.max_app_waits = max_app_waits
+        self.max_lag = max_lag
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self.join()
+
+    def run(self) -> None:
+        conn = None
+        while not self._stopping.wait(self.interval):
+            try:
+                if conn is None or conn.closed or conn.broken:
+                    conn = psycopg.connect(self.conninfo, autocommit=True)
+                waits, lag = conn.execute(SIGNALS_QUERY, (self.app_user,)).fetchone()
+            except psycopg.Error:
+                logger.warning("Failed to read load signals", exc_info=True)
+                continue
+            pressure = bool(
+                (self.max_app_waits and waits > self.max_app_waits)
+                or (self.max_lag and lag > self.max_lag)
+            )
+            writers = self.throttle.allowed_writers()
+            self.throttle.factor = adjust(self.throttle.factor, pressure)
+            if self.throttle.allowed_writers() != writers:
+                logger.info(
+                    "%s: %d waiting app queries, %.1fs replication lag; "
+                    "now %d writer(s) at %.0f%% rate",
+                    "Backing off" if pressure else "Recovering",
+                    waits,
+                    lag,
+                    self.throttle.allowed_writers(),
+                    self.throttle.factor * 100,
+                )
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,260 @@
+"""Build HiPS-style catalogue tiles for progressive display.
+
+Every filter gets its own tile set: for each HEALPix order between
+TILE_MIN_ORDER and TILE_MAX_ORDER, tile ``Norder{k}/Dir{d}/Npix{p}.tsv``
+lists the TILE_SIZE brightest sources of pixel ``p``. Only the deepest
+order is read from the database; each coarser tile is the brightest
+TILE_SIZE rows of its four children, which is exact because the brightest
+sources of a pixel are among the brightest of the sub-pixel they fall in.
+
+``_manifest.json`` records, for every quadrant, the pixels at TILE_MAX_ORDER
+it had sources in when the tiles were last built. A quadrant ingested again
+gets the tiles of both its old and its new pixels rebuilt, and a removed one
+those of its old pixels, so that no tile keeps sources that moved away.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+import psycopg
+from astropy_healpix import HEALPix
+
+from .discover import FILTER_IDS, FileRef
+
+logger = logging.getLogger(__name__)
+
+TILE_MIN_ORDER = 3
+TILE_MAX_ORDER = 7
+TILE_SIZE = 500
+TILE_COLUMNS = ("oid", "ra", "dec", "mag", "sigmag")
+
+MANIFEST = "_manifest.json"
+
+QuadrantKey = tuple[int, str, int, int]
+
+
+def tile_path(root: Path, filt: str, order: int, npix: int) -> Path:
+    return (
+        root
+        / filt
+        / f"Norder{order}"
+        / f"Dir{npix // 10000 * 10000}"
+        / f"Npix{npix}.tsv"
+    )
+
+
+def changed_quadrants(
+    conn: psycopg.Connection, since: datetime | None
+) -> list[FileRef]:
+    """Quadrants ingested at or after ``since``, or all of them if it is None."""
+    rows = conn.execute(
+        """
+        SELECT fieldid, filter, ccdid, qid FROM ingest_metadata
+        WHERE %(since)s::timestamptz IS NULL OR ingested_at >= %(since)s
+        """,
+        {"since": since},
+    ).fetchall()
+    return [FileRef(fieldid=f, filter=filt, ccdid=c, qid=q) for f, filt, c, q in rows]
+
+
+def quadrant_pixels(conn: psycopg.Connection, ref: FileRef, order: int) -> set[int]:
+    """HEALPix pixels at ``order`` holding at least one source of a quadrant."""
+    rows = conn.execute(
+        """
+        SELECT degrees(long(coord)), degrees(lat(coord)) FROM refpsfcat
+        WHERE fieldid = %s AND filterid = %s AND ccdid = %s AND qid = %s
+        """,
+        (ref.fieldid, FILTER_IDS[ref.filter], ref.ccdid, ref.qid),
+    ).fetchall()
+    if not rows:
+        return set()
+    ra, dec = np.array(rows, dtype=np.float64).T
+    hp = HEALPix(nside=2**order, order="nested")
+    return set(np.unique(hp.lonlat_to_healpix(ra * u.deg, dec * u.deg)).tolist())
+
+
+def read_manifest(root: Path) -> dict[QuadrantKey, list[int]]:
+    """Per quadrant, its pixels when the tiles were last built; empty if
+    they never were."""
+    path = root / MANIFEST
+    if not path.exists():
+        return {}
+    manifest = json.loads(path.read_text())
+    if manifest.get("tile_order") != TILE_MAX_ORDER:
+        return {}
+    return {
+        (fieldid, filt, ccdid, qid): pixels
+        for fieldid, filt, ccdid, qid, pixels in manifest["quadrants"]
+    }
+
+
+def write_manifest(root: Path, quadrants: dict[QuadrantKey, list[int]]) -> None:
+    manifest = {
+        "tile_order": TILE_MAX_ORDER,
+        "quadrants": [[*key, pixels] for key, pixels in sorted(quadrants.items())],
+    }
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = root / f"{MANIFEST}.tmp"
+    tmp.write_text(json.dumps(manifest))
+    tmp.replace(root / MANIFEST)
+
+
+def _bounding_circle(hp: HEALPix, npix: int) -> tuple[float, float, float]:
+    """Center (deg) and radius (deg) of a circle enclosing a pixel."""
+    lon, lat = hp.healpix_to_lonlat([npix])
+    edge_lon, edge_lat = hp.boundaries_lonlat([npix], step=4)
+    center_ra, center_dec = lon.deg[0], lat.deg[0]
+    ra, dec = np.radians(edge_lon.deg[0]), np.radians(edge_lat.deg[0])
+    c_ra, c_dec = np.radians(center_ra), np.radians(center_dec)
+    cos_sep = np.sin(dec) * np.sin(c_dec) + np.cos(dec) * np.cos(c_dec) * np.cos(
+        ra - c_ra
+    )
+    radius = np.degrees(np.arccos(np.clip(cos_sep, -1.0, 1.0)).max())
+    # Pixel edges are not great circles, leave some room for the bulge
+    return center_ra, center_dec, radius * 1.05
+
+
+def _leaf_rows(conn: psycopg.Connection, filt: str, npix: int) -> list[tuple]:
+    """The TILE_SIZE brightest sources inside one pixel at TILE_MAX_ORDER.
+
+    The database only knows the enclosing circle, so fetch the brightest
+    rows of the circle and keep those inside the pixel. Any brighter source
+    of the pixel would also have ranked in the circle, so if enough rows
+    survive they are exactly the ones we want; otherwise fetch more.
+    """
+    hp = HEALPix(nside=2**TILE_MAX_ORDER, order="nested")
+    ra0, dec0, radius = _bounding_circle(hp, npix)
+    limit = 4 * TILE_SIZE
+    while True:
+        rows = conn.execute(
+            """
+            SELECT oid::text, ra, dec, mag + magzp, sigmag
+            FROM refpsfcat_full
+            WHERE coord <@ scircle(spoint(radians(%s), radians(%s)), radians(%s))
+              AND filterid = %s AND mag <> 'NaN'
+            ORDER BY mag + magzp
+            LIMIT %s
+            """,
+            (ra0, dec0, radius, FILTER_IDS[filt], limit),
+        ).fetchall()
+        if not rows:
+            return []
+        ra, dec = np.array([row[1:3] for row in rows], dtype=np.float64).T
+        inside = hp.lonlat_to_healpix(ra * u.deg, dec * u.deg) == npix
+        selected = [row for row, keep in zip(rows, inside) if keep]
+        if len(selected) >= TILE_SIZE or len(rows) < limit:
+            break
+        limit *= 4
+    return selected[:TILE_SIZE]
+
+
+def _write_tile(path: Path, rows: list[tuple]) -> None:
+    if not rows:
+        path.unlink(missing_ok=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(TILE_COLUMNS)
+        writer.writerows(rows)
+    tmp.replace(path)
+
+
+def _read_tile(path: Path) -> list[tuple]:
+    if not path.exists():
+        return []
+    with path.open(newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        next(reader)
+        return [
+            (oid, float(ra), float(dec), float(mag), float(sigmag))
+            for oid, ra, dec, mag, sigmag in reader
+        ]
+
+
+def _write_properties(root: Path, filt: str) -> None:
+    path = root / filt / "properties"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        "\n".join(
+            [
+                f"creator_did = ivo://snad.space/ztf-reference/refpsfcat/{filt}",
+                f"obs_title = ZTF reference PSF catalog ({filt})",
+                "dataproduct_type = catalog",
+                "hips_frame = equatorial",
+                f"hips_order = {TILE_MAX_ORDER}",
+                f"hips_order_min = {TILE_MIN_ORDER}",
+                "hips_tile_format = tsv",
+                f"hips_release_date = {datetime.now():%Y-%m-%dT%H:%M}",
+                "",
+            ]
+        )
+    )
+
+
+def build_tiles(
+    conn: psycopg.Connection, root: Path, since: datetime | None = None
+) -> int:
+    """Regenerate the tiles touched by quadrants ingested since ``since``,
+    where they have sources now or had them at the last build, and by
+    quadrants removed since.
+
+    With ``since=None`` every tile is rebuilt. Returns the number of tiles
+    written or removed.
+    """
+    built = read_manifest(root)
+    current = {
+        (ref.fieldid, ref.filter, ref.ccdid, ref.qid)
+        for ref in changed_quadrants(conn, None)
+    }
+
+    touched: dict[str, set[int]] = {}
+    for key in sorted(built.keys() - current):
+        touched.setdefault(key[1], set()).update(built.pop(key))
+    for ref in changed_quadrants(conn, since):
+        key = (ref.fieldid, ref.filter, ref.ccdid, ref.qid)
+        pixels = quadrant_pixels(conn, ref, TILE_MAX_ORDER)
+        touched.setdefault(ref.filter, set()).update(built.get(key, ()), pixels)
+        built[key] = sorted(pixels)
+
+    count = 0
+    for filt, pixels in sorted(touched.items()):
+        logger.info(
+            "Building %s tiles for %d pixels at order %d",
+            filt,
+            len(pixels),
+            TILE_MAX_ORDER,
+        )
+        for npix in sorted(pixels):
+            _write_tile(
+                tile_path(root, filt, TILE_MAX_ORDER, npix),
+                _leaf_rows(conn, filt, npix),
+            )
+            count += 1
+
+        for order in range(TILE_MAX_ORDER - 1, TILE_MIN_ORDER - 1, -1):
+            pixels = {npix // 4 for npix in pixels}
+            for npix in sorted(pixels):
+                rows = [
+                    row
+                    for child in range(4 * npix, 4 * npix + 4)
+                    for row in _read_tile(tile_path(root, filt, order + 1, child))
+                ]
+                rows.sort(key=lambda row: row[3])
+                _write_tile(tile_path(root, filt, order, npix), rows[:TILE_SIZE])
+                count += 1
+
+        _write_properties(root, filt)
+
+    # Last, so that an interrupted build leaves the previous pixels on record
+    write_manifest(root, built)
+    logger.info("Tiles done: %d tiles updated", count)
+    return count
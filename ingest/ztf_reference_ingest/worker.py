@@ -0,0 +1,131 @@
+"""Ingest work done in the worker processes.
+
+Every process keeps one database connection and one HTTP client for its
+whole life, instead of connecting for each file.
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+from pathlib import Path
+
+import httpx
+import psycopg
+
+from .db import ingest_catalogs
+from .discover import FileRef
+from .download import download_if_changed
+from .fits import parse_fits
+from .throttle import Throttle, copy_bytes, install, reserve, writer
+
+logger = logging.getLogger(__name__)
+
+_conninfo: str | None = None
+_conn: psycopg.Connection | None = None
+_client: httpx.Client | None = None
+
+
+def _init_worker(conninfo: str, throttle: Throttle | None = None) -> None:
+    global _conninfo, _client
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    install(throttle)
+    _conninfo = conninfo
+    _client = httpx.Client()
+    atexit.register(_close)
+
+
+def _close() -> None:
+    if _conn is not None:
+        _conn.close()
+    if _client is not None:
+        _client.close()
+
+
+def _connection() -> psycopg.Connection:
+    """The process's connection, reopened if it was lost."""
+    global _conn
+    if _conn is None or _conn.closed or _conn.broken:
+        _conn = psycopg.connect(_conninfo, autocommit=True)
+    return _conn
+
+
+def process_batch(refs: list[FileRef], diff: bool = False) -> list[tuple[str, int]]:
+    """Download the changed files among ``refs`` and ingest them together.
+
+    All of them are loaded in one transaction (see ``ingest_catalogs``),
+    writing only the changed rows with ``diff``.
+    Returns a (status, rows) pair per ref, status being "ingested",
+    "skipped" or "failed".
+    """
+    results: list[tuple[str, int]] = [("skipped", 0)] * len(refs)
+    pending = []
+    for i, ref in enumerate(refs):
+        try:
+            downloaded = download_if_changed(_client, _connection(), ref)
+            if downloaded is None:
+                continue
+            catalog = parse_fits(downloaded.content)
+        except Exception:
+            logger.exception("Failed to process %s", ref.path)
+            results[i] = ("failed", 0)
+            continue
+        metadata = {
+            "etag": downloaded.etag,
+            "last_modified": downloaded.last_modified,
+            "content_length": downloaded.content_length,
+        }
+        pending.append((i, (catalog, ref, metadata)))
+    return _ingest(pending, results, diff)
+
+
+def process_local_batch(paths: list[Path], diff: bool = False) -> list[tuple[str, int]]:
+    """Parse local FITS files and ingest them together, like ``process_batch``."""
+    results: list[tuple[str, int]] = [("skipped", 0)] * len(paths)
+    pending = []
+    for i, path in enumerate(paths):
+        logger.info("Ingesting local file: %s", path)
+        try:
+            catalog = parse_fits(path)
+        except Exception:
+            logger.exception("Failed to parse %s", path)
+            results[i] = ("failed", 0)
+            continue
+        ref = FileRef(
+            fieldid=catalog.fieldid,
+            filter=catalog.filter,
+            ccdid=catalog.ccdid,
+            qid=catalog.qid,
+        )
+        pending.append((i, (catalog, ref, {})))
+    return _ingest(pending, results, diff)
+
+
+def _ingest(
+    pending: list[tuple[int, tuple]], results: list[tuple[str, int]], diff: bool
+) -> list[tuple[str, int]]:
+    """Load the (result index, ingest item) pairs in one transaction and
+    record their outcome in ``results``."""
+    if not pending:
+        return results
+
+    try:
+        with writer():
+            # Sleeping here rather than during the COPY keeps the transaction
+            # as short as unthrottled
+            reserve(sum(copy_bytes(catalog.rows) for _, (catalog, _, _) in pending))
+            counts = ingest_catalogs(
+                _connection(), [item for _, item in pending], diff=diff
+            )
+    except Exception:
+        logger.exception(
+            "Failed to ingest %s", ", ".join(ref.path for _, (_, ref, _) in pending)
+        )
+        counts = [None] * len(pending)
+
+    for (i, _), count in zip(pending, counts):
+        results[i] = ("failed", 0) if count is None else ("ingested", count)
+    return results
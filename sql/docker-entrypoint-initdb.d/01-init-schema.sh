@@ -3,6 +3,9 @@ set -e
 
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
     CREATE EXTENSION IF NOT EXISTS pg_sphere;
+    CREATE EXTENSION IF NOT EXISTS pg_prewarm;
+    CREATE EXTENSION IF NOT EXISTS pgstattuple;
+    CREATE EXTENSION IF NOT EXISTS btree_gist;
 
     CREATE USER app;
     CREATE USER ingest;
@@ -16,42 +19,69 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
         magzp_rms   real       NOT NULL,
         magzp_unc   real       NOT NULL,
         infobits    integer    NOT NULL,
-        PRIMARY KEY (fieldid, filter, ccdid, qid)
+        filterid    smallint   NOT NULL GENERATED ALWAYS AS (
+                        CASE filter WHEN 'zg' THEN 1 WHEN 'zr' THEN 2 WHEN 'zi' THEN 3 END
+                    ) STORED,
+        PRIMARY KEY (fieldid, filter, ccdid, qid),
+        UNIQUE (fieldid, filterid, ccdid, qid)
     );
 
+    -- Compact layout: the filter is stored as its ZTF filter ID, ra/dec are
+    -- derived from coord in refpsfcat_full, and columns are ordered by
+    -- decreasing alignment so that rows carry no padding. The primary key
+    -- also serves per-quadrant scans, so there is no separate quadrant index.
     CREATE TABLE refpsfcat (
-        fieldid     integer          NOT NULL,
-        filter      varchar(2)       NOT NULL,
-        ccdid       smallint         NOT NULL,
-        qid         smallint         NOT NULL,
-        sourceid    integer          NOT NULL,
-        xpos        real             NOT NULL,
-        ypos        real             NOT NULL,
-        ra          double precision NOT NULL,
-        dec         double precision NOT NULL,
-        coord       spoint           NOT NULL,
-        flux        real             NOT NULL,
-        sigflux     real             NOT NULL,
-        mag         real             NOT NULL,
-        sigmag      real             NOT NULL,
-        snr         real             NOT NULL,
-        chi         real             NOT NULL,
-        sharp       real             NOT NULL,
-        flags       smallint         NOT NULL,
-        PRIMARY KEY (fieldid, filter, ccdid, qid, sourceid),
-        FOREIGN KEY (fieldid, filter, ccdid, qid) REFERENCES quadrant (fieldid, filter, ccdid, qid)
+        coord       spoint   NOT NULL,
+        fieldid     integer  NOT NULL,
+        sourceid    integer  NOT NULL,
+        xpos        real     NOT NULL,
+        ypos        real     NOT NULL,
+        flux        real     NOT NULL,
+        sigflux     real     NOT NULL,
+        mag         real     NOT NULL,
+        sigmag      real     NOT NULL,
+        snr         real     NOT NULL,
+        chi         real     NOT NULL,
+        sharp       real     NOT NULL,
+        filterid    smallint NOT NULL,
+        ccdid       smallint NOT NULL,
+        qid         smallint NOT NULL,
+        flags       smallint NOT NULL,
+        PRIMARY KEY (fieldid, filterid, ccdid, qid, sourceid),
+        FOREIGN KEY (fieldid, filterid, ccdid, qid) REFERENCES quadrant (fieldid, filterid, ccdid, qid)
     );
 
     CREATE INDEX idx_refpsfcat_coord ON refpsfcat USING GIST (coord);
-    CREATE INDEX idx_refpsfcat_quadrant ON refpsfcat (fieldid, filter, ccdid, qid);
 
+    -- The object ID as a bigint, {fieldid}{filterid}{ccdid:02}{qid}{sourceid:08},
+    -- for lookups by a single narrow key. It is computed rather than stored,
+    -- and refpsfcat_full exposes it with the same expression so that the
+    -- planner uses this index.
+    CREATE UNIQUE INDEX idx_refpsfcat_oid ON refpsfcat (
+        ((((fieldid::bigint * 10 + filterid) * 100 + ccdid) * 10 + qid) * 100000000 + sourceid)
+    );
+
+    -- Sources by pixel position within their quadrant, for /api/v1/pixel:
+    -- btree_gist lets the quadrant key share the index with the point, so
+    -- a nearest-first search only visits the entries of one quadrant
+    CREATE INDEX idx_refpsfcat_pixel ON refpsfcat
+        USING GIST (fieldid, filterid, ccdid, qid, point(xpos, ypos));
+
+    -- LEFT JOIN (the foreign key makes it equivalent to an inner join) lets
+    -- the planner drop the quadrant join when no header columns are selected.
+    -- Queries should filter on filterid, which the indexes cover, not filter.
     CREATE VIEW refpsfcat_full AS
-    SELECT r.fieldid, r.filter, r.ccdid, r.qid, r.sourceid,
-           r.xpos, r.ypos, r.ra, r.dec, r.coord,
+    SELECT r.fieldid,
+           (CASE r.filterid WHEN 1 THEN 'zg' WHEN 2 THEN 'zr' WHEN 3 THEN 'zi' END)::varchar(2)
+               AS filter,
+           r.filterid, r.ccdid, r.qid, r.sourceid,
+           r.xpos, r.ypos, degrees(long(r.coord)) AS ra, degrees(lat(r.coord)) AS dec, r.coord,
            r.flux, r.sigflux, r.mag, r.sigmag, r.snr, r.chi, r.sharp, r.flags,
-           q.magzp, q.magzp_rms, q.magzp_unc, q.infobits
+           q.magzp, q.magzp_rms, q.magzp_unc, q.infobits,
+           (((r.fieldid::bigint * 10 + r.filterid) * 100 + r.ccdid) * 10 + r.qid) * 100000000
+               + r.sourceid AS oid
     FROM refpsfcat r
-    JOIN quadrant q USING (fieldid, filter, ccdid, qid);
+    LEFT JOIN quadrant q USING (fieldid, filterid, ccdid, qid);
 
     CREATE TABLE ingest_metadata (
         fieldid       integer    NOT NULL,
@@ -65,13 +95,190 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
         PRIMARY KEY (fieldid, filter, ccdid, qid)
     );
 
+    -- Per-quadrant statistics, kept up to date by ingest and cached by the
+    -- app to answer /api/v1/stats without touching refpsfcat
+    CREATE TABLE quadrant_summary (
+        fieldid       integer     NOT NULL,
+        filter        varchar(2)  NOT NULL,
+        ccdid         smallint    NOT NULL,
+        qid           smallint    NOT NULL,
+        n_sources     integer     NOT NULL,
+        mag_min       real,
+        mag_max       real,
+        sigmag_median real,
+        region        scircle,
+        updated_at    timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (fieldid, filter, ccdid, qid),
+        FOREIGN KEY (fieldid, filter, ccdid, qid) REFERENCES quadrant (fieldid, filter, ccdid, qid)
+    );
+
+    CREATE INDEX idx_quadrant_summary_updated_at ON quadrant_summary (updated_at);
+
+    -- Sky coverage of each filter (see ztf_reference_ingest.moc): sorted
+    -- [start, end) ranges of nested HEALPix pixels at moc_order, flattened,
+    -- split by the pixel of order 3 (chunk) they lie in
+    CREATE TABLE coverage (
+        filterid   smallint    NOT NULL,
+        chunk      integer     NOT NULL,
+        moc_order  smallint    NOT NULL,
+        ranges     bigint[]    NOT NULL,
+        updated_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (filterid, chunk)
+    );
+
+    -- Sources of the same star in the zg/zr/zi catalogs of one quadrant,
+    -- rebuilt by ingest whenever one of those catalogs is loaded
+    CREATE TABLE band_association (
+        fieldid     integer          NOT NULL,
+        ccdid       smallint         NOT NULL,
+        qid         smallint         NOT NULL,
+        associd     integer          NOT NULL,
+        ra          double precision NOT NULL,
+        dec         double precision NOT NULL,
+        coord       spoint           NOT NULL,
+        zg_sourceid integer,
+        zr_sourceid integer,
+        zi_sourceid integer,
+        PRIMARY KEY (fieldid, ccdid, qid, associd)
+    );
+
+    CREATE INDEX idx_band_association_coord ON band_association USING GIST (coord);
+    CREATE UNIQUE INDEX idx_band_association_zg ON band_association (fieldid, ccdid, qid, zg_sourceid);
+    CREATE UNIQUE INDEX idx_band_association_zr ON band_association (fieldid, ccdid, qid, zr_sourceid);
+    CREATE UNIQUE INDEX idx_band_association_zi ON band_association (fieldid, ccdid, qid, zi_sourceid);
+
+    CREATE TABLE xmatch_job (
+        job_id        uuid        PRIMARY KEY,
+        status        text        NOT NULL DEFAULT 'queued'
+                                  CHECK (status IN ('queued', 'running', 'done', 'failed')),
+        format        text        NOT NULL,
+        radius_arcsec real        NOT NULL,
+        filter        varchar(2),
+        n_rows        bigint,
+        n_processed   bigint      NOT NULL DEFAULT 0,
+        n_matched     bigint      NOT NULL DEFAULT 0,
+        error         text,
+        created_at    timestamptz NOT NULL DEFAULT now(),
+        started_at    timestamptz,
+        -- Touched by the worker running the job; a running job not touched
+        -- for a while has lost its worker and is claimed again
+        heartbeat_at  timestamptz,
+        -- Incremented on every claim; a worker only updates the job while
+        -- the attempt it claimed is the current one
+        attempt       integer     NOT NULL DEFAULT 0,
+        finished_at   timestamptz
+    );
+
+    CREATE INDEX idx_xmatch_job_queued ON xmatch_job (created_at) WHERE status = 'queued';
+
+    -- Load the indexes behind the API lookups into shared buffers; called by
+    -- the app on startup, pg_prewarm itself would need rights on each index
+    CREATE FUNCTION prewarm_catalog() RETURNS bigint
+    LANGUAGE sql SECURITY DEFINER SET search_path = public, pg_temp
+    AS \$\$
+        SELECT coalesce(sum(pg_prewarm(rel)), 0)
+        FROM unnest(ARRAY[
+            'quadrant', 'quadrant_pkey', 'quadrant_fieldid_filterid_ccdid_qid_key',
+            'refpsfcat_pkey', 'idx_refpsfcat_coord', 'idx_refpsfcat_oid',
+            'band_association_pkey', 'idx_band_association_coord'
+        ]::regclass[]) AS rel
+    \$\$;
+    REVOKE ALL ON FUNCTION prewarm_catalog() FROM public;
+    GRANT EXECUTE ON FUNCTION prewarm_catalog() TO app;
+
+    -- Blue/green reload (see ztf_reference_ingest.shadow): ingest builds a
+    -- complete catalog in catalog_next, and swap_catalog() exchanges it with
+    -- the one in public in a single transaction. The previous catalog is
+    -- left in catalog_next, so calling it again rolls back.
+    CREATE SCHEMA catalog_next AUTHORIZATION ingest;
+
+    -- One row per swap; the app reloads its caches when the generation changes
+    CREATE TABLE catalog_generation (
+        generation bigint      GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        source     name        NOT NULL,
+        swapped_at timestamptz NOT NULL DEFAULT now()
+    );
+
+    CREATE FUNCTION swap_catalog(source name) RETURNS bigint
+    LANGUAGE plpgsql SECURITY DEFINER SET search_path = public, pg_temp
+    AS \$\$
+    DECLARE
+        rel record;
+        acl record;
+        source_owner name;
+        new_generation bigint;
+    BEGIN
+        SELECT nspowner::regrole::name INTO STRICT source_owner
+        FROM pg_namespace WHERE nspname = source AND nspname <> 'public';
+        -- Wait for running queries only briefly, rather than hold up every
+        -- query queued behind the swap
+        PERFORM set_config('lock_timeout', '5s', true);
+        CREATE SCHEMA catalog_swapping;
+        FOR rel IN
+            SELECT * FROM (VALUES
+                ('VIEW', 'refpsfcat_full'),
+                ('TABLE', 'quadrant'), ('TABLE', 'refpsfcat'),
+                ('TABLE', 'band_association'), ('TABLE', 'quadrant_summary'),
+                ('TABLE', 'coverage'), ('TABLE', 'ingest_metadata')
+            ) AS r (kind, name)
+        LOOP
+            -- The incoming relation takes the owner and grants of the live one
+            EXECUTE format('ALTER %s %I.%I OWNER TO %I', rel.kind, source, rel.name, current_user);
+            FOR acl IN
+                SELECT a.grantee, a.privilege_type
+                FROM pg_class c, aclexplode(c.relacl) a
+                WHERE c.oid = format('public.%I', rel.name)::regclass AND a.grantee <> c.relowner
+            LOOP
+                EXECUTE format(
+                    'GRANT %s ON %I.%I TO %s', acl.privilege_type, source, rel.name,
+                    CASE WHEN acl.grantee = 0 THEN 'PUBLIC' ELSE acl.grantee::regrole::text END
+                );
+            END LOOP;
+            -- and the outgoing one goes to the owner of the schema it leaves
+            -- for, who will drop it on the next reload
+            EXECUTE format('ALTER %s public.%I OWNER TO %I', rel.kind, rel.name, source_owner);
+
+            EXECUTE format('ALTER %s public.%I SET SCHEMA catalog_swapping', rel.kind, rel.name);
+            EXECUTE format('ALTER %s %I.%I SET SCHEMA public', rel.kind, source, rel.name);
+            EXECUTE format('ALTER %s catalog_swapping.%I SET SCHEMA %I', rel.kind, rel.name, source);
+        END LOOP;
+        DROP SCHEMA catalog_swapping;
+        INSERT INTO catalog_generation (source) VALUES (source)
+        RETURNING generation INTO new_generation;
+        RETURN new_generation;
+    END
+    \$\$;
+    REVOKE ALL ON FUNCTION swap_catalog(name) FROM public;
+    GRANT EXECUTE ON FUNCTION swap_catalog(name) TO ingest;
+
     GRANT SELECT ON quadrant TO app;
     GRANT SELECT ON refpsfcat TO app;
     GRANT SELECT ON refpsfcat_full TO app;
+    GRANT SELECT ON band_association TO app;
+    GRANT SELECT ON quadrant_summary TO app;
+    GRANT SELECT ON coverage TO app;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON xmatch_job TO app;
+    GRANT SELECT ON catalog_generation TO app;
+    -- Versions of the fields, to tell which search shards are up to date
+    GRANT SELECT ON ingest_metadata TO app;
+    GRANT SELECT ON catalog_generation TO ingest;
     GRANT SELECT, INSERT, UPDATE, DELETE ON quadrant TO ingest;
     GRANT SELECT, INSERT, UPDATE, DELETE ON refpsfcat TO ingest;
     GRANT SELECT, INSERT, UPDATE, DELETE ON ingest_metadata TO ingest;
+    GRANT SELECT ON refpsfcat_full TO ingest;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON band_association TO ingest;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON quadrant_summary TO ingest;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON coverage TO ingest;
     GRANT MAINTAIN ON quadrant TO ingest;
     GRANT MAINTAIN ON refpsfcat TO ingest;
+    GRANT MAINTAIN ON band_association TO ingest;
+    GRANT MAINTAIN ON ingest_metadata TO ingest;
+    GRANT MAINTAIN ON quadrant_summary TO ingest;
+    GRANT MAINTAIN ON coverage TO ingest;
+    -- pgstattuple, to measure index bloat after ingest
+    GRANT pg_stat_scan_tables TO ingest;
+    -- wait events of the app's queries and replication lag, which ingest
+    -- backs off on
+    GRANT pg_read_all_stats TO ingest;
     REVOKE CREATE ON SCHEMA public FROM public;
 EOSQL
@@ -1,7 +1,27 @@
 import os
+import re
+import uuid
+from pathlib import Path
 
 import pytest
 
+SCHEMA_SCRIPT = (
+    Path(__file__).parent.parent
+    / "sql"
+    / "docker-entrypoint-initdb.d"
+    / "01-init-schema.sh"
+)
+
+
+def schema_sql() -> str:
+    """The SQL of the schema script, without the roles, which the test
+    server already has."""
+    script = SCHEMA_SCRIPT.read_text()
+    sql = script.split("<<-EOSQL\n", 1)[1].rsplit("EOSQL", 1)[0]
+    sql = re.sub(r"^\s*CREATE USER \w+;$", "", sql, flags=re.MULTILINE)
+    return sql.replace("\\$", "$")
+
+
 # Only load app-related fixtures when asyncpg is available (app test environment)
 try:
     import asyncpg
@@ -33,32 +53,101 @@ try:
             )
             await con.execute(
                 """
-                INSERT INTO refpsfcat (fieldid, filter, ccdid, qid, sourceid, xpos, ypos, ra, dec, coord,
+                INSERT INTO refpsfcat (fieldid, filterid, ccdid, qid, sourceid, xpos, ypos, coord,
                                        flux, sigflux, mag, sigmag, snr, chi, sharp, flags)
                 VALUES
-                    (202, 'zg', 10, 1, 0, 119.791, 61.432, 24.9859705, -29.6089428,
+                    (202, 1, 10, 1, 0, 119.791, 61.432,
                      spoint(radians(24.9859705), radians(-29.6089428)),
                      237.02818, 18.01066, -5.937, 0.083, 13.16, 1.009, -0.058, 0),
-                    (202, 'zg', 10, 1, 1, 1354.238, 62.677, 25.3803179, -29.6047335,
+                    (202, 1, 10, 1, 1, 1354.238, 62.677,
                      spoint(radians(25.3803179), radians(-29.6047335)),
                      68.48572, 21.969954, -4.589, 0.348, 3.12, 1.459, -0.452, 0),
-                    (202, 'zr', 10, 1, 0, 119.791, 61.432, 24.9859705, -29.6089428,
+                    (202, 2, 10, 1, 0, 119.791, 61.432,
                      spoint(radians(24.9859705), radians(-29.6089428)),
                      310.50000, 15.20000, -6.230, 0.053, 20.43, 0.995, -0.041, 0)
                 ON CONFLICT DO NOTHING
                 """
             )
+            await con.execute(
+                """
+                INSERT INTO band_association (fieldid, ccdid, qid, associd, ra, dec, coord,
+                                              zg_sourceid, zr_sourceid, zi_sourceid)
+                VALUES
+                    (202, 10, 1, 0, 24.9859705, -29.6089428,
+                     spoint(radians(24.9859705), radians(-29.6089428)), 0, 0, NULL),
+                    (202, 10, 1, 1, 25.3803179, -29.6047335,
+                     spoint(radians(25.3803179), radians(-29.6047335)), 1, NULL, NULL)
+                ON CONFLICT DO NOTHING
+                """
+            )
+            await con.execute(
+                """
+                INSERT INTO quadrant_summary (fieldid, filter, ccdid, qid, n_sources,
+                                              mag_min, mag_max, sigmag_median, region)
+                VALUES
+                    (202, 'zg', 10, 1, 2, 20.388, 21.736, 0.2155,
+                     scircle(spoint(radians(25.1831442), radians(-29.6068382)), radians(0.172))),
+                    (202, 'zr', 10, 1, 1, 19.960, 19.960, 0.053,
+                     scircle(spoint(radians(24.9859705), radians(-29.6089428)), 0.0))
+                ON CONFLICT DO NOTHING
+                """
+            )
+            # Order 11 cells of the sources above
+            await con.execute(
+                """
+                INSERT INTO coverage (filterid, chunk, moc_order, ranges)
+                VALUES
+                    (1, 557, 11, '{36548718, 36548719, 36549121, 36549122}'),
+                    (2, 557, 11, '{36549121, 36549122}')
+                ON CONFLICT DO NOTHING
+                """
+            )
             await con.execute("ANALYZE quadrant")
             await con.execute("ANALYZE refpsfcat")
         await pool.close()
 
     @pytest_asyncio.fixture
-    async def client(aiohttp_client, seed_db, db_params):
+    async def client(aiohttp_client, seed_db, db_params, tmp_path):
         os.environ["DB_HOST"] = db_params["host"]
         os.environ["DB_NAME"] = db_params["database"]
         os.environ["DB_USER"] = db_params["user"]
+        os.environ["XMATCH_DIR"] = str(tmp_path / "xmatch")
+        os.environ["TILES_DIR"] = str(tmp_path / "tiles")
         app = await get_app()
         return await aiohttp_client(app)
 
 except ImportError:
     pass
+
+
+# Ingest tests against a database of their own (ingest test environment)
+try:
+    import psycopg
+
+    def _test_conninfo(dbname: str, user: str | None = None) -> str:
+        host = os.environ.get("TEST_DB_HOST", "localhost")
+        user = user or os.environ.get("TEST_DB_USER", "ztfref")
+        return f"host={host} dbname={dbname} user={user}"
+
+    @pytest.fixture
+    def scratch_db():
+        """Conninfo of an empty database of its own, dropped after the test."""
+        admin = _test_conninfo(os.environ.get("TEST_DB_NAME", "ztfref"))
+        name = f"ztfref_test_{uuid.uuid4().hex[:12]}"
+        with psycopg.connect(admin, autocommit=True) as conn:
+            conn.execute(f"CREATE DATABASE {name}")
+        try:
+            yield _test_conninfo(name)
+        finally:
+            with psycopg.connect(admin, autocommit=True) as conn:
+                conn.execute(f"DROP DATABASE {name} WITH (FORCE)")
+
+    @pytest.fixture
+    def catalog_db(scratch_db):
+        """Conninfo of a database with the current schema and no data."""
+        with psycopg.connect(scratch_db, autocommit=True) as conn:
+            conn.execute(schema_sql())
+        return scratch_db
+
+except ImportError:
+    pass
@@ -1,16 +1,108 @@
+import json
 import math
 from pathlib import Path
 
+import astropy.units as u
+import click
+import numpy as np
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import pytest
+from astropy_healpix import HEALPix
+from click.testing import CliRunner
 
+from ztf_reference_ingest.__main__ import expand_local_paths, main
+from ztf_reference_ingest.associate import associate
 from ztf_reference_ingest.discover import FileRef, generate_all_refs
 from ztf_reference_ingest.fits import parse_fits
+from ztf_reference_ingest.maintenance import (
+    REINDEX_BYTES_PER_SECOND,
+    TableActivity,
+    bloat_fraction,
+    churn,
+    plan,
+    rebuild_seconds,
+)
+from ztf_reference_ingest.moc import (
+    CHUNK_SHIFT,
+    MOC_ORDER,
+    cells,
+    cells_to_ranges,
+    union_ranges,
+)
+from ztf_reference_ingest.parquet import (
+    PARTITION_ORDER,
+    SCHEMA,
+    SORT_ORDER,
+    changed_quadrants,
+    partition_batch,
+    partition_path,
+    partition_table,
+    read_manifest,
+    write_manifest,
+    write_metadata,
+    write_partition,
+)
+from ztf_reference_ingest.shards import (
+    INDEX_ORDER,
+    SHARD_ORDER,
+    SOURCE_DTYPE,
+    _remove_others,
+    shard_key,
+    shard_path,
+    write_shard,
+)
+from ztf_reference_ingest.summary import summarize
+from ztf_reference_ingest.throttle import MIN_FACTOR, Throttle, adjust, copy_bytes
+from ztf_reference_ingest.tiles import (
+    TILE_MAX_ORDER,
+    _bounding_circle,
+    _read_tile,
+    _write_tile,
+    tile_path,
+)
+from ztf_reference_ingest.tiles import read_manifest as read_tile_manifest
+from ztf_reference_ingest.tiles import write_manifest as write_tile_manifest
 
 
 FIXTURES_DIR = Path(__file__).parent / "fixtures"
 EXAMPLE_FITS = FIXTURES_DIR / "ztf_000202_zg_c10_q1_refpsfcat.fits"
 
 
+class TestLocalPaths:
+    def test_directory_glob_and_file(self, tmp_path):
+        a = tmp_path / "000" / "field000202" / "ztf_000202_zg_c10_q1_refpsfcat.fits"
+        b = tmp_path / "ztf_000203_zr_c01_q4_refpsfcat.fits"
+        other = tmp_path / "000" / "notes.txt"
+        for path in (a, b, other):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        assert expand_local_paths((str(tmp_path / "000"),)) == [a]
+        assert expand_local_paths((str(tmp_path / "**" / "*.fits"), str(b))) == sorted(
+            [a, b]
+        )
+
+    def test_missing(self, tmp_path):
+        with pytest.raises(click.BadParameter):
+            expand_local_paths((str(tmp_path / "*.fits"),))
+
+
+class TestShadowOptions:
+    @pytest.mark.parametrize(
+        "args,env",
+        [
+            (["--fieldid", "202"], {}),
+            (["--filter", "zg"], {}),
+            ([], {"INGEST_QID": "1"}),
+            (["--from-file", "catalogs"], {}),
+        ],
+    )
+    def test_subset_rejected(self, args, env):
+        result = CliRunner().invoke(main, ["--shadow", *args], env=env)
+        assert result.exit_code == 2
+        assert "--shadow loads the whole catalog" in result.output
+
+
 class TestFileRef:
     def test_root_small_field(self):
         ref = FileRef(fieldid=202, filter="zg", ccdid=10, qid=1)
@@ -56,22 +148,21 @@ class TestParseFits:
     def test_row_structure(self):
         catalog = parse_fits(EXAMPLE_FITS)
         row = catalog.rows[0]
-        # 18 source-level columns
-        assert len(row) == 18
-        # fieldid, filter, ccdid, qid, sourceid, xpos, ypos, ra, dec, coord, flux, ...
+        # 16 source-level columns
+        assert len(row) == 16
+        # fieldid, filterid, ccdid, qid, sourceid, xpos, ypos, coord, flux, ...
         assert row[0] == 202  # fieldid
-        assert row[1] == "zg"  # filter
+        assert row[1] == 1  # filterid (zg)
         assert row[2] == 10  # ccdid
         assert row[3] == 1  # qid
         assert isinstance(row[4], int)  # sourceid
-        assert isinstance(row[7], float)  # ra
-        assert isinstance(row[8], float)  # dec
-        assert isinstance(row[9], str)  # coord (spoint text)
+        assert isinstance(row[7], str)  # coord (spoint text)
+        assert len(catalog.ra) == len(catalog.dec) == len(catalog.rows)
 
     def test_coord_format(self):
         catalog = parse_fits(EXAMPLE_FITS)
         row = catalog.rows[0]
-        coord = row[9]
+        coord = row[7]
         # Should be "(ra_rad, dec_rad)" format
         assert coord.startswith("(")
         assert coord.endswith(")")
@@ -79,5 +170,335 @@ class TestParseFits:
         assert len(parts) == 2
         ra_rad = float(parts[0])
         dec_rad = float(parts[1])
-        assert abs(math.degrees(ra_rad) - row[7]) < 0.0001
-        assert abs(math.degrees(dec_rad) - row[8]) < 0.0001
+        assert abs(math.degrees(ra_rad) - catalog.ra[0]) < 0.0001
+        assert abs(math.degrees(dec_rad) - catalog.dec[0]) < 0.0001
+
+
+class TestTiles:
+    def test_tile_path(self):
+        path = tile_path(Path("/tiles"), "zg", 7, 142770)
+        assert path == Path("/tiles/zg/Norder7/Dir140000/Npix142770.tsv")
+
+    def test_write_read_roundtrip(self, tmp_path):
+        path = tile_path(tmp_path, "zr", 3, 557)
+        rows = [("20221001000000000", 24.98, -29.6, 20.4, 0.08)]
+        _write_tile(path, rows)
+        assert path.read_text().splitlines()[0] == "oid\tra\tdec\tmag\tsigmag"
+        assert _read_tile(path) == rows
+
+    def test_empty_tile_is_removed(self, tmp_path):
+        path = tile_path(tmp_path, "zr", 3, 557)
+        _write_tile(path, [("20221001000000000", 24.98, -29.6, 20.4, 0.08)])
+        _write_tile(path, [])
+        assert not path.exists()
+        assert _read_tile(path) == []
+
+    def test_manifest_roundtrip(self, tmp_path):
+        assert read_tile_manifest(tmp_path) == {}
+        quadrants = {(202, "zg", 10, 1): [142770, 142771], (203, "zr", 1, 4): []}
+        write_tile_manifest(tmp_path, quadrants)
+        assert read_tile_manifest(tmp_path) == quadrants
+
+    def test_manifest_of_other_order(self, tmp_path):
+        (tmp_path / "_manifest.json").write_text(
+            '{"tile_order": 6, "quadrants": [[202, "zg", 10, 1, [1]]]}'
+        )
+        assert read_tile_manifest(tmp_path) == {}
+
+    def test_bounding_circle_covers_sources(self):
+        catalog = parse_fits(EXAMPLE_FITS)
+        ra, dec = catalog.ra, catalog.dec
+        hp = HEALPix(nside=2**TILE_MAX_ORDER, order="nested")
+        pixels = hp.lonlat_to_healpix(ra * u.deg, dec * u.deg)
+        for npix in np.unique(pixels):
+            ra0, dec0, radius = _bounding_circle(hp, npix)
+            inside = pixels == npix
+            cos_sep = np.sin(np.radians(dec[inside])) * np.sin(
+                np.radians(dec0)
+            ) + np.cos(np.radians(dec[inside])) * np.cos(np.radians(dec0)) * np.cos(
+                np.radians(ra[inside] - ra0)
+            )
+            assert np.degrees(np.arccos(np.clip(cos_sep, -1, 1))).max() < radius
+
+
+class TestShards:
+    def _sources(self, n=500):
+        rng = np.random.default_rng(0)
+        sources = np.zeros(n, dtype=SOURCE_DTYPE)
+        sources["ccdid"] = rng.integers(1, 17, n)
+        sources["qid"] = rng.integers(1, 5, n)
+        sources["sourceid"] = np.arange(n)
+        sources["ra"] = rng.uniform(24.0, 26.0, n)
+        sources["dec"] = rng.uniform(-30.0, -29.0, n)
+        return sources
+
+    def test_write_shard(self, tmp_path):
+        sources = self._sources()
+        path = shard_path(tmp_path, "zg", 202, 1, 42)
+        write_shard(path, 202, "zg", 1, 42, sources)
+        assert [p.name for p in path.parent.iterdir()] == ["1-42"]
+
+        stored = np.load(path / "sources.npy")
+        hpx = np.load(path / "hpx.npy")
+        assert len(stored) == len(sources)
+        assert np.all(np.diff(hpx) >= 0)
+        hp = HEALPix(nside=2**SHARD_ORDER, order="nested")
+        assert np.array_equal(
+            hpx, hp.lonlat_to_healpix(stored["ra"] * u.deg, stored["dec"] * u.deg)
+        )
+
+        keys = np.load(path / "keys.npy")
+        rows = np.load(path / "key_rows.npy")
+        assert np.all(np.diff(keys) > 0)
+        src = sources[123]
+        i = np.searchsorted(keys, shard_key(src["ccdid"], src["qid"], src["sourceid"]))
+        assert stored[rows[i]] == src
+
+        meta = json.loads((path / "meta.json").read_text())
+        shift = 2 * (SHARD_ORDER - INDEX_ORDER)
+        assert meta["pixels"] == np.unique(hpx >> shift).tolist()
+        assert (meta["fieldid"], meta["filter"], meta["version"]) == (202, "zg", 42)
+
+    def test_remove_others(self, tmp_path):
+        old = shard_path(tmp_path, "zg", 202, 1, 41)
+        new = shard_path(tmp_path, "zg", 202, 1, 42)
+        write_shard(old, 202, "zg", 1, 41, self._sources(10))
+        write_shard(new, 202, "zg", 1, 42, self._sources(10))
+        _remove_others(new.parent, new)
+        assert list(new.parent.iterdir()) == [new]
+        _remove_others(new.parent, None)
+        assert not new.parent.exists()
+
+
+class TestParquet:
+    def _rows(self, n=2000):
+        # Sources around the center of pixel 100, some of them in its neighbours
+        hp = HEALPix(nside=2**PARTITION_ORDER, order="nested")
+        ra0, dec0, radius = _bounding_circle(hp, 100)
+        rng = np.random.default_rng(0)
+        ra = ra0 + rng.uniform(-radius, radius, n)
+        dec = dec0 + rng.uniform(-radius, radius, n)
+        return [
+            (202, "zg", 10, 1, i, 1.0, 2.0, ra[i], dec[i], *[float(i)] * 7, 0)
+            + (26.0, 0.5, 0.25, 0, f"2021101{i:08d}")
+            for i in range(n)
+        ]
+
+    def test_changed_quadrants(self):
+        exported = {(202, "zg", 10, 1): 1, (202, "zg", 10, 2): 1, (202, "zr", 1, 1): 1}
+        current = {(202, "zg", 10, 1): 1, (202, "zg", 10, 2): 2, (203, "zg", 1, 1): 1}
+        assert changed_quadrants(exported, current) == {
+            (202, "zg", 10, 2),
+            (202, "zr", 1, 1),
+            (203, "zg", 1, 1),
+        }
+
+    def test_partition_table(self):
+        rows = self._rows()
+        table = partition_table([partition_batch(rows, 100)])
+        assert table.schema == SCHEMA
+        assert 0 < table.num_rows < len(rows)
+        hpx = table["hpx"].to_numpy()
+        assert np.all(np.diff(hpx) >= 0)
+        assert np.all(hpx >> 2 * (SORT_ORDER - PARTITION_ORDER) == 100)
+        row = rows[table["sourceid"][0].as_py()]
+        assert table.slice(0, 1).to_pylist()[0] == dict(
+            zip(SCHEMA.names, (*row, int(hpx[0])))
+        )
+        assert partition_table([]).num_rows == 0
+        assert partition_table([partition_batch([], 100)]).num_rows == 0
+        # Read in batches, the partition is the same
+        batches = [partition_batch(rows[i : i + 300], 100) for i in range(0, 2000, 300)]
+        assert partition_table(batches).equals(table)
+
+    def test_write_partition(self, tmp_path):
+        table = partition_table([partition_batch(self._rows(), 100)])
+        path = partition_path(tmp_path, 100)
+        write_partition(path, table)
+        assert write_metadata(tmp_path) == 1
+
+        footer = pq.read_metadata(tmp_path / "_metadata")
+        assert footer.num_rows == table.num_rows
+        stats = footer.row_group(0).column(SCHEMA.get_field_index("ra")).statistics
+        assert stats.min == min(table["ra"].to_pylist())
+
+        dataset = ds.dataset(tmp_path, partitioning="hive")
+        assert dataset.to_table(filter=ds.field("Npix") == 100).num_rows == len(table)
+        assert dataset.to_table(filter=ds.field("Npix") == 101).num_rows == 0
+
+        write_partition(path, table.slice(0, 0))
+        assert not path.parent.exists()
+
+    def test_manifest(self, tmp_path):
+        assert read_manifest(tmp_path) == {"generation": None, "quadrants": {}}
+        quadrants = {(202, "zg", 10, 1): (123, [100, 101])}
+        write_manifest(tmp_path, 3, quadrants)
+        assert read_manifest(tmp_path) == {"generation": 3, "quadrants": quadrants}
+
+
+class TestAssociate:
+    def test_matches_across_bands(self):
+        groups = associate(
+            {
+                "zg": (
+                    np.array([0, 1]),
+                    np.array([25.0, 25.01]),
+                    np.array([-29.6, -29.6]),
+                ),
+                "zr": (np.array([7]), np.array([25.0001]), np.array([-29.6])),
+                "zi": (np.array([3]), np.array([25.02]), np.array([-29.6])),
+            }
+        )
+        members = [group for _, _, group in groups]
+        assert members == [{"zg": 0, "zr": 7}, {"zg": 1}, {"zi": 3}]
+        ra, dec, _ = next(g for g in groups if g[2] == {"zg": 0, "zr": 7})
+        assert ra == pytest.approx(25.00005)
+        assert dec == pytest.approx(-29.6)
+
+    def test_one_to_one(self):
+        # Both zr sources are within the radius, only the closest one links
+        groups = associate(
+            {
+                "zg": (np.array([0]), np.array([10.0]), np.array([0.0])),
+                "zr": (
+                    np.array([1, 2]),
+                    np.array([10.0001, 10.0002]),
+                    np.array([0.0, 0.0]),
+                ),
+            }
+        )
+        members = [group for _, _, group in groups]
+        assert members == [{"zg": 0, "zr": 1}, {"zr": 2}]
+
+    def test_ra_wrap(self):
+        groups = associate(
+            {
+                "zg": (np.array([0]), np.array([359.99995]), np.array([10.0])),
+                "zr": (np.array([1]), np.array([0.00005]), np.array([10.0])),
+            }
+        )
+        assert [group for _, _, group in groups] == [{"zg": 0, "zr": 1}]
+        ra, _, _ = groups[0]
+        assert min(ra, 360.0 - ra) < 1e-6
+
+
+class TestSummary:
+    def test_summarize_example(self):
+        catalog = parse_fits(EXAMPLE_FITS)
+        n, mag_min, mag_max, sigmag_median, region = summarize(
+            catalog.mag + catalog.magzp, catalog.sigmag, catalog.ra, catalog.dec
+        )
+        assert n == len(catalog.rows)
+        assert mag_min <= mag_max
+        assert sigmag_median == pytest.approx(np.nanmedian(catalog.sigmag))
+
+        center, radius = region.strip("<>").rsplit(",", 1)
+        c_ra, c_dec = (float(x) for x in center.strip(" ()").split(","))
+        ra, dec = np.radians(catalog.ra), np.radians(catalog.dec)
+        cos_sep = np.sin(dec) * np.sin(c_dec) + np.cos(dec) * np.cos(c_dec) * np.cos(
+            ra - c_ra
+        )
+        assert np.arccos(np.clip(cos_sep, -1.0, 1.0)).max() <= float(radius)
+
+    def test_summarize_nan_and_empty(self):
+        assert summarize(
+            np.array([np.nan, 20.0]),
+            np.array([0.1, np.nan]),
+            np.array([10.0, 10.001]),
+            np.array([0.0, 0.0]),
+        )[:4] == (2, 20.0, 20.0, 0.1)
+        empty = np.array([])
+        assert summarize(empty, empty, empty, empty) == (0, None, None, None, None)
+
+
+class TestMaintenance:
+    def test_plan(self):
+        activity = {
+            "refpsfcat": TableActivity(
+                changed=0, live=1000, dead=400, modified_since_analyze=800
+            ),
+            "quadrant": TableActivity(
+                changed=0, live=1000, dead=10, modified_since_analyze=100
+            ),
+            "coverage": TableActivity(
+                changed=0, live=1000, dead=0, modified_since_analyze=1
+            ),
+            "ingest_metadata": TableActivity(
+                changed=0, live=0, dead=0, modified_since_analyze=5
+            ),
+        }
+        tasks = plan(activity)
+        assert [(t.table, t.vacuum, t.analyze) for t in tasks] == [
+            ("ingest_metadata", False, True),
+            ("refpsfcat", True, True),
+            ("quadrant", False, True),
+        ]
+
+    def test_churn(self):
+        before = {
+            "refpsfcat": TableActivity(100, 0, 0, 0),
+            "quadrant": TableActivity(50, 0, 0, 0),
+        }
+        after = {
+            "refpsfcat": TableActivity(160, 0, 0, 0),
+            "quadrant": TableActivity(5, 0, 0, 0),
+            "coverage": TableActivity(7, 0, 0, 0),
+        }
+        assert churn(before, after) == {"refpsfcat": 60, "quadrant": 0, "coverage": 7}
+        assert churn(None, after) == {}
+
+    def test_bloat_fraction(self):
+        # A fresh build leaves 10% free at fillfactor 90, which is no bloat
+        assert bloat_fraction(1000, 100, 90) == 0.0
+        assert bloat_fraction(1000, 80, 90) == 0.0
+        assert bloat_fraction(1000, 600, 90) == pytest.approx(0.5)
+        assert bloat_fraction(1000, 600, 100) == pytest.approx(0.6)
+        assert bloat_fraction(0, 0, 90) == 0.0
+
+    def test_rebuild_seconds(self):
+        assert rebuild_seconds(60 * REINDEX_BYTES_PER_SECOND) == 60.0
+
+
+class TestThrottle:
+    def test_adjust(self):
+        assert adjust(1.0, pressure=True) == 0.5
+        assert adjust(MIN_FACTOR, pressure=True) == MIN_FACTOR
+        assert adjust(0.5, pressure=False) == pytest.approx(0.6)
+        assert adjust(0.95, pressure=False) == 1.0
+
+    def test_allowed_writers(self):
+        throttle = Throttle(max_writers=10)
+        assert throttle.allowed_writers() == 10
+        throttle.factor = 0.3
+        assert throttle.allowed_writers() == 3
+        throttle.factor = MIN_FACTOR
+        assert throttle.allowed_writers() == 0
+
+    def test_copy_bytes(self):
+        assert copy_bytes([(1, "ab", 2.5), (2, "cd", 3.5)]) == 2 * 9
+        assert copy_bytes([]) == 0
+
+
+class TestMoc:
+    def test_cells_to_ranges(self):
+        ranges = cells_to_ranges(np.array([3, 4, 5, 9, 11, 12]))
+        assert ranges.tolist() == [[3, 6], [9, 10], [11, 13]]
+        assert cells_to_ranges(np.array([], dtype=np.int64)).shape == (0, 2)
+
+    # Shared with the tests of the app's copy of union_ranges
+    @pytest.mark.parametrize(
+        "case", json.loads((FIXTURES_DIR / "union_ranges.json").read_text())
+    )
+    def test_union_ranges(self, case):
+        merged = union_ranges(*(np.array(r) for r in case["inputs"]))
+        assert merged.shape == (len(case["expected"]), 2)
+        assert merged.tolist() == case["expected"]
+
+    def test_example_cells(self):
+        catalog = parse_fits(EXAMPLE_FITS)
+        pixels = cells(catalog.ra, catalog.dec)
+        hp = HEALPix(nside=2**MOC_ORDER, order="nested")
+        expected = hp.lonlat_to_healpix(catalog.ra * u.deg, catalog.dec * u.deg)
+        assert set(pixels.tolist()) == set(expected.tolist())
+        # A quadrant spans few chunks
+        assert len(np.unique(pixels >> CHUNK_SHIFT)) <= 4
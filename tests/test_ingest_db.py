@@ -0,0 +1,409 @@
+"""Ingest tests against a PostgreSQL server with pg_sphere, each in a
+database of its own (see the scratch_db fixture)."""
+
+import dataclasses
+from pathlib import Path
+
+import psycopg
+import pytest
+from psycopg.conninfo import make_conninfo
+
+from ztf_reference_ingest.db import ingest_catalog
+from ztf_reference_ingest.discover import FileRef
+from ztf_reference_ingest.fits import ParsedCatalog, parse_fits
+from ztf_reference_ingest.migrate import (
+    add_job_attempts,
+    add_job_heartbeats,
+    add_object_ids,
+    add_pixel_index,
+    compact,
+    is_migrated,
+)
+from ztf_reference_ingest.shadow import (
+    SHADOW_SCHEMA,
+    finish_shadow,
+    prepare_shadow,
+    shadow_conninfo,
+    swap,
+)
+from ztf_reference_ingest.tiles import TILE_MAX_ORDER, build_tiles
+
+EXAMPLE_FITS = (
+    Path(__file__).parent / "fixtures" / "ztf_000202_zg_c10_q1_refpsfcat.fits"
+)
+EXAMPLE_REF = FileRef(fieldid=202, filter="zg", ccdid=10, qid=1)
+
+# Tables ingest writes for a quadrant
+QUADRANT_TABLES = (
+    "quadrant",
+    "refpsfcat",
+    "band_association",
+    "quadrant_summary",
+    "coverage",
+    "ingest_metadata",
+)
+
+# The layout before the compact one, with the tables added alongside it
+OLD_LAYOUT_SQL = """
+    CREATE EXTENSION IF NOT EXISTS pg_sphere;
+    CREATE EXTENSION IF NOT EXISTS pg_prewarm;
+    CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+    CREATE TABLE quadrant (
+        fieldid     integer    NOT NULL,
+        filter      varchar(2) NOT NULL CHECK (filter IN ('zg', 'zr', 'zi')),
+        ccdid       smallint   NOT NULL,
+        qid         smallint   NOT NULL,
+        magzp       real       NOT NULL,
+        magzp_rms   real       NOT NULL,
+        magzp_unc   real       NOT NULL,
+        infobits    integer    NOT NULL,
+        PRIMARY KEY (fieldid, filter, ccdid, qid)
+    );
+
+    CREATE TABLE refpsfcat (
+        fieldid     integer          NOT NULL,
+        filter      varchar(2)       NOT NULL,
+        ccdid       smallint         NOT NULL,
+        qid         smallint         NOT NULL,
+        sourceid    integer          NOT NULL,
+        xpos        real             NOT NULL,
+        ypos        real             NOT NULL,
+        ra          double precision NOT NULL,
+        dec         double precision NOT NULL,
+        coord       spoint           NOT NULL,
+        flux        real             NOT NULL,
+        sigflux     real             NOT NULL,
+        mag         real             NOT NULL,
+        sigmag      real             NOT NULL,
+        snr         real             NOT NULL,
+        chi         real             NOT NULL,
+        sharp       real             NOT NULL,
+        flags       smallint         NOT NULL,
+        PRIMARY KEY (fieldid, filter, ccdid, qid, sourceid),
+        FOREIGN KEY (fieldid, filter, ccdid, qid) REFERENCES quadrant (fieldid, filter, ccdid, qid)
+    );
+
+    CREATE INDEX idx_refpsfcat_coord ON refpsfcat USING GIST (coord);
+    CREATE INDEX idx_refpsfcat_quadrant ON refpsfcat (fieldid, filter, ccdid, qid);
+
+    CREATE VIEW refpsfcat_full AS
+    SELECT r.fieldid, r.filter, r.ccdid, r.qid, r.sourceid,
+           r.xpos, r.ypos, r.ra, r.dec, r.coord,
+           r.flux, r.sigflux, r.mag, r.sigmag, r.snr, r.chi, r.sharp, r.flags,
+           q.magzp, q.magzp_rms, q.magzp_unc, q.infobits
+    FROM refpsfcat r
+    JOIN quadrant q USING (fieldid, filter, ccdid, qid);
+
+    CREATE TABLE ingest_metadata (
+        fieldid       integer    NOT NULL,
+        filter        varchar(2) NOT NULL,
+        ccdid         smallint   NOT NULL,
+        qid           smallint   NOT NULL,
+        etag          text,
+        last_modified text,
+        content_length bigint,
+        ingested_at   timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (fieldid, filter, ccdid, qid)
+    );
+
+    CREATE TABLE band_association (
+        fieldid     integer          NOT NULL,
+        ccdid       smallint         NOT NULL,
+        qid         smallint         NOT NULL,
+        associd     integer          NOT NULL,
+        coord       spoint           NOT NULL,
+        PRIMARY KEY (fieldid, ccdid, qid, associd)
+    );
+    CREATE INDEX idx_band_association_coord ON band_association USING GIST (coord);
+
+    CREATE TABLE xmatch_job (
+        job_id      uuid PRIMARY KEY,
+        status      text NOT NULL DEFAULT 'queued',
+        started_at  timestamptz
+    );
+
+    GRANT SELECT ON quadrant TO app;
+    GRANT SELECT ON refpsfcat TO app;
+    GRANT SELECT ON refpsfcat_full TO app;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON quadrant TO ingest;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON refpsfcat TO ingest;
+    GRANT SELECT, INSERT, UPDATE, DELETE ON ingest_metadata TO ingest;
+
+    INSERT INTO quadrant VALUES
+        (202, 'zg', 10, 1, 26.325, 0.087, 0.0005, 16),
+        (202, 'zr', 10, 1, 26.190, 0.065, 0.0004, 0);
+    INSERT INTO refpsfcat VALUES
+        (202, 'zg', 10, 1, 0, 119.791, 61.432, 24.9859705, -29.6089428,
+         spoint(radians(24.9859705), radians(-29.6089428)),
+         237.0, 18.0, -5.937, 0.083, 13.16, 1.009, -0.058, 0),
+        (202, 'zg', 10, 1, 1, 1354.238, 62.677, 25.3803179, -29.6047335,
+         spoint(radians(25.3803179), radians(-29.6047335)),
+         68.5, 22.0, -4.589, 0.348, 3.12, 1.459, -0.452, 0),
+        (202, 'zr', 10, 1, 0, 119.791, 61.432, 24.9859705, -29.6089428,
+         spoint(radians(24.9859705), radians(-29.6089428)),
+         310.5, 15.2, -6.230, 0.053, 20.43, 0.995, -0.041, 2);
+    INSERT INTO ingest_metadata (fieldid, filter, ccdid, qid) VALUES
+        (202, 'zg', 10, 1), (202, 'zr', 10, 1);
+"""
+
+
+def _indexes(conn: psycopg.Connection, table: str, schema: str = "public") -> set[str]:
+    return {
+        name
+        for (name,) in conn.execute(
+            """
+            SELECT indexname FROM pg_indexes
+            WHERE schemaname = %s AND tablename = %s
+            """,
+            (schema, table),
+        )
+    }
+
+
+def _exists(conn: psycopg.Connection, relation: str) -> bool:
+    return conn.execute("SELECT to_regclass(%s)", (relation,)).fetchone()[0] is not None
+
+
+def _can(conn: psycopg.Connection, role: str, relation: str, privilege: str) -> bool:
+    return conn.execute(
+        "SELECT has_table_privilege(%s, %s, %s)", (role, relation, privilege)
+    ).fetchone()[0]
+
+
+def _versions(conn: psycopg.Connection) -> dict[str, set[str]]:
+    """The transactions that last wrote each quadrant table's rows."""
+    return {
+        table: {xmin for (xmin,) in conn.execute(f"SELECT xmin::text FROM {table}")}
+        for table in QUADRANT_TABLES
+    }
+
+
+def _sources(conn: psycopg.Connection) -> dict[int, tuple]:
+    return {
+        sourceid: rest
+        for sourceid, *rest in conn.execute(
+            "SELECT sourceid, flux, flags FROM refpsfcat ORDER BY sourceid"
+        )
+    }
+
+
+def _count(conn: psycopg.Connection, relation: str) -> int:
+    return conn.execute(f"SELECT count(*) FROM {relation}").fetchone()[0]
+
+
+def _head(catalog: ParsedCatalog, n: int) -> ParsedCatalog:
+    return dataclasses.replace(
+        catalog,
+        rows=catalog.rows[:n],
+        ra=catalog.ra[:n],
+        dec=catalog.dec[:n],
+        mag=catalog.mag[:n],
+        sigmag=catalog.sigmag[:n],
+    )
+
+
+@pytest.fixture(scope="module")
+def example_catalog() -> ParsedCatalog:
+    return parse_fits(EXAMPLE_FITS)
+
+
+class TestDiffSources:
+    def test_first_load(self, catalog_db, example_catalog):
+        with psycopg.connect(catalog_db, autocommit=True) as conn:
+            count = ingest_catalog(conn, example_catalog, EXAMPLE_REF, diff=True)
+            assert count == len(example_catalog.rows)
+            assert len(_sources(conn)) == len(example_catalog.rows)
+            for table in QUADRANT_TABLES:
+                assert conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0] > 0
+
+    def test_unchanged(self, catalog_db, example_catalog):
+        with psycopg.connect(catalog_db, autocommit=True) as conn:
+            ingest_catalog(conn, example_catalog, EXAMPLE_REF, diff=True)
+            before = _versions(conn)
+            assert ingest_catalog(conn, example_catalog, EXAMPLE_REF, diff=True) == 0
+            after = _versions(conn)
+            # Only the metadata's ingested_at moves
+            assert {t for t in QUADRANT_TABLES if after[t] != before[t]} == {
+                "ingest_metadata"
+            }
+
+    def test_header_only(self, catalog_db, example_catalog):
+        changed = dataclasses.replace(
+            example_catalog, magzp=example_catalog.magzp + 0.1
+        )
+        with psycopg.connect(catalog_db, autocommit=True) as conn:
+            ingest_catalog(conn, example_catalog, EXAMPLE_REF, diff=True)
+            before = _versions(conn)
+            assert ingest_catalog(conn, changed, EXAMPLE_REF, etag="v2", diff=True) == 0
+            after = _versions(conn)
+            # Only the quadrant, its summary and its metadata are rewritten
+            assert {t for t in QUADRANT_TABLES if after[t] != before[t]} == {
+                "quadrant",
+                "quadrant_summary",
+                "ingest_metadata",
+            }
+            magzp, etag = conn.execute(
+                "SELECT magzp, etag FROM quadrant JOIN ingest_metadata "
+                "USING (fieldid, filter, ccdid, qid)"
+            ).fetchone()
+            assert magzp == pytest.approx(changed.magzp)
+            assert etag == "v2"
+
+    def test_updated_added_removed(self, catalog_db, example_catalog):
+        rows = list(example_catalog.rows)
+        first, removed = rows[0], rows.pop(1)
+        rows[0] = first[:8] + (first[8] * 2,) + first[9:15] + (4,)
+        added = rows[-1][:4] + (rows[-1][4] + 1,) + rows[-1][5:]
+        rows.append(added)
+        changed = dataclasses.replace(example_catalog, rows=rows)
+        with psycopg.connect(catalog_db, autocommit=True) as conn:
+            ingest_catalog(conn, example_catalog, EXAMPLE_REF, diff=True)
+            before = _sources(conn)
+            # One updated, one inserted
+            assert ingest_catalog(conn, changed, EXAMPLE_REF, diff=True) == 2
+            after = _sources(conn)
+            assert removed[4] not in after
+            assert after[first[4]] == (pytest.approx(first[8] * 2), 4)
+            assert after[added[4]] == (pytest.approx(added[8]), added[15])
+            unchanged = before.keys() - {first[4], removed[4]}
+            assert {k: after[k] for k in unchanged} == {k: before[k] for k in unchanged}
+            assert len(after) == len(rows)
+
+
+class TestTiles:
+    def test_moved_quadrant(self, catalog_db, example_catalog, tmp_path):
+        with psycopg.connect(catalog_db, autocommit=True) as conn:
+            ingest_catalog(conn, example_catalog, EXAMPLE_REF)
+            build_tiles(conn, tmp_path)
+            before = set(tmp_path.glob(f"*/Norder{TILE_MAX_ORDER}/*/*.tsv"))
+            assert before
+
+            # Re-ingested with its sources elsewhere on the sky
+            since = conn.execute("SELECT now()").fetchone()[0]
+            conn.execute(
+                "UPDATE refpsfcat SET coord = spoint(long(coord) + radians(5),"
+                " lat(coord))"
+            )
+            conn.execute("UPDATE ingest_metadata SET ingested_at = now()")
+            build_tiles(conn, tmp_path, since)
+            after = set(tmp_path.glob(f"*/Norder{TILE_MAX_ORDER}/*/*.tsv"))
+            assert after
+            assert not before & after
+
+
+class TestMigrate:
+    def test_old_layout(self, scratch_db):
+        with psycopg.connect(scratch_db, autocommit=True) as conn:
+            conn.execute(OLD_LAYOUT_SQL)
+            # A shadow catalog, always of the current layout, does not count
+            conn.execute("CREATE SCHEMA catalog_next")
+            conn.execute("CREATE TABLE catalog_next.refpsfcat (filterid smallint)")
+            assert not is_migrated(conn)
+
+            compact(conn)
+            add_object_ids(conn)
+            add_pixel_index(conn)
+            add_job_heartbeats(conn)
+            add_job_attempts(conn)
+
+            assert is_migrated(conn)
+            rows = conn.execute(
+                """
+                SELECT fieldid, filter, filterid, ccdid, qid, sourceid, flags,
+                       round(ra::numeric, 7), round(dec::numeric, 7), magzp, oid
+                FROM refpsfcat_full ORDER BY oid
+                """
+            ).fetchall()
+            assert [row[:7] for row in rows] == [
+                (202, "zg", 1, 10, 1, 0, 0),
+                (202, "zg", 1, 10, 1, 1, 0),
+                (202, "zr", 2, 10, 1, 0, 2),
+            ]
+            assert [float(row[7]) for row in rows] == [
+                24.9859705,
+                25.3803179,
+                24.9859705,
+            ]
+            assert rows[0][9] == pytest.approx(26.325)
+            assert [row[10] for row in rows] == [
+                202110100000000,
+                202110100000001,
+                202210100000000,
+            ]
+            assert _indexes(conn, "refpsfcat") == {
+                "refpsfcat_pkey",
+                "idx_refpsfcat_coord",
+                "idx_refpsfcat_oid",
+                "idx_refpsfcat_pixel",
+            }
+            assert not _exists(conn, "refpsfcat_migration")
+            assert not _exists(conn, "refpsfcat_compact")
+            assert _can(conn, "app", "refpsfcat_full", "SELECT")
+            assert _can(conn, "ingest", "refpsfcat", "INSERT")
+            assert _can(conn, "ingest", "refpsfcat", "MAINTAIN")
+            assert conn.execute("SELECT prewarm_catalog()").fetchone()[0] > 0
+            conn.execute("SELECT heartbeat_at, attempt FROM xmatch_job")
+            assert _can(conn, "app", "xmatch_job", "DELETE")
+
+            # Running it again changes nothing
+            add_object_ids(conn)
+            add_pixel_index(conn)
+            add_job_heartbeats(conn)
+            add_job_attempts(conn)
+            assert (
+                conn.execute("SELECT count(*) FROM refpsfcat_full").fetchone()[0] == 3
+            )
+
+
+class TestShadow:
+    def test_reload_swap_and_rollback(self, catalog_db, example_catalog):
+        # Loaded as ingest would, the live catalog by the table owner
+        ingest_db = make_conninfo(catalog_db, user="ingest")
+        with psycopg.connect(catalog_db, autocommit=True) as conn:
+            ingest_catalog(conn, example_catalog, EXAMPLE_REF)
+            live_indexes = {
+                table: _indexes(conn, table) for table in ("refpsfcat", "quadrant")
+            }
+
+        with psycopg.connect(ingest_db, autocommit=True) as conn:
+            prepare_shadow(conn)
+            for table in QUADRANT_TABLES:
+                assert _count(conn, f"{SHADOW_SCHEMA}.{table}") == 0
+            assert _exists(conn, f"{SHADOW_SCHEMA}.refpsfcat_full")
+            # Only the keys until the load is done
+            assert _indexes(conn, "refpsfcat", SHADOW_SCHEMA) == {"refpsfcat_pkey"}
+
+        with psycopg.connect(shadow_conninfo(ingest_db), autocommit=True) as conn:
+            ingest_catalog(conn, _head(example_catalog, 100), EXAMPLE_REF)
+
+        with psycopg.connect(ingest_db, autocommit=True) as conn:
+            finish_shadow(conn)
+            for table, indexes in live_indexes.items():
+                assert _indexes(conn, table, SHADOW_SCHEMA) == indexes
+            assert _count(conn, "refpsfcat_full") == len(example_catalog.rows)
+
+            assert swap(conn) == 1
+            assert _count(conn, "public.refpsfcat_full") == 100
+            assert _count(conn, f"{SHADOW_SCHEMA}.refpsfcat_full") == len(
+                example_catalog.rows
+            )
+            for table, indexes in live_indexes.items():
+                assert _indexes(conn, table) == indexes
+            # The swapped-in catalog has the live one's grants
+            assert _can(conn, "app", "public.refpsfcat_full", "SELECT")
+            assert _can(conn, "app", "public.coverage", "SELECT")
+            assert _can(conn, "ingest", "public.refpsfcat", "INSERT")
+            assert _can(conn, "ingest", "public.refpsfcat", "MAINTAIN")
+            assert not _can(conn, "app", "public.refpsfcat", "INSERT")
+
+            # Swapping again rolls back
+            assert swap(conn) == 2
+            assert _count(conn, "public.refpsfcat_full") == len(example_catalog.rows)
+            assert conn.execute(
+                "SELECT generation, source FROM catalog_generation ORDER BY 1"
+            ).fetchall() == [(1, SHADOW_SCHEMA), (2, SHADOW_SCHEMA)]
+
+            # The catalog left behind belongs to ingest, which can replace it
+            prepare_shadow(conn)
+            assert _count(conn, f"{SHADOW_SCHEMA}.refpsfcat") == 0
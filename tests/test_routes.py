@@ -1,4 +1,65 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+from pathlib import Path
+from uuid import uuid4
+
+import asyncpg
+import astropy.units as u
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+from asyncpg.exceptions import InvalidCatalogNameError
+from astropy_healpix import HEALPix
+
+from ztf_reference.admission import (
+    Admission,
+    Gate,
+    QueryTimeout,
+    Rejected,
+    TokenBuckets,
+)
+from ztf_reference.catalog import (
+    build_object_id,
+    object_id,
+    parse_object_id,
+    region_query,
+)
+from ztf_reference.coverage import (
+    Coverage,
+    CoverageCache,
+    bounding_circle,
+    union_ranges,
+)
+from ztf_reference.pg_sphere import SBox, SPoint, connection_setup
+from ztf_reference.pools import PoolRouter, parse_hosts
+from ztf_reference.routes import MAX_REGION_RESULTS
+from ztf_reference.shards import (
+    SHARD_ORDER,
+    Selection,
+    Shard,
+    ShardSet,
+    _separation_deg,
+    shard_key,
+)
+from ztf_reference.singleflight import SingleFlight
+from ztf_reference.stats import StatsCache
+from ztf_reference.tiles import tile_file
+from ztf_reference.xmatch import (
+    JobLost,
+    _finish,
+    input_path,
+    job_dir,
+    jobs_dir,
+    partial_path,
+    read_table,
+    result_path,
+    spatial_order,
+    sweep_jobs,
+)
 
 
 async def test_health(client):
@@ -8,12 +69,81 @@ async def test_health(client):
     assert data["status"] == "ok"
 
 
+async def test_ready(client):
+    for _ in range(100):
+        resp = await client.get("/api/v1/ready")
+        if resp.status == 200:
+            break
+        assert resp.status == 503
+        assert (await resp.json())["status"] == "warming up"
+        await asyncio.sleep(0.1)
+    assert resp.status == 200
+    data = await resp.json()
+    assert data["status"] == "ready"
+
+
 async def test_stats(client):
     resp = await client.get("/api/v1/stats")
     assert resp.status == 200
     data = await resp.json()
     assert data["approximate_source_count"] >= 3
     assert data["approximate_quadrant_count"] >= 2
+    assert data["source_count"] == data["approximate_source_count"]
+    assert data["filters"]["zg"]["source_count"] >= 2
+    assert data["filters"]["zr"]["quadrant_count"] >= 1
+
+
+async def test_stats_field(client):
+    resp = await client.get("/api/v1/stats", params={"fieldid": 202})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data["fieldid"] == 202
+    assert data["source_count"] == 3
+    assert data["filters"]["zg"]["source_count"] == 2
+    assert data["mag_min"] == pytest.approx(19.96)
+    assert data["mag_max"] == pytest.approx(21.736)
+    zg = next(q for q in data["quadrants"] if q["filter"] == "zg")
+    assert zg["ccdid"] == 10
+    assert zg["sigmag_median"] == pytest.approx(0.2155)
+    assert zg["region"]["ra"] == pytest.approx(25.1831442)
+    assert zg["region"]["radius_deg"] == pytest.approx(0.172)
+
+
+async def test_stats_cache_late_commit(seed_db, db_params):
+    pool = await asyncpg.create_pool(**db_params, setup=connection_setup)
+    cache = StatsCache()
+    try:
+        await cache.load(pool)
+        async with pool.acquire() as con:
+            # Dated before the load, as a transaction committing late would be
+            await con.execute(
+                """
+                UPDATE quadrant_summary
+                SET n_sources = 7, updated_at = now() - interval '1 day'
+                WHERE fieldid = 202 AND filter = 'zr'
+                """
+            )
+        stats = await cache.load(pool)
+        assert stats.fields[202]["filters"]["zr"]["source_count"] == 7
+    finally:
+        async with pool.acquire() as con:
+            await con.execute(
+                """
+                UPDATE quadrant_summary SET n_sources = 1, updated_at = now()
+                WHERE fieldid = 202 AND filter = 'zr'
+                """
+            )
+        await pool.close()
+
+
+async def test_stats_field_not_found(client):
+    resp = await client.get("/api/v1/stats", params={"fieldid": 999999})
+    assert resp.status == 404
+
+
+async def test_stats_field_invalid(client):
+    resp = await client.get("/api/v1/stats", params={"fieldid": "abc"})
+    assert resp.status == 400
 
 
 async def test_source_found(client):
@@ -84,6 +214,15 @@ async def test_object_invalid(client):
     assert resp.status == 400
 
 
+# Well formed, for a fieldid too large for the bigint object ID
+TOO_LARGE_OID = "9" * 8 + "110100000000"
+
+
+async def test_object_out_of_range(client):
+    resp = await client.get("/api/v1/object", params={"oid": TOO_LARGE_OID})
+    assert resp.status == 400
+
+
 async def test_object_missing_param(client):
     resp = await client.get("/api/v1/object")
     assert resp.status == 400
@@ -110,9 +249,864 @@ async def test_cone_search_with_filter(client):
     assert len(data) == 0
 
 
+async def test_moc(client):
+    for _ in range(100):
+        resp = await client.get("/api/v1/moc", params={"filter": "zr"})
+        if resp.status != 503:
+            break
+        await asyncio.sleep(0.1)
+    assert resp.status == 200
+    data = await resp.json()
+    assert 36549121 in data["11"]
+
+
+async def test_moc_invalid_filter(client):
+    resp = await client.get("/api/v1/moc", params={"filter": "zz"})
+    assert resp.status == 400
+
+
+async def test_cone_outside_coverage(client):
+    resp = await client.get(
+        "/api/v1/cone",
+        params={"ra": 24.986, "dec": 29.609, "radius_arcsec": 60},
+    )
+    assert resp.status == 200
+    assert await resp.json() == []
+
+
 async def test_cone_invalid_radius(client):
     resp = await client.get(
         "/api/v1/cone",
         params={"ra": 24.986, "dec": -29.609, "radius_arcsec": 100},
     )
     assert resp.status == 400
+
+
+async def test_cone_quality_cuts(client):
+    resp = await client.get(
+        "/api/v1/cone",
+        params={
+            "ra": 24.986,
+            "dec": -29.609,
+            "radius_arcsec": 60,
+            "mag_max": -6.0,
+            "flags_exclude": 1,
+        },
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data) >= 1
+    assert all(row["mag"] <= -6.0 for row in data)
+    assert any(row["filter"] == "zr" for row in data)
+
+
+async def test_cone_brightest_first(client):
+    resp = await client.get(
+        "/api/v1/cone",
+        params={"ra": 24.986, "dec": -29.609, "radius_arcsec": 60, "order": "mag"},
+    )
+    assert resp.status == 200
+    mags = [row["mag"] for row in await resp.json()]
+    assert mags == sorted(mags)
+
+
+async def test_cone_columns(client):
+    resp = await client.get(
+        "/api/v1/cone",
+        params={
+            "ra": 24.986,
+            "dec": -29.609,
+            "radius_arcsec": 60,
+            "columns": "mag,oid",
+        },
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data) >= 1
+    assert list(data[0]) == ["mag", "oid"]
+
+
+async def test_cone_invalid_columns(client):
+    resp = await client.get(
+        "/api/v1/cone",
+        params={"ra": 24.986, "dec": -29.609, "radius_arcsec": 60, "columns": "foo"},
+    )
+    assert resp.status == 400
+
+
+async def test_multiband_by_oid(client):
+    resp = await client.get("/api/v1/multiband", params={"oid": "202210100000000"})
+    assert resp.status == 200
+    data = await resp.json()
+    assert (data["fieldid"], data["ccdid"], data["qid"]) == (202, 10, 1)
+    assert data["zg"]["oid"] == "202110100000000"
+    assert data["zr"]["oid"] == "202210100000000"
+    assert data["zi"] is None
+    assert "separation_arcsec" not in data
+
+
+async def test_multiband_by_position(client):
+    resp = await client.get(
+        "/api/v1/multiband", params={"ra": 25.3803179, "dec": -29.6047335}
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert data["zg"]["sourceid"] == 1
+    assert data["zr"] is None
+    assert data["separation_arcsec"] < 0.01
+
+
+async def test_multiband_not_found(client):
+    resp = await client.get("/api/v1/multiband", params={"ra": 0.0, "dec": 0.0})
+    assert resp.status == 404
+    resp = await client.get("/api/v1/multiband", params={"oid": "202310100000000"})
+    assert resp.status == 404
+
+
+async def test_multiband_missing_params(client):
+    resp = await client.get("/api/v1/multiband", params={"ra": 25.0})
+    assert resp.status == 400
+
+
+async def test_knn(client):
+    resp = await client.get(
+        "/api/v1/knn", params={"ra": 25.3803, "dec": -29.6047, "k": 2}
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data) == 2
+    assert data[0]["sourceid"] == 1
+    assert data[0]["separation_arcsec"] < 1.0
+    assert data[0]["separation_arcsec"] <= data[1]["separation_arcsec"]
+
+
+async def test_knn_with_filter(client):
+    resp = await client.get(
+        "/api/v1/knn",
+        params={"ra": 25.3803, "dec": -29.6047, "k": 5, "filter": "zr"},
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data) >= 1
+    assert all(row["filter"] == "zr" for row in data)
+
+
+async def test_knn_invalid_k(client):
+    resp = await client.get("/api/v1/knn", params={"ra": 25.0, "dec": -29.0, "k": 0})
+    assert resp.status == 400
+
+
+PIXEL_PARAMS = {"fieldid": 202, "filter": "zg", "ccdid": 10, "qid": 1}
+
+
+async def test_pixel(client):
+    resp = await client.get(
+        "/api/v1/pixel",
+        params={**PIXEL_PARAMS, "x": 119.8, "y": 61.4, "radius_px": 5, "k": 2},
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data) == 1
+    assert data[0]["sourceid"] == 0
+    assert data[0]["separation_px"] < 1.0
+
+
+async def test_pixel_invalid(client):
+    resp = await client.get(
+        "/api/v1/pixel", params={**PIXEL_PARAMS, "x": 1, "y": 1, "radius_px": 0}
+    )
+    assert resp.status == 400
+    params = {**PIXEL_PARAMS, "x": 1, "y": 1, "radius_px": 5}
+    del params["qid"]
+    resp = await client.get("/api/v1/pixel", params=params)
+    assert resp.status == 400
+
+
+BOX_PARAMS = {"ra_min": 24.9, "ra_max": 25.5, "dec_min": -29.7, "dec_max": -29.5}
+
+
+async def test_box(client):
+    resp = await client.get("/api/v1/box", params=BOX_PARAMS)
+    assert resp.status == 200
+    data = await resp.json()
+    oids = {row["oid"] for row in data["sources"]}
+    assert {"202110100000000", "202110100000001", "202210100000000"} <= oids
+
+
+async def test_box_paging(client):
+    params = {**BOX_PARAMS, "filter": "zg", "limit": 1, "columns": "oid"}
+    resp = await client.get("/api/v1/box", params=params)
+    assert resp.status == 200
+    first = await resp.json()
+    assert len(first["sources"]) == 1
+    assert first["next"] is not None
+
+    resp = await client.get(first["next"])
+    assert resp.status == 200
+    second = await resp.json()
+    assert len(second["sources"]) == 1
+    assert second["sources"][0]["oid"] > first["sources"][0]["oid"]
+
+
+async def test_box_paging_across_fieldid_lengths(client, db_params):
+    con = await asyncpg.connect(**db_params)
+    try:
+        # Next to the seeded sources, object IDs of 15 and 16 digits
+        for fieldid in (245, 1023):
+            await con.execute(
+                """
+                INSERT INTO quadrant (fieldid, filter, ccdid, qid, magzp, magzp_rms,
+                                      magzp_unc, infobits)
+                VALUES ($1, 'zg', 1, 1, 26.0, 0.05, 0.0005, 0)
+                """,
+                fieldid,
+            )
+            await con.execute(
+                """
+                INSERT INTO refpsfcat (fieldid, filterid, ccdid, qid, sourceid, xpos,
+                                       ypos, coord, flux, sigflux, mag, sigmag, snr,
+                                       chi, sharp, flags)
+                VALUES ($1, 1, 1, 1, 0, 100.0, 100.0,
+                        spoint(radians(24.9859705), radians(-29.6089428)),
+                        100.0, 10.0, -5.0, 0.1, 10.0, 1.0, 0.0, 0)
+                """,
+                fieldid,
+            )
+
+        params = {**BOX_PARAMS, "filter": "zg", "limit": 1, "columns": "oid"}
+        resp = await client.get("/api/v1/box", params=params)
+        oids = []
+        while True:
+            assert resp.status == 200
+            data = await resp.json()
+            oids += [row["oid"] for row in data["sources"]]
+            if data["next"] is None:
+                break
+            resp = await client.get(data["next"])
+        assert oids == [
+            "202110100000000",
+            "202110100000001",
+            "245110100000000",
+            "1023110100000000",
+        ]
+    finally:
+        await con.execute("DELETE FROM refpsfcat WHERE fieldid IN (245, 1023)")
+        await con.execute("DELETE FROM quadrant WHERE fieldid IN (245, 1023)")
+        await con.close()
+
+
+async def test_box_after_out_of_range(client):
+    params = {**BOX_PARAMS, "after": TOO_LARGE_OID}
+    resp = await client.get("/api/v1/box", params=params)
+    assert resp.status == 400
+
+
+@pytest.mark.parametrize("value", ["nan", "inf", "-inf"])
+async def test_box_not_finite(client, value):
+    for param in ("ra_min", "dec_max"):
+        resp = await client.get("/api/v1/box", params={**BOX_PARAMS, param: value})
+        assert resp.status == 400
+
+
+async def test_box_plan(seed_db, db_params):
+    # With an empty region, the plan must still start from the GiST index
+    # rather than walk the oid index testing every source
+    con = await asyncpg.connect(**db_params)
+    try:
+        await connection_setup(con)
+        await con.execute("SET enable_seqscan = off")
+        query = region_query(
+            ("oid",), ["coord <@ $1::sbox", "oid > $2"], MAX_REGION_RESULTS + 1
+        )
+        empty = SBox(sw=SPoint(ra=180.0, dec=10.0), ne=SPoint(ra=180.1, dec=10.1))
+        plan = await con.fetchval(f"EXPLAIN (FORMAT JSON) {query}", empty, 0)
+        assert "idx_refpsfcat_coord" in plan
+        assert "idx_refpsfcat_oid" not in plan
+    finally:
+        await con.close()
+
+
+async def test_box_too_large(client):
+    resp = await client.get("/api/v1/box", params={**BOX_PARAMS, "ra_max": 30.0})
+    assert resp.status == 400
+
+
+async def test_polygon(client):
+    resp = await client.get(
+        "/api/v1/polygon",
+        params={"vertices": "24.95,-29.65,25.05,-29.65,25.0,-29.55", "filter": "zr"},
+    )
+    assert resp.status == 200
+    data = await resp.json()
+    assert [row["oid"] for row in data["sources"]] == ["202210100000000"]
+    assert data["next"] is None
+
+
+async def test_polygon_invalid(client):
+    resp = await client.get("/api/v1/polygon", params={"vertices": "1,2,3,4"})
+    assert resp.status == 400
+    resp = await client.get(
+        "/api/v1/polygon", params={"vertices": "24.95,-29.65,nan,-29.65,25.0,-29.55"}
+    )
+    assert resp.status == 400
+
+
+EXPORT_PARAMS = {"fieldid": 202, "filter": "zr", "ccdid": 10, "qid": 1}
+
+
+async def test_export_csv(client):
+    resp = await client.get("/api/v1/export", params=EXPORT_PARAMS)
+    assert resp.status == 200
+    assert resp.content_type == "text/csv"
+    header, *lines = (await resp.text()).splitlines()
+    assert header.split(",")[-1] == "oid"
+    assert any(line.endswith(",202210100000000") for line in lines)
+
+
+async def test_export_ndjson(client):
+    resp = await client.get(
+        "/api/v1/export", params={**EXPORT_PARAMS, "format": "ndjson"}
+    )
+    assert resp.status == 200
+    rows = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert {row["oid"] for row in rows} >= {"202210100000000"}
+    assert all(row["filter"] == "zr" for row in rows)
+
+
+async def test_export_arrow(client):
+    resp = await client.get(
+        "/api/v1/export", params={**EXPORT_PARAMS, "format": "arrow"}
+    )
+    assert resp.status == 200
+    table = pa.ipc.open_stream(await resp.read()).read_all()
+    assert table.num_rows >= 1
+    assert "202210100000000" in table.column("oid").to_pylist()
+    assert table.column("magzp")[0].as_py() == pytest.approx(26.190, abs=0.001)
+
+
+async def test_export_unknown_quadrant(client):
+    resp = await client.get("/api/v1/export", params={**EXPORT_PARAMS, "fieldid": 999})
+    assert resp.status == 404
+
+
+async def test_tile(client):
+    path = tile_file("zg", 3, 557)
+    path.parent.mkdir(parents=True)
+    path.write_text(
+        "oid\tra\tdec\tmag\tsigmag\n2021010000000\t24.9859705\t-29.6089428\t20.388\t0.083\n"
+    )
+
+    resp = await client.get("/api/v1/tiles/zg/Norder3/Dir0/Npix557.tsv")
+    assert resp.status == 200
+    assert resp.content_type == "text/tab-separated-values"
+    assert "max-age" in resp.headers["Cache-Control"]
+    assert (await resp.text()) == path.read_text()
+
+
+async def test_tile_missing(client):
+    resp = await client.get("/api/v1/tiles/zg/Norder3/Dir0/Npix556.tsv")
+    assert resp.status == 404
+    resp = await client.get("/api/v1/tiles/zg/Norder7/Dir0/Npix142770.tsv")
+    assert resp.status == 404
+
+
+async def test_xmatch_job(client):
+    body = "id,RA,Dec\n1,25.3803179,-29.6047335\n2,0.0,0.0\n3,24.9859705,-29.6089428\n"
+    resp = await client.post(
+        "/api/v1/xmatch", params={"filter": "zg"}, data=body.encode()
+    )
+    assert resp.status == 202
+    job = await resp.json()
+    assert job["status"] == "queued"
+
+    for _ in range(100):
+        resp = await client.get(f"/api/v1/xmatch/{job['job_id']}")
+        job = await resp.json()
+        if job["status"] in ("done", "failed"):
+            break
+        await asyncio.sleep(0.1)
+    assert job["status"] == "done", job["error"]
+    assert job["n_rows"] == 3
+    assert job["n_matched"] == 2
+
+    resp = await client.get(job["result"])
+    assert resp.status == 200
+    table = pq.read_table(io.BytesIO(await resp.read()))
+    rows = {row["id"]: row for row in table.to_pylist()}
+    assert rows[1]["ref_sourceid"] == 1
+    assert rows[1]["ref_filter"] == "zg"
+    assert rows[1]["separation_arcsec"] < 1.0
+    assert rows[2]["ref_oid"] is None
+    assert rows[3]["ref_oid"] == "202110100000000"
+
+
+async def test_xmatch_reclaims_stale_job(client, db_params):
+    # A job left running by a worker that died an hour ago
+    job_id = uuid4()
+    path = input_path(job_id, "csv")
+    path.parent.mkdir(parents=True)
+    path.write_text("ra,dec\n25.3803179,-29.6047335\n")
+    con = await asyncpg.connect(**db_params)
+    try:
+        await con.execute(
+            """
+            INSERT INTO xmatch_job (job_id, status, format, radius_arcsec,
+                                    started_at, heartbeat_at)
+            VALUES ($1, 'running', 'csv', 1.5, now() - interval '1 hour',
+                    now() - interval '1 hour')
+            """,
+            job_id,
+        )
+    finally:
+        await con.close()
+
+    for _ in range(100):
+        resp = await client.get(f"/api/v1/xmatch/{job_id}")
+        job = await resp.json()
+        if job["status"] in ("done", "failed"):
+            break
+        await asyncio.sleep(0.1)
+    assert job["status"] == "done", job["error"]
+    assert job["n_matched"] == 1
+
+
+async def test_xmatch_stale_attempt(client, db_params):
+    # A job claimed again while its first worker was stuck
+    job_id = uuid4()
+    job_dir(job_id).mkdir(parents=True)
+    partial_path(job_id, 1).write_bytes(b"stale")
+    con = await asyncpg.connect(**db_params)
+    try:
+        await con.execute(
+            """
+            INSERT INTO xmatch_job (job_id, status, format, radius_arcsec,
+                                    started_at, heartbeat_at, attempt)
+            VALUES ($1, 'running', 'csv', 1.5, now(), now(), 2)
+            """,
+            job_id,
+        )
+        with pytest.raises(JobLost):
+            await _finish(client.app, {"job_id": job_id, "attempt": 1}, "done", None)
+        status = await con.fetchval(
+            "SELECT status FROM xmatch_job WHERE job_id = $1", job_id
+        )
+    finally:
+        await con.close()
+    assert status == "running"
+    assert not result_path(job_id).exists()
+
+
+async def test_xmatch_sweep(client, db_params):
+    old, recent = uuid4(), uuid4()
+    con = await asyncpg.connect(**db_params)
+    try:
+        for job_id, age in ((old, "30 days"), (recent, "1 hour")):
+            job_dir(job_id).mkdir(parents=True)
+            result_path(job_id).write_bytes(b"result")
+            await con.execute(
+                """
+                INSERT INTO xmatch_job (job_id, status, format, radius_arcsec,
+                                        finished_at)
+                VALUES ($1, 'done', 'csv', 1.5, now() - $2::interval)
+                """,
+                job_id,
+                age,
+            )
+        await sweep_jobs(client.app)
+        remaining = await con.fetch(
+            "SELECT job_id FROM xmatch_job WHERE job_id = ANY($1::uuid[])",
+            [old, recent],
+        )
+    finally:
+        await con.close()
+    assert [row["job_id"] for row in remaining] == [recent]
+    assert not job_dir(old).exists()
+    assert result_path(recent).exists()
+
+
+async def test_xmatch_empty_upload(client):
+    resp = await client.post("/api/v1/xmatch", data=b"")
+    assert resp.status == 400
+    assert not jobs_dir().exists() or not any(jobs_dir().iterdir())
+
+
+async def test_xmatch_invalid_format(client):
+    resp = await client.post(
+        "/api/v1/xmatch", params={"format": "votable"}, data=b"ra,dec\n1,2\n"
+    )
+    assert resp.status == 400
+
+
+async def test_xmatch_unknown_job(client):
+    resp = await client.get("/api/v1/xmatch/00000000-0000-0000-0000-000000000000")
+    assert resp.status == 404
+
+
+def test_xmatch_read_table(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text("name,RA,DEC\na,10.0,20.0\n")
+    table = read_table(path, "csv")
+    assert table.column_names == ["name", "ra", "dec"]
+
+
+def test_xmatch_spatial_order():
+    ra = np.array([10.0, 350.0, 20.0, 15.0])
+    dec = np.array([0.0, -45.0, 0.01, 45.0])
+    order = spatial_order(ra, dec)
+    assert order.tolist() == [1, 0, 2, 3]
+
+
+# Shared with the tests of the ingest copy of union_ranges
+UNION_RANGES_CASES = json.loads(
+    (Path(__file__).parent / "fixtures" / "union_ranges.json").read_text()
+)
+
+
+@pytest.mark.parametrize("case", UNION_RANGES_CASES)
+def test_union_ranges(case):
+    merged = union_ranges(*(np.array(r) for r in case["inputs"]))
+    assert merged.shape == (len(case["expected"]), 2)
+    assert merged.tolist() == case["expected"]
+
+
+def test_coverage_overlaps():
+    # Order 11 cell of zg source 0, whose neighbours are not covered
+    coverage = Coverage(11, np.array([[36549121, 36549122]]))
+    assert coverage.overlaps(SPoint(ra=24.9859705, dec=-29.6089428), 1 / 3600)
+    assert coverage.overlaps(SPoint(ra=24.9859705, dec=-29.65), 0.05)
+    assert not coverage.overlaps(SPoint(ra=24.9859705, dec=-29.8), 1 / 60)
+    assert not coverage.overlaps(SPoint(ra=204.98, dec=29.6), 1 / 60)
+    assert not Coverage(11, np.empty((0, 2), dtype=np.int64)).overlaps(
+        SPoint(ra=0.0, dec=0.0), 1.0
+    )
+
+
+def test_coverage_to_moc():
+    # 16 aligned cells make one order 9 cell, the rest stay at order 11
+    coverage = Coverage(11, np.array([[16, 33], [40, 41]]))
+    assert coverage.to_moc() == {"9": [1], "11": [32, 40]}
+    assert Coverage(11, np.empty((0, 2), dtype=np.int64)).to_moc() == {"11": []}
+
+
+async def test_coverage_cache_late_commit(db_params):
+    pool = await asyncpg.create_pool(**db_params, setup=connection_setup)
+    cache = CoverageCache()
+    try:
+        await cache.refresh(pool)
+        async with pool.acquire() as con:
+            # Dated well before the last refresh, as a late commit would be
+            await con.execute(
+                """
+                INSERT INTO coverage (filterid, chunk, moc_order, ranges, updated_at)
+                VALUES (3, 557, 11, '{36549121, 36549122}', now() - interval '1 day')
+                """
+            )
+        await cache.refresh(pool)
+        assert cache._chunks[(3, 557)].tolist() == [[36549121, 36549122]]
+        async with pool.acquire() as con:
+            await con.execute("DELETE FROM coverage WHERE filterid = 3 AND chunk = 557")
+        await cache.refresh(pool)
+        assert (3, 557) not in cache._chunks
+    finally:
+        async with pool.acquire() as con:
+            await con.execute("DELETE FROM coverage WHERE filterid = 3 AND chunk = 557")
+        await pool.close()
+
+
+def test_bounding_circle():
+    corners = [SPoint(ra=359.5, dec=10.0), SPoint(ra=0.5, dec=11.0)]
+    center, radius = bounding_circle(corners)
+    assert min(center.ra, 360.0 - center.ra) < 0.01
+    assert radius < 1.0
+    assert radius == pytest.approx(max(center.separation(p) for p in corners))
+
+
+async def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    results = await asyncio.gather(
+        *(flight.do("a", lambda: fn(len(calls))) for _ in range(10)),
+        flight.do("b", lambda: fn("b")),
+    )
+    assert results == [0] * 10 + ["b"]
+    assert calls == [0, "b"]
+    assert len(flight) == 0
+
+
+async def test_single_flight_cancelled_caller():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        return 42
+
+    first = asyncio.ensure_future(flight.do("a", fn))
+    second = asyncio.ensure_future(flight.do("a", fn))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == 42
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+
+async def test_gate_sheds_load():
+    gate = Gate(concurrency=1, queue=1, max_wait=0.05)
+    release = asyncio.Event()
+
+    async def hold():
+        async with gate.enter():
+            await release.wait()
+
+    holder = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    queued = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    assert gate.waiting == 1
+    with pytest.raises(Rejected, match="full"):
+        async with gate.enter():
+            pass
+    # The queued request gives up once it waited too long
+    with pytest.raises(Rejected, match="timed out"):
+        await queued
+    assert gate.waiting == 0
+
+    release.set()
+    await holder
+    async with gate.enter():
+        pass
+
+
+def test_token_buckets():
+    now = 0.0
+    buckets = TokenBuckets(rate=2, burst=2, clock=lambda: now)
+    assert buckets.take("a") == 0
+    assert buckets.take("a") == 0
+    assert buckets.take("a") == pytest.approx(0.5)
+    assert buckets.take("b") == 0
+    now = 0.5
+    assert buckets.take("a") == 0
+    # Buckets that filled up again are forgotten
+    now = 10.0
+    buckets.take("c")
+    assert len(buckets) == 1
+
+
+async def test_single_flight_all_callers_cancelled():
+    flight = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def fn():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    callers = [asyncio.ensure_future(flight.do("a", fn)) for _ in range(2)]
+    await asyncio.sleep(0)
+    for caller in callers:
+        caller.cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
+    assert len(flight) == 0
+
+
+async def test_admission_timeout():
+    admission = Admission({"search": (1, 0)}, timeouts={"search": 0.01})
+    with pytest.raises(QueryTimeout):
+        async with admission.enter("search"):
+            await asyncio.sleep(1)
+    # The slot is free again
+    async with admission.enter("search"):
+        pass
+
+
+def _write_shard(path, fieldid, filt, n, rng):
+    # The layout written by the ingest service
+    dtype = [("ccdid", "i2"), ("qid", "i2"), ("sourceid", "i4"), ("ra", "f8")]
+    dtype += [("dec", "f8"), ("mag", "f4"), ("flags", "i2")]
+    sources = np.zeros(n, dtype=dtype)
+    sources["ccdid"] = rng.integers(1, 17, n)
+    sources["qid"] = rng.integers(1, 5, n)
+    sources["sourceid"] = np.arange(n)
+    sources["ra"] = rng.uniform(24.0, 26.0, n)
+    sources["dec"] = rng.uniform(-30.0, -29.0, n)
+    sources["mag"] = rng.uniform(-8.0, -2.0, n)
+    sources["mag"][::7] = np.nan
+    sources["flags"] = rng.integers(0, 4, n)
+    hp = HEALPix(nside=2**SHARD_ORDER, order="nested")
+    hpx = hp.lonlat_to_healpix(sources["ra"] * u.deg, sources["dec"] * u.deg)
+    order = np.argsort(hpx)
+    sources, hpx = sources[order], hpx[order]
+    keys = shard_key(
+        sources["ccdid"].astype(np.int64),
+        sources["qid"].astype(np.int64),
+        sources["sourceid"].astype(np.int64),
+    )
+    key_rows = np.argsort(keys)
+    path.mkdir(parents=True)
+    np.save(path / "sources.npy", sources)
+    np.save(path / "hpx.npy", hpx)
+    np.save(path / "keys.npy", keys[key_rows])
+    np.save(path / "key_rows.npy", key_rows)
+    meta = {"fieldid": fieldid, "filter": filt, "order": SHARD_ORDER}
+    meta.update(index_order=6, pixels=np.unique(hpx >> 28).tolist())
+    (path / "meta.json").write_text(json.dumps(meta))
+    return sources
+
+
+def test_shards(tmp_path):
+    rng = np.random.default_rng(0)
+    a = _write_shard(tmp_path / "a", 202, "zg", 20000, rng)
+    b = _write_shard(tmp_path / "b", 203, "zg", 20000, rng)
+    shards = ShardSet(
+        {("zg", 202): Shard(tmp_path / "a"), ("zg", 203): Shard(tmp_path / "b")},
+        {"zg", "zr", "zi"},
+    )
+    center = SPoint(ra=25.0, dec=-29.5)
+    radius = 60 / 3600
+    sources = np.concatenate([a, b])
+    separation = _separation_deg(center.ra, center.dec, sources["ra"], sources["dec"])
+
+    rows = shards.cone(center, radius, Selection(), "distance", 1000)
+    assert len(rows) == np.count_nonzero(separation <= radius)
+    rows = shards.cone(
+        center,
+        radius,
+        Selection(fieldid=202, cuts=[("mag", "<=", -4.0)], flags_exclude=1),
+        "mag",
+        1000,
+    )
+    expected = a[
+        (separation[: len(a)] <= radius) & (a["mag"] <= -4.0) & (a["flags"] & 1 == 0)
+    ]
+    assert [row["mag"] for row in rows] == sorted(expected["mag"].tolist())
+    assert {row["fieldid"] for row in rows} == {202}
+
+    rows = shards.knn(center, 5, Selection())
+    assert [row["separation_arcsec"] for row in rows] == pytest.approx(
+        np.sort(separation)[:5] * 3600
+    )
+
+    src = a[100]
+    key = int(src["ccdid"]), int(src["qid"]), int(src["sourceid"])
+    (row,) = shards.source(202, "zg", *key)
+    assert (row["fieldid"], row["filter"], row["sourceid"]) == (202, "zg", key[2])
+    assert row["oid"] == build_object_id(202, "zg", *key)
+    assert shards.source(202, "zg", 1, 1, 10**6) == []
+    # Fields and filters without a current shard are left to the database
+    assert shards.source(204, "zg", 1, 1, 1) is None
+    stale = ShardSet(shards.shards, {"zg", "zr"})
+    assert stale.cone(center, radius, Selection(filter="zg"), "mag", 10) is not None
+    assert stale.cone(center, radius, Selection(), "mag", 10) is None
+
+
+def test_object_id():
+    oid = object_id(202, 1, 10, 1, 5)
+    assert str(oid) == build_object_id(202, "zg", 10, 1, 5) == "202110100000005"
+    assert parse_object_id(str(oid)) == (202, "zg", 10, 1, 5)
+    # Too large for the bigint it is stored as
+    with pytest.raises(ValueError):
+        parse_object_id(TOO_LARGE_OID)
+    # Sorts like the key, also for arrays
+    keys = np.array(
+        [
+            (202, 1, 10, 1, 5),
+            (202, 1, 16, 4, 99999999),
+            (202, 3, 1, 1, 0),
+            (1795, 1, 1, 1, 0),
+        ],
+        dtype=np.int64,
+    )
+    assert np.all(np.diff(object_id(*keys.T)) > 0)
+
+
+def test_parse_hosts():
+    assert parse_hosts("sql, replica:5433,") == [("sql", 5432), ("replica", 5433)]
+
+
+async def test_router_survives_check_errors():
+    class BrokenRouter(PoolRouter):
+        async def _create_pool(self, ep):
+            raise InvalidCatalogNameError("database does not exist")
+
+    router = BrokenRouter(("127.0.0.1", 1), [], check_interval=0.01)
+    ep = router.endpoints[0]
+    ep.healthy = True
+    router._health_task = asyncio.create_task(router._health_loop())
+    try:
+        await asyncio.sleep(0.05)
+        assert not router._health_task.done()
+        assert not ep.healthy
+    finally:
+        await router.close()
+
+
+class _LaggingPool:
+    def __init__(self, lag):
+        self.lag = lag
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield self
+
+    async def fetchval(self, query, timeout=None):
+        return self.lag
+
+
+async def test_router_lagging_replica():
+    router = PoolRouter(("127.0.0.1", 1), [("127.0.0.2", 1)], max_lag=30)
+    ep = router.endpoints[0]
+    ep.pool = _LaggingPool(120.0)
+    await router._check(ep)
+    assert not ep.healthy
+    ep.pool.lag = 1.0
+    await router._check(ep)
+    assert ep.healthy
+
+
+async def test_router_failover(db_params):
+    (primary,) = parse_hosts(db_params["host"])
+    router = PoolRouter(
+        primary,
+        [("127.0.0.1", 1), primary],
+        connect_timeout=1,
+        database=db_params["database"],
+        user=db_params["user"],
+        setup=connection_setup,
+    )
+    await router.start()
+    try:
+        for _ in range(3):
+            async with router.acquire() as con:
+                assert await con.fetchval("SELECT 1") == 1
+        assert len(router.pools()) == 1
+    finally:
+        await router.close()
+
+
+async def test_router_balances_replicas(db_params):
+    replica = os.environ.get("TEST_DB_REPLICA_HOST")
+    if not replica:
+        pytest.skip("TEST_DB_REPLICA_HOST is not set")
+    (primary,) = parse_hosts(db_params["host"])
+    router = PoolRouter(
+        primary,
+        [primary, *parse_hosts(replica)],
+        database=db_params["database"],
+        user=db_params["user"],
+        setup=connection_setup,
+    )
+    await router.start()
+    try:
+        async with router.acquire() as con1, router.acquire() as con2:
+            port1 = await con1.fetchval("SELECT inet_server_port()")
+            port2 = await con2.fetchval("SELECT inet_server_port()")
+        assert port1 != port2
+    finally:
+        await router.close()